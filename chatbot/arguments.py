@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+from typing import Optional
 from transformers import HfArgumentParser
 
 @dataclass
@@ -12,6 +13,10 @@ class ChatbotArguments:
     rag_collector_name_or_path: str = field(
         metadata={"help": "The name or path to the chatbot model."}
     )
+    chatbot_draft_model_name_or_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Small draft model sharing the chatbot tokenizer. When set, chat and RAG responses use assisted (speculative) decoding."}
+    )
     default_chat_system_prompt: str = field(
         default="당신은 대형 언어 모델인 assistant입니다. user의 질문에 대해 정확하고 유용하며 정보가 풍부한 답변을 제공하는 것이 당신의 역할입니다.",
         metadata={"help": "The name or path to the chatbot model."}
@@ -24,8 +29,285 @@ class ChatbotArguments:
         default=True,
         metadata={"help": "Whether to use the system prompt template for fine-tuning or inference."}
     )
+    chatbot_max_new_tokens: int = field(
+        default=512,
+        metadata={"help": "Maximum number of tokens generated per chat and RAG response. The chat history budget leaves room for this many tokens."}
+    )
+    chat_context_tokens: Optional[int] = field(
+        default=None,
+        metadata={"help": "Context length used to trim chat history. History is kept within this budget minus max_new_tokens. Defaults to the model's max_position_embeddings."}
+    )
+    use_streaming: bool = field(
+        default=True,
+        metadata={"help": "Whether to stream generated tokens to the chat and RAG outputs as they are produced."}
+    )
+    kv_cache_max_memory_mb: int = field(
+        default=2048,
+        metadata={"help": "Memory budget in MB for per-session KV caches reused across chat turns (LRU eviction). 0 disables reuse."}
+    )
+    use_batch_scheduler: bool = field(
+        default=False,
+        metadata={"help": "Whether to run concurrent chat and RAG requests through one continuously batched decoding loop."}
+    )
+    scheduler_max_batch_size: int = field(
+        default=8,
+        metadata={"help": "Maximum number of requests decoded together by the batch scheduler."}
+    )
+    rag_store_dir: str = field(
+        default="./storage/rag_store",
+        metadata={"help": "Directory where memory-mapped RAG corpus embeddings are cached between launches."}
+    )
+    rag_embedding_dtype: str = field(
+        default="float32",
+        metadata={"help": "Storage dtype of the cached corpus embeddings ('float32' or 'float16')."}
+    )
+    rag_normalize_embeddings: bool = field(
+        default=True,
+        metadata={"help": "Whether to L2-normalize corpus embeddings before caching them."}
+    )
+    rag_index_type: str = field(
+        default="exact",
+        metadata={"help": "Vector index used for retrieval ('exact' for brute-force search, 'ivf' for an inverted-file ANN index, 'int8' or 'binary' for quantized codes rescored at full precision)."}
+    )
+    rag_ivf_nlist: int = field(
+        default=1024,
+        metadata={"help": "Number of IVF clusters. More clusters make each query scan fewer documents."}
+    )
+    rag_ivf_nprobe: int = field(
+        default=16,
+        metadata={"help": "Number of IVF clusters scanned per query. Higher values improve recall at the cost of speed."}
+    )
+    rag_rescore_candidates: int = field(
+        default=200,
+        metadata={"help": "Number of candidates found with the 'int8' or 'binary' index that are rescored with the full-precision embeddings on disk."}
+    )
+    rag_query_debounce_ms: int = field(
+        default=300,
+        metadata={"help": "Delay in milliseconds before searching while the RAG search box is still changing."}
+    )
+    rag_query_cache_size: int = field(
+        default=1024,
+        metadata={"help": "Number of query embeddings and top-k results kept in the LRU retrieval caches."}
+    )
+    rag_use_sparse_first_stage: bool = field(
+        default=False,
+        metadata={"help": "Shortlist documents with a BM25 index first and rescore only the shortlist with the dense embeddings."}
+    )
+    rag_sparse_candidates: int = field(
+        default=2000,
+        metadata={"help": "Number of BM25 candidates passed to the dense rescoring stage."}
+    )
+    rag_reload_interval_seconds: float = field(
+        default=10,
+        metadata={"help": "How often to check the embedding store for documents ingested by chatbot/ingest.py and swap in the new version. 0 disables hot reloading."}
+    )
+    telemetry_window_size: int = field(
+        default=1000,
+        metadata={"help": "Number of recent requests per metric used for the rolling p50/p95/p99 served at /metrics."}
+    )
+    telemetry_log_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "File where per-request metrics are written as JSON lines. Defaults to stderr."}
+    )
+    telemetry_log_conversations: bool = field(
+        default=True,
+        metadata={"help": "Whether to include the prompt conversation in the per-request JSON logs."}
+    )
+    http_api_host: str = field(
+        default="127.0.0.1",
+        metadata={"help": "Host the local HTTP API binds to."}
+    )
+    http_api_port: Optional[int] = field(
+        default=None,
+        metadata={"help": "Port of the local HTTP API (including /metrics). When set, gradio_chatbot.py also serves the API with the same loaded models."}
+    )
+
+@dataclass
+class BatchInferenceArguments:
+    input_path: str = field(
+        metadata={"help": "JSONL file with one prompt per line."}
+    )
+    output_path: str = field(
+        metadata={"help": "JSONL file where each input record is written with its index and response, in generation order."}
+    )
+    prompt_field: str = field(
+        default="instruction",
+        metadata={"help": "Field of the input records that holds the prompt."}
+    )
+    use_rag: bool = field(
+        default=False,
+        metadata={"help": "Whether to retrieve the top document for each prompt and add it with the RAG template."}
+    )
+    batch_size: int = field(
+        default=16,
+        metadata={"help": "Number of prompts generated together. Prompts are bucketed by token length to limit padding."}
+    )
+    max_new_tokens: int = field(
+        default=512,
+        metadata={"help": "Maximum number of tokens generated per prompt."}
+    )
+    do_sample: bool = field(
+        default=False,
+        metadata={"help": "Whether to sample. Greedy decoding is used otherwise."}
+    )
+    temperature: float = field(
+        default=1.0,
+        metadata={"help": "Sampling temperature."}
+    )
+    top_p: float = field(
+        default=1.0,
+        metadata={"help": "Top-p used when sampling."}
+    )
+    repetition_penalty: float = field(
+        default=1.0,
+        metadata={"help": "Repetition penalty."}
+    )
 
-def parse_args():
+@dataclass
+class BenchmarkArguments:
+    output_dir: str = field(
+        default="./storage/benchmark",
+        metadata={"help": "Directory where report.json and the per-request telemetry log are written."}
+    )
+    use_synthetic_models: bool = field(
+        default=True,
+        metadata={"help": "Whether to benchmark tiny randomly initialised models and a synthetic corpus instead of the given model paths."}
+    )
+    synthetic_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory for the synthetic models and corpus. Defaults to a new temporary directory."}
+    )
+    synthetic_documents: int = field(
+        default=2000,
+        metadata={"help": "Number of documents in the synthetic RAG corpus."}
+    )
+    num_users: int = field(
+        default=8,
+        metadata={"help": "Number of simulated concurrent users."}
+    )
+    num_turns: int = field(
+        default=4,
+        metadata={"help": "Number of chat turns sent by each user."}
+    )
+    num_retries: int = field(
+        default=1,
+        metadata={"help": "Number of retries each user sends after the chat turns."}
+    )
+    num_rag_queries: int = field(
+        default=2,
+        metadata={"help": "Number of retrieval + RAG inference requests sent by each user."}
+    )
+    message_words: int = field(
+        default=16,
+        metadata={"help": "Number of words in each generated user message and RAG query."}
+    )
+    max_new_tokens: int = field(
+        default=64,
+        metadata={"help": "Maximum number of tokens generated per response during the benchmark."}
+    )
+    temperature: float = field(
+        default=1.0,
+        metadata={"help": "Sampling temperature."}
+    )
+    top_p: float = field(
+        default=1.0,
+        metadata={"help": "Top-p used when sampling."}
+    )
+    generation_concurrency: Optional[int] = field(
+        default=None,
+        metadata={"help": "Number of generation handlers running at once. Defaults to the Gradio queue limit (scheduler_max_batch_size with the batch scheduler, otherwise 1)."}
+    )
+    warmup_requests: int = field(
+        default=1,
+        metadata={"help": "Number of untimed chat requests sent before the benchmark starts."}
+    )
+    seed: int = field(
+        default=0,
+        metadata={"help": "Seed for the synthetic models, corpus and user messages."}
+    )
+
+@dataclass
+class EncodeCorpusArguments:
+    shard_size: int = field(
+        default=50000,
+        metadata={"help": "Number of documents per saved shard. An interrupted build resumes from the first missing shard."}
+    )
+    encode_batch_size: int = field(
+        default=64,
+        metadata={"help": "Batch size of each encoding worker."}
+    )
+    encode_devices: Optional[str] = field(
+        default=None,
+        metadata={"help": "Comma separated devices for the encoding workers, e.g. cuda:0,cuda:1 or cpu,cpu,cpu,cpu. Defaults to all CUDA devices, or up to 4 CPU workers."}
+    )
+    work_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory for the length order and encoded shards. Defaults to <store path>.build next to the store."}
+    )
+
+@dataclass
+class RagStoreArguments:
+    rag_embedder_name_or_path: str = field(
+        metadata={"help": "The name or path to the embedding model used for the RAG corpus."}
+    )
+    rag_collector_name_or_path: str = field(
+        metadata={"help": "The name or path to the RAG corpus dataset."}
+    )
+    rag_store_dir: str = field(
+        default="./storage/rag_store",
+        metadata={"help": "Directory where memory-mapped RAG corpus embeddings are cached between launches."}
+    )
+    rag_embedding_dtype: str = field(
+        default="float32",
+        metadata={"help": "Storage dtype of the cached corpus embeddings ('float32' or 'float16')."}
+    )
+    rag_normalize_embeddings: bool = field(
+        default=True,
+        metadata={"help": "Whether to L2-normalize corpus embeddings before caching them."}
+    )
+
+@dataclass
+class IngestArguments:
+    input_path: str = field(
+        metadata={"help": "JSONL file with one document per line to add, update or delete."}
+    )
+    id_field: str = field(
+        default="id",
+        metadata={"help": "Field holding the document id. Documents of the original collector are matched by this column, or by row number when the collector has no such column."}
+    )
+    text_field: str = field(
+        default="output",
+        metadata={"help": "Field holding the document text."}
+    )
+    delete_field: str = field(
+        default="deleted",
+        metadata={"help": "Field that marks a record as a deletion when true."}
+    )
+
+def parse_args(args=None):
     parser = HfArgumentParser(ChatbotArguments)
 
-    return parser.parse_args_into_dataclasses()
\ No newline at end of file
+    return parser.parse_args_into_dataclasses(args=args)
+
+def batch_inference_parse_args():
+    parser = HfArgumentParser((ChatbotArguments, BatchInferenceArguments))
+
+    return parser.parse_args_into_dataclasses()
+
+def encode_corpus_parse_args():
+    # 코퍼스 인코딩도 챗봇 모델을 읽지 않으므로 임베딩 store 를 찾는 인자만 받음
+    parser = HfArgumentParser((RagStoreArguments, EncodeCorpusArguments))
+
+    return parser.parse_args_into_dataclasses()
+
+def ingest_parse_args():
+    # ingestion 은 챗봇 모델을 읽지 않으므로 임베딩 store 를 찾는 인자만 받음
+    parser = HfArgumentParser((RagStoreArguments, IngestArguments))
+
+    return parser.parse_args_into_dataclasses()
+
+def benchmark_parse_args():
+    parser = HfArgumentParser(BenchmarkArguments)
+
+    # 나머지 인자는 ChatbotArguments 로 다시 파싱
+    return parser.parse_args_into_dataclasses(return_remaining_strings=True)
\ No newline at end of file
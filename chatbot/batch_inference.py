@@ -0,0 +1,74 @@
+import json
+import time
+
+from rich.console import Console
+from rich.panel import Panel
+from rich.align import Align
+from rich.progress import track
+
+from arguments import batch_inference_parse_args
+from chatbot_functions import ChatbotFunctions
+
+
+def length_buckets(lengths, batch_size):
+    # 길이가 비슷한 프롬프트끼리 묶어서 padding 을 줄이고, 가장 긴 배치를 먼저 실행해 메모리 부족을 빨리 확인
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx], reverse=True)
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def main():
+    args = batch_inference_parse_args()
+    chatbot_args = args[0]
+    batch_args = args[1]
+
+    with open(batch_args.input_path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    messages = [record[batch_args.prompt_field] for record in records]
+
+    chatbot = ChatbotFunctions(chatbot_args, use_rag=batch_args.use_rag)
+
+    documents = [None] * len(records)
+    system_prompt = chatbot_args.default_chat_system_prompt
+    if batch_args.use_rag is True:
+        documents = [top_documents[0] for top_documents in chatbot.retrieve_documents(messages, top_k=1)]
+        system_prompt = chatbot_args.default_rag_system_prompt
+
+    input_ids_list = [
+        chatbot.build_input_ids(message, chatbot_args.use_system_prompt, system_prompt, document=document)
+        for message, document in zip(messages, documents)
+        ]
+
+    start_time = time.perf_counter()
+    with open(batch_args.output_path, "w", encoding="utf-8") as f:
+        for batch in track(length_buckets([input_ids.shape[-1] for input_ids in input_ids_list], batch_args.batch_size), description="Generating"):
+            metrics = chatbot.telemetry.request("batch_inference", batch_size=len(batch))
+            responses = chatbot.generate_texts(
+                [input_ids_list[idx] for idx in batch],
+                repetition_penalty=batch_args.repetition_penalty,
+                temperature=batch_args.temperature,
+                top_p=batch_args.top_p,
+                max_new_tokens=batch_args.max_new_tokens,
+                do_sample=batch_args.do_sample,
+                metrics=metrics
+                )
+            metrics.finish(
+                prompt_tokens=sum(input_ids_list[idx].shape[-1] for idx in batch),
+                padded_prompt_tokens=len(batch) * max(input_ids_list[idx].shape[-1] for idx in batch)
+                )
+
+            for idx, response in zip(batch, responses):
+                output = dict(records[idx], index=idx, response=response)
+                if documents[idx] is not None:
+                    output["document"] = documents[idx]
+                f.write(json.dumps(output, ensure_ascii=False) + "\n")
+            f.flush()
+
+    return len(records), time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    num_records, elapsed = main()
+
+    console = Console()
+    message = Align.center(f"Generated {num_records} responses in {elapsed:.1f}s.")
+    console.print("\n", Panel(message, title="Success", border_style="bold", width=60, height=3), "\n")
@@ -0,0 +1,286 @@
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+from dataclasses import asdict
+from threading import Lock, Semaphore, Thread
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import transformers
+
+from rich.console import Console
+from rich.table import Table
+
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import BertConfig, BertModel, LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+from sentence_transformers import SentenceTransformer
+from sentence_transformers.models import Pooling, Transformer
+
+from arguments import benchmark_parse_args, parse_args
+from chatbot_functions import ChatbotFunctions
+
+
+WORDS = "서울 부산 대구 인천 대한민국 수도 역사 인구 강 산 바다 학교 대학 문화 경제 과학 기술 정부 the a of city river mountain school history population capital science culture".split()
+
+CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for message in messages %}"
+    "{{ '<start_of_turn>' + message['role'] + '\n' + message['content'] | trim + '<end_of_turn>\n' }}"
+    "{% endfor %}{% if add_generation_prompt %}{{ '<start_of_turn>model\n' }}{% endif %}"
+    )
+
+
+def build_synthetic_assets(output_dir, num_documents, seed):
+    # 랜덤 초기화한 작은 모델과 합성 코퍼스로 CPU 에서도 같은 조건의 벤치마크를 재현
+    rng = random.Random(seed)
+    torch.manual_seed(seed)
+
+    corpus = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 60))) for _ in range(num_documents)]
+
+    tokenizer_model = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer_model.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer_model.decoder = decoders.ByteLevel()
+    tokenizer_model.train_from_iterator(corpus, trainers.BpeTrainer(
+        vocab_size=1000,
+        special_tokens=["<pad>", "<unk>", "<bos>", "<start_of_turn>", "<end_of_turn>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+        ))
+
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer_model, bos_token="<bos>", eos_token="<end_of_turn>", pad_token="<pad>", unk_token="<unk>", additional_special_tokens=["<start_of_turn>"])
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    model_path = os.path.join(output_dir, "model")
+    model = LlamaForCausalLM(LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=128,
+        intermediate_size=256,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id
+        ))
+    model.save_pretrained(model_path)
+    tokenizer.save_pretrained(model_path)
+
+    embedder_path = os.path.join(output_dir, "embedder")
+    encoder_path = os.path.join(output_dir, "encoder")
+    BertModel(BertConfig(vocab_size=len(tokenizer), hidden_size=64, num_hidden_layers=1, num_attention_heads=2, intermediate_size=128, max_position_embeddings=512)).save_pretrained(encoder_path)
+    tokenizer.save_pretrained(encoder_path)
+    transformer = Transformer(encoder_path, max_seq_length=256)
+    SentenceTransformer(modules=[transformer, Pooling(transformer.get_word_embedding_dimension())]).save(embedder_path)
+
+    corpus_path = os.path.join(output_dir, "corpus")
+    os.makedirs(corpus_path, exist_ok=True)
+    with open(os.path.join(corpus_path, "train.jsonl"), "w", encoding="utf-8") as f:
+        for document in corpus:
+            f.write(json.dumps({"instruction": document[:40], "output": document}, ensure_ascii=False) + "\n")
+
+    return model_path, embedder_path, corpus_path
+
+
+def random_message(rng, num_words):
+    return " ".join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def last(generator):
+    result = None
+    for result in generator:
+        pass
+    return result
+
+
+class BenchmarkRecorder:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.latencies = {}
+        self.errors = {}
+        self.generated_tokens = 0
+        self.lock = Lock()
+
+    def run(self, handler, call, limiter=None):
+        start_time = time.perf_counter()
+        try:
+            if limiter is None:
+                result = call()
+            else:
+                # Gradio 큐의 동시 실행 수 제한과 같은 조건으로 대기
+                with limiter:
+                    result = call()
+        except Exception as error:
+            with self.lock:
+                self.errors.setdefault(handler, []).append(repr(error))
+            return None
+
+        latency = time.perf_counter() - start_time
+        with self.lock:
+            self.latencies.setdefault(handler, []).append(latency)
+        return result
+
+    def count_tokens(self, texts):
+        num_tokens = sum(len(self.tokenizer(text, add_special_tokens=False)["input_ids"]) for text in texts)
+        with self.lock:
+            self.generated_tokens += num_tokens
+
+    def summary(self):
+        handlers = {}
+        for handler in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies.get(handler, [])
+            handlers[handler] = {
+                "count": len(latencies),
+                "errors": len(self.errors.get(handler, [])),
+                "mean_seconds": float(np.mean(latencies)) if latencies else None,
+                "p50_seconds": float(np.percentile(latencies, 50)) if latencies else None,
+                "p99_seconds": float(np.percentile(latencies, 99)) if latencies else None
+                }
+        return handlers
+
+
+def run_user(chatbot, chatbot_args, benchmark_args, user_idx, recorder, limiter):
+    rng = random.Random(benchmark_args.seed + user_idx)
+    request = SimpleNamespace(session_hash=f"benchmark-user-{user_idx}")
+    use_system_prompt = chatbot_args.use_system_prompt
+    sampling = (1.0, benchmark_args.temperature, benchmark_args.top_p)
+
+    history = []
+    for _ in range(benchmark_args.num_turns):
+        message = random_message(rng, benchmark_args.message_words)
+        outputs = recorder.run("chat_respond", lambda: last(chatbot.chat_respond(use_system_prompt, chatbot.default_chat_system_prompt, message, *sampling, history, request=request)), limiter)
+        if outputs is not None:
+            history = outputs[0]
+            recorder.count_tokens([history[-1][1]])
+
+    for _ in range(benchmark_args.num_retries if history else 0):
+        outputs = recorder.run("retry", lambda: last(chatbot.retry(use_system_prompt, chatbot.default_chat_system_prompt, *sampling, history, request=request)), limiter)
+        if outputs is not None:
+            history = outputs[0]
+            recorder.count_tokens([history[-1][1]])
+
+    for _ in range(benchmark_args.num_rag_queries):
+        query = random_message(rng, benchmark_args.message_words)
+        documents = recorder.run("retrieval", lambda: chatbot.retrieval(query, request=request))
+        if documents is None:
+            continue
+        outputs = recorder.run("rag_inference", lambda: last(chatbot.rag_inference(use_system_prompt, chatbot.default_rag_system_prompt, query, *sampling, "Document 1", *documents)), limiter)
+        if outputs is not None:
+            recorder.count_tokens(outputs)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    benchmark_args, remaining_args = benchmark_parse_args()
+    os.makedirs(benchmark_args.output_dir, exist_ok=True)
+
+    # 검색 지연시간이 입력 debounce 대기 시간이 아닌 실제 검색 시간을 재도록 debounce 를 끔
+    injected_args = [
+        "--telemetry_log_path", os.path.join(benchmark_args.output_dir, "telemetry.jsonl"),
+        "--rag_query_debounce_ms", "0"
+        ]
+    if benchmark_args.use_synthetic_models is True:
+        synthetic_dir = benchmark_args.synthetic_dir if benchmark_args.synthetic_dir is not None else tempfile.mkdtemp(prefix="chatbot-benchmark-")
+        model_path, embedder_path, corpus_path = build_synthetic_assets(synthetic_dir, benchmark_args.synthetic_documents, benchmark_args.seed)
+        injected_args += [
+            "--chatbot_model_name_or_path", model_path,
+            "--rag_embedder_name_or_path", embedder_path,
+            "--rag_collector_name_or_path", corpus_path,
+            "--rag_store_dir", os.path.join(synthetic_dir, "rag_store")
+            ]
+    # 직접 넘긴 인자가 뒤에 오도록 해서 기본값보다 우선하게 함
+    # 생성 길이는 프롬프트 토큰 예산을 계산하기 전에 정해져야 하므로 chatbot 인자로 넘기고, 벤치마크 값이 항상 우선하게 함
+    chatbot_args = parse_args(injected_args + remaining_args + ["--chatbot_max_new_tokens", str(benchmark_args.max_new_tokens)])[0]
+
+    torch.manual_seed(benchmark_args.seed)
+    chatbot = ChatbotFunctions(chatbot_args)
+    chatbot.chat_ready.result()
+    chatbot.rag_ready.result()
+
+    concurrency = benchmark_args.generation_concurrency
+    if concurrency is None:
+        concurrency = chatbot_args.scheduler_max_batch_size if chatbot.scheduler is not None else 1
+    limiter = Semaphore(concurrency)
+
+    for _ in range(benchmark_args.warmup_requests):
+        last(chatbot.chat_respond(chatbot_args.use_system_prompt, chatbot.default_chat_system_prompt, "warmup", 1.0, benchmark_args.temperature, benchmark_args.top_p, []))
+
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+    recorder = BenchmarkRecorder(chatbot.tokenizer)
+    threads = [
+        Thread(target=run_user, args=(chatbot, chatbot_args, benchmark_args, user_idx, recorder, limiter), daemon=True)
+        for user_idx in range(benchmark_args.num_users)
+        ]
+
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - start_time
+
+    handlers = recorder.summary()
+    num_requests = sum(handler["count"] for handler in handlers.values())
+    report = {
+        "config": {"benchmark": asdict(benchmark_args), "chatbot": asdict(chatbot_args), "generation_concurrency": concurrency},
+        "environment": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "device": str(chatbot.model.device)
+            },
+        "wall_seconds": wall_seconds,
+        "throughput": {
+            "requests_per_second": num_requests / wall_seconds,
+            "generated_tokens_per_second": recorder.generated_tokens / wall_seconds,
+            "generated_tokens": recorder.generated_tokens
+            },
+        "handlers": handlers,
+        "memory": {
+            # Linux 의 ru_maxrss 단위는 KB
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "peak_cuda_allocated_mb": torch.cuda.max_memory_allocated() / 2**20 if torch.cuda.is_available() else None
+            },
+        "telemetry": chatbot.telemetry.snapshot(),
+        "errors": recorder.errors
+        }
+
+    report_path = os.path.join(benchmark_args.output_dir, "report.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    return report, report_path
+
+
+if __name__ == "__main__":
+    report, report_path = main()
+
+    table = Table(title=f"Chatbot benchmark ({report['wall_seconds']:.1f}s)")
+    for column in ["Handler", "Count", "Errors", "p50 (s)", "p99 (s)"]:
+        table.add_column(column)
+    for handler, summary in report["handlers"].items():
+        table.add_row(
+            handler,
+            str(summary["count"]),
+            str(summary["errors"]),
+            f"{summary['p50_seconds']:.3f}" if summary["p50_seconds"] is not None else "-",
+            f"{summary['p99_seconds']:.3f}" if summary["p99_seconds"] is not None else "-"
+            )
+
+    console = Console()
+    console.print("\n", table)
+    console.print(f"requests/sec: {report['throughput']['requests_per_second']:.2f} · generated tokens/sec: {report['throughput']['generated_tokens_per_second']:.1f} · peak RSS: {report['memory']['peak_rss_mb']:.0f} MB")
+    console.print(f"Report saved to {report_path}\n")
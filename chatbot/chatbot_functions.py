@@ -1,133 +1,572 @@
-import numpy as np
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
+from threading import Event, Lock, Thread
 
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from sentence_transformers import SentenceTransformer, util
+import torch
+
+from transformers import AutoModelForCausalLM, AutoTokenizer, TextIteratorStreamer, DynamicCache
+from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+from sentence_transformers import SentenceTransformer
 from datasets import load_dataset
 
 import gradio as gr
 
+from kv_cache import SessionKVCache, common_prefix_length
+from scheduler import BatchScheduler
+from embedding_store import load_or_build_store
+from rag_corpus import build_corpus
+from query_cache import LRUCache
+from prompt_builder import ChatPromptBuilder
+from speculative import SpeculativeStats
+from telemetry import Telemetry, timed_streamer
+
 class ChatbotFunctions:
-    def __init__(self, chatbot_model_name_or_path, rag_embedder_name_or_path, rag_collector_name_or_path, default_chat_system_prompt, default_rag_system_prompt):
-        self.default_chat_system_prompt = default_chat_system_prompt
-        self.default_rag_system_prompt = default_rag_system_prompt
+    def __init__(self, chatbot_args, use_rag=True):
+        self.default_chat_system_prompt = chatbot_args.default_chat_system_prompt
+        self.default_rag_system_prompt = chatbot_args.default_rag_system_prompt
 
         self.rag_template = """\n\n아래 문서를 참고해서 대답하세요.\n{document}"""
 
-        self.model = AutoModelForCausalLM.from_pretrained(chatbot_model_name_or_path, torch_dtype='auto', device_map='auto')
-        self.tokenizer = AutoTokenizer.from_pretrained(chatbot_model_name_or_path)
-        self.embedder = SentenceTransformer(rag_embedder_name_or_path)
-        self.collector = load_dataset(rag_collector_name_or_path)
-        self.corpus_embeddings = self.embedder.encode(self.collector['train']['output'], convert_to_tensor=True)
-
-        self.max_new_tokens = 512
-    
-    def chat_respond(self, use_system_prompt, applied_system_prompt, message, repetition_penalty, temperature, top_p, history):
-        conversation = [{"role": "system", "content": applied_system_prompt}] if use_system_prompt is True else []
-        conversation_len = len(history[-5:])
-
-        for idx in range(conversation_len):
-            conversation_idx = conversation_len - idx
-            conversation.append({"role": "user", "content": history[-conversation_idx][0]})
-            conversation.append({"role": "assistant", "content": history[-conversation_idx][1]})
-        conversation.append({"role": "user", "content": message})
-
-        input_ids = self.tokenizer.apply_chat_template(
-            conversation,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_tensors="pt"
-            ).to(self.model.device)
-
-        outputs = self.model.generate(
-            input_ids,
+        self.max_new_tokens = chatbot_args.chatbot_max_new_tokens
+        self.use_streaming = chatbot_args.use_streaming
+        self.kv_cache = None
+        self.scheduler = None
+        self.draft_model = None
+
+        self.telemetry = Telemetry(chatbot_args.telemetry_window_size, chatbot_args.telemetry_log_path)
+        self.log_conversations = chatbot_args.telemetry_log_conversations
+
+        self.query_debounce_seconds = chatbot_args.rag_query_debounce_ms / 1000
+        self.query_embedding_cache = LRUCache(chatbot_args.rag_query_cache_size)
+        self.search_result_cache = LRUCache(chatbot_args.rag_query_cache_size)
+        self.retrieval_tickets = {}
+        self.retrieval_lock = Lock()
+
+        # 무거운 구성요소를 동시에 로드하고, 각 탭은 필요한 구성요소가 준비되는 대로 사용
+        self.executor = ThreadPoolExecutor(max_workers=6, thread_name_prefix="chatbot-loader")
+        model_future = self.executor.submit(load_causal_lm, chatbot_args.chatbot_model_name_or_path)
+        tokenizer_future = self.executor.submit(AutoTokenizer.from_pretrained, chatbot_args.chatbot_model_name_or_path)
+
+        draft_model_future = None
+        if chatbot_args.chatbot_draft_model_name_or_path is not None:
+            draft_model_future = self.executor.submit(load_causal_lm, chatbot_args.chatbot_draft_model_name_or_path)
+
+        self.chat_ready = self.executor.submit(self.setup_chat, chatbot_args, model_future, tokenizer_future, draft_model_future)
+
+        if use_rag is True:
+            embedder_future = self.executor.submit(SentenceTransformer, chatbot_args.rag_embedder_name_or_path)
+            collector_future = self.executor.submit(load_dataset, chatbot_args.rag_collector_name_or_path)
+            self.rag_ready = self.executor.submit(self.setup_rag, chatbot_args, embedder_future, collector_future)
+        else:
+            # 검색을 쓰지 않는 실행에서는 임베딩 모델, 코퍼스, corpus watcher 를 띄우지 않음
+            self.rag_ready = Future()
+            self.rag_ready.set_exception(RuntimeError("RAG is disabled for this ChatbotFunctions."))
+
+    def setup_chat(self, chatbot_args, model_future, tokenizer_future, draft_model_future=None):
+        self.model = model_future.result()
+        self.draft_model = draft_model_future.result() if draft_model_future is not None else None
+        self.speculative_stats = SpeculativeStats(self.model, self.draft_model, self.telemetry) if self.draft_model is not None else None
+        self.tokenizer = tokenizer_future.result()
+        self.pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+
+        context_tokens = chatbot_args.chat_context_tokens
+        if context_tokens is None:
+            context_tokens = getattr(self.model.config, "max_position_embeddings", 8192)
+        self.prompt_builder = ChatPromptBuilder(self.tokenizer, context_tokens - self.max_new_tokens)
+
+        # Cache 클래스를 지원하지 않는 모델은 매 턴 전체 대화를 다시 prefill
+        use_kv_cache = chatbot_args.kv_cache_max_memory_mb > 0 and getattr(self.model, "_supports_cache_class", False)
+        self.kv_cache = SessionKVCache(chatbot_args.kv_cache_max_memory_mb) if use_kv_cache else None
+
+        use_scheduler = chatbot_args.use_batch_scheduler is True and self.draft_model is None
+        self.scheduler = BatchScheduler(self.model, chatbot_args.scheduler_max_batch_size) if use_scheduler else None
+
+    def setup_rag(self, chatbot_args, embedder_future, collector_future):
+        self.embedder = embedder_future.result()
+        self.collector = collector_future.result()
+
+        embedding_store = load_or_build_store(
+            self.embedder,
+            chatbot_args.rag_embedder_name_or_path,
+            self.collector['train'],
+            'output',
+            chatbot_args.rag_store_dir,
+            dtype=chatbot_args.rag_embedding_dtype,
+            normalize_embeddings=chatbot_args.rag_normalize_embeddings
+            )
+        self.corpus = build_corpus(embedding_store, chatbot_args, self.embedder.device, self.collector['train'].data.column('output'))
+
+        if chatbot_args.rag_reload_interval_seconds > 0:
+            Thread(target=self.watch_corpus, args=(chatbot_args,), daemon=True, name="chatbot-corpus-watcher").start()
+
+    def watch_corpus(self, chatbot_args):
+        while True:
+            time.sleep(chatbot_args.rag_reload_interval_seconds)
+            try:
+                self.reload_corpus(chatbot_args)
+            except Exception as error:
+                self.telemetry.record("corpus_reload_error", error=repr(error))
+
+    def reload_corpus(self, chatbot_args):
+        corpus = self.corpus
+        embedding_store = corpus.embedding_store.reload()
+        if embedding_store.version == corpus.version:
+            return False
+
+        # 새 버전의 인덱스를 다 만든 다음 참조만 바꿔서, 진행 중인 검색은 이전 버전을 끝까지 사용
+        start_time = time.perf_counter()
+        self.corpus = build_corpus(embedding_store, chatbot_args, self.embedder.device, self.collector['train'].data.column('output'))
+        self.search_result_cache.clear()
+        self.telemetry.record(
+            "corpus_reload",
+            version=embedding_store.version,
+            num_documents=embedding_store.count,
+            reload_seconds=time.perf_counter() - start_time
+            )
+        return True
+
+    def readiness(self):
+        chat_ok = self.chat_ready.done() and self.chat_ready.exception() is None
+        rag_ok = self.rag_ready.done() and self.rag_ready.exception() is None
+
+        status = "**Status :** Multiturn Chatbot {} · RAG {}".format(
+            readiness_label(self.chat_ready),
+            readiness_label(self.rag_ready)
+            )
+        loading = not (self.chat_ready.done() and self.rag_ready.done())
+
+        return (
+            gr.update(value=status),
+            gr.update(interactive=chat_ok),
+            gr.update(interactive=chat_ok),
+            gr.update(interactive=chat_ok),
+            gr.update(interactive=rag_ok),
+            gr.update(interactive=chat_ok),
+            gr.Timer(active=loading)
+            )
+
+    def generate(self, input_ids, repetition_penalty, temperature, top_p, session_id=None, metrics=None):
+        generate_kwargs = dict(
             max_new_tokens=self.max_new_tokens,
             eos_token_id=self.tokenizer.eos_token_id,
             repetition_penalty=float(repetition_penalty),
-            do_sample=True,
             temperature=float(temperature),
             top_p=top_p
             )
 
-        response = outputs[0][input_ids.shape[-1]:]
-        response = self.tokenizer.decode(response, skip_special_tokens=True)
-        history.append((message, response))
-    
-        for item in conversation:
-            print(item)
-        print("")
-        print("--------------------------")
-        print("")
+        use_kv_cache = session_id is not None and self.kv_cache is not None
+        if use_kv_cache:
+            generate_kwargs.update(past_key_values=self.kv_cache.pop(session_id, input_ids[0]))
 
-        return history, gr.update(value="")
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True) if self.use_streaming else None
+        stop_event = Event()
+        results = []
+        errors = []
+
+        def run_generate():
+            try:
+                if self.scheduler is not None:
+                    results.append(self.scheduler.generate(input_ids[0], streamer=streamer, stop_event=stop_event, metrics=metrics, **generate_kwargs))
+                else:
+                    if metrics is not None:
+                        metrics.mark_started()
+                    if use_kv_cache:
+                        # gemma-2 의 hybrid cache 대신 세션에서 가져온 DynamicCache 를 사용
+                        generate_kwargs.update(cache_implementation=None)
+                    results.append(self.model_generate(
+                        input_ids,
+                        do_sample=True,
+                        streamer=timed_streamer(streamer, metrics),
+                        stopping_criteria=StoppingCriteriaList([StopOnEvent(stop_event)]),
+                        return_dict_in_generate=True,
+                        **generate_kwargs
+                        ))
+            except Exception as error:
+                errors.append(error)
+                if streamer is not None:
+                    streamer.end()
+
+        thread = Thread(target=run_generate, daemon=True)
+        thread.start()
+
+        try:
+            if streamer is None:
+                thread.join()
+            else:
+                response = ""
+                for new_text in streamer:
+                    response += new_text
+                    yield response
+        finally:
+            # 사용자가 요청을 취소하면 백그라운드 생성도 함께 중단
+            stop_event.set()
+            thread.join()
+            self.save_kv_cache(session_id, results)
+
+        if errors:
+            raise errors[0]
+
+        if streamer is None:
+            yield self.tokenizer.decode(results[0].sequences[0][input_ids.shape[-1]:], skip_special_tokens=True)
+
+    def generate_batch(self, input_ids_list, repetition_penalty, temperature, top_p, metrics=None):
+        generate_kwargs = dict(
+            max_new_tokens=self.max_new_tokens,
+            eos_token_id=self.tokenizer.eos_token_id,
+            repetition_penalty=float(repetition_penalty),
+            temperature=float(temperature),
+            top_p=top_p
+            )
+
+        batch_size = len(input_ids_list)
+        streamer = BatchTextIteratorStreamer(self.tokenizer, batch_size, self.tokenizer.eos_token_id) if self.use_streaming else None
+        stop_event = Event()
+        results = [None] * batch_size
+        errors = []
+
+        def run_scheduler(idx):
+            try:
+                outputs = self.scheduler.generate(
+                    input_ids_list[idx],
+                    streamer=streamer.row(idx) if streamer is not None else None,
+                    stop_event=stop_event,
+                    metrics=metrics,
+                    **generate_kwargs
+                    )
+                results[idx] = outputs.sequences[0][input_ids_list[idx].shape[-1]:]
+            except Exception as error:
+                # 스케줄러가 요청을 끝내면서 해당 행의 streamer 도 닫음
+                errors.append(error)
+
+        def run_generate():
+            try:
+                if metrics is not None:
+                    metrics.mark_started()
+                input_ids, attention_mask, past_key_values = self.prefill_shared_prefix(input_ids_list)
+                outputs = self.model.generate(
+                    input_ids,
+                    attention_mask=attention_mask,
+                    past_key_values=past_key_values,
+                    cache_implementation=None,
+                    pad_token_id=self.pad_token_id,
+                    do_sample=True,
+                    streamer=timed_streamer(streamer, metrics, self.tokenizer.eos_token_id),
+                    stopping_criteria=StoppingCriteriaList([StopOnEvent(stop_event)]),
+                    **generate_kwargs
+                    )
+                for idx in range(batch_size):
+                    results[idx] = outputs[idx][input_ids.shape[-1]:]
+            except Exception as error:
+                errors.append(error)
+                if streamer is not None:
+                    streamer.end()
+
+        def run_assisted():
+            # assisted decoding 은 batch 1 만 지원하므로 행마다 차례로 생성
+            try:
+                if metrics is not None:
+                    metrics.mark_started()
+                for idx, input_ids in enumerate(input_ids_list):
+                    if stop_event.is_set():
+                        break
+                    outputs = self.model_generate(
+                        input_ids.unsqueeze(0),
+                        do_sample=True,
+                        streamer=timed_streamer(streamer.row(idx) if streamer is not None else None, metrics),
+                        stopping_criteria=StoppingCriteriaList([StopOnEvent(stop_event)]),
+                        return_dict_in_generate=True,
+                        **generate_kwargs
+                        )
+                    results[idx] = outputs.sequences[0][input_ids.shape[-1]:]
+            except Exception as error:
+                errors.append(error)
+                if streamer is not None:
+                    streamer.end()
+
+        if self.scheduler is not None:
+            threads = [Thread(target=run_scheduler, args=(idx,), daemon=True) for idx in range(batch_size)]
+        elif self.draft_model is not None:
+            threads = [Thread(target=run_assisted, daemon=True)]
+        else:
+            threads = [Thread(target=run_generate, daemon=True)]
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            if streamer is None:
+                for thread in threads:
+                    thread.join()
+            else:
+                for responses in streamer:
+                    yield responses
+        finally:
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+        if streamer is None:
+            yield [self.tokenizer.decode(result, skip_special_tokens=True) for result in results]
+
+    def generate_texts(self, input_ids_list, repetition_penalty=1.0, temperature=1.0, top_p=1.0, max_new_tokens=None, do_sample=True, metrics=None):
+        self.chat_ready.result()
+        if self.scheduler is not None:
+            return self.generate_texts_scheduled(input_ids_list, repetition_penalty, temperature, top_p, max_new_tokens, do_sample, metrics)
+
+        if metrics is not None:
+            metrics.mark_started()
+
+        generate_kwargs = dict(
+            max_new_tokens=max_new_tokens if max_new_tokens is not None else self.max_new_tokens,
+            eos_token_id=self.tokenizer.eos_token_id,
+            pad_token_id=self.pad_token_id,
+            repetition_penalty=float(repetition_penalty),
+            do_sample=do_sample
+            )
+        if do_sample:
+            generate_kwargs.update(temperature=float(temperature), top_p=top_p)
+
+        if self.draft_model is not None:
+            outputs = [
+                self.model_generate(
+                    input_ids.unsqueeze(0).to(self.model.device),
+                    streamer=timed_streamer(None, metrics),
+                    return_dict_in_generate=True,
+                    **generate_kwargs
+                    ).sequences[0][input_ids.shape[-1]:]
+                for input_ids in input_ids_list
+                ]
+        else:
+            # 프롬프트 끝이 맞춰지도록 left padding 해서 한 번에 생성
+            max_length = max(input_ids.shape[-1] for input_ids in input_ids_list)
+            batch_input_ids = torch.full((len(input_ids_list), max_length), self.pad_token_id, dtype=torch.long, device=self.model.device)
+            attention_mask = torch.zeros_like(batch_input_ids)
+            for idx, input_ids in enumerate(input_ids_list):
+                batch_input_ids[idx, max_length - input_ids.shape[-1]:] = input_ids
+                attention_mask[idx, max_length - input_ids.shape[-1]:] = 1
+
+            sequences = self.model.generate(
+                batch_input_ids,
+                attention_mask=attention_mask,
+                streamer=timed_streamer(None, metrics, self.tokenizer.eos_token_id),
+                **generate_kwargs
+                )
+            outputs = [sequence[max_length:] for sequence in sequences]
+
+        return [self.tokenizer.decode(output, skip_special_tokens=True) for output in outputs]
+
+    def generate_texts_scheduled(self, input_ids_list, repetition_penalty, temperature, top_p, max_new_tokens, do_sample, metrics):
+        # Gradio 요청과 같은 continuous batching loop 에 넣어서 동시에 들어온 요청끼리 함께 생성 (greedy 는 temperature 0)
+        generate_kwargs = dict(
+            max_new_tokens=max_new_tokens if max_new_tokens is not None else self.max_new_tokens,
+            eos_token_id=self.tokenizer.eos_token_id,
+            repetition_penalty=float(repetition_penalty),
+            temperature=float(temperature) if do_sample else 0.0,
+            top_p=top_p if do_sample else 1.0
+            )
+        outputs = [None] * len(input_ids_list)
+        errors = []
+
+        def run_scheduler(idx):
+            try:
+                outputs[idx] = self.scheduler.generate(input_ids_list[idx], metrics=metrics, **generate_kwargs).sequences[0][input_ids_list[idx].shape[-1]:]
+            except Exception as error:
+                errors.append(error)
+
+        threads = [Thread(target=run_scheduler, args=(idx,), daemon=True) for idx in range(len(input_ids_list))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        return [self.tokenizer.decode(output, skip_special_tokens=True) for output in outputs]
+
+    def model_generate(self, input_ids, **generate_kwargs):
+        if self.draft_model is None:
+            return self.model.generate(input_ids, **generate_kwargs)
+
+        with self.speculative_stats.track() as counters:
+            outputs = self.model.generate(input_ids, assistant_model=self.draft_model, **generate_kwargs)
+            counters["new_tokens"] = outputs.sequences.shape[-1] - input_ids.shape[-1]
+        return outputs
+
+    def prefill_shared_prefix(self, input_ids_list):
+        prefix_len = min(input_ids.shape[-1] for input_ids in input_ids_list) - 1
+        for input_ids in input_ids_list[1:]:
+            prefix_len = min(prefix_len, common_prefix_length(input_ids_list[0], input_ids))
+        suffix_len = max(input_ids.shape[-1] for input_ids in input_ids_list) - prefix_len
+
+        # 공통 prefix 뒤에 padding 을 두고 각자의 suffix 를 오른쪽 정렬
+        # position id 는 attention mask 로 계산되므로 prefix 의 KV cache 를 모든 행이 공유할 수 있음
+        batch_input_ids = torch.full((len(input_ids_list), prefix_len + suffix_len), self.pad_token_id, dtype=torch.long, device=self.model.device)
+        attention_mask = torch.zeros_like(batch_input_ids)
+        for idx, input_ids in enumerate(input_ids_list):
+            row_suffix_len = input_ids.shape[-1] - prefix_len
+            batch_input_ids[idx, :prefix_len] = input_ids[:prefix_len]
+            batch_input_ids[idx, -row_suffix_len:] = input_ids[prefix_len:]
+            attention_mask[idx, :prefix_len] = 1
+            attention_mask[idx, -row_suffix_len:] = 1
+
+        past_key_values = DynamicCache()
+        if prefix_len > 0:
+            with torch.no_grad():
+                past_key_values = self.model(batch_input_ids[:1, :prefix_len], past_key_values=past_key_values, use_cache=True).past_key_values
+            past_key_values.batch_repeat_interleave(len(input_ids_list))
+
+        return batch_input_ids, attention_mask, past_key_values
+
+    def build_input_ids(self, message, use_system_prompt, applied_system_prompt, history=(), document=None):
+        self.chat_ready.result()
+
+        system_prompt = [{"role": "system", "content": applied_system_prompt}] if use_system_prompt is True else []
+        if document is not None:
+            message = message + self.rag_template.format(document=document)
+
+        input_ids, _ = self.prompt_builder.build(system_prompt, [tuple(turn) for turn in history], message)
+        return input_ids[0]
 
-    def retrieval(self, name):
-        queries = [name]
+    def save_kv_cache(self, session_id, results):
+        if session_id is None or self.kv_cache is None or not results:
+            return
+        self.kv_cache.put(session_id, results[0].sequences[0], results[0].past_key_values)
 
+    def chat_respond(self, use_system_prompt, applied_system_prompt, message, repetition_penalty, temperature, top_p, history, request: gr.Request = None):
+        session_id = request.session_hash if request is not None else None
+        with self.telemetry.request("chat", session_id=session_id) as metrics:
+            self.chat_ready.result()
+
+            system_prompt = [{"role": "system", "content": applied_system_prompt}] if use_system_prompt is True else []
+
+            # 컨텍스트 길이에서 생성 길이를 뺀 토큰 예산 안에 들어가는 최근 턴만 사용
+            input_ids, conversation = self.prompt_builder.build(system_prompt, history, message)
+            input_ids = input_ids.to(self.model.device)
+
+            log_fields = {"conversation": conversation} if self.log_conversations is True else {}
+            metrics.update(prompt_tokens=input_ids.shape[-1], history_turns=len(history), **log_fields)
+
+            history.append((message, ""))
+            for response in self.generate(input_ids, repetition_penalty, temperature, top_p, session_id=session_id, metrics=metrics):
+                history[-1] = (message, response)
+                yield history, gr.update(value="")
+
+    def retrieval(self, name, request: gr.Request = None):
         top_k = 3
-        for query in queries:
+        query = name.strip()
+        session_id = request.session_hash if request is not None else None
+        # 입력을 지운 경우에도 진행 중인 이전 검색 결과가 빈 화면을 덮어쓰지 않도록 ticket 을 올림
+        ticket = self.next_retrieval_ticket(session_id)
+        if query == "":
+            return ("",) * top_k
+
+        self.rag_ready.result()
+
+        corpus = self.corpus
+        top_results = self.search_result_cache.get((corpus.version, query, top_k))
+        if top_results is None:
+            # 입력이 계속 바뀌는 동안에는 기다렸다가 마지막 입력만 검색
+            time.sleep(self.query_debounce_seconds)
+            if self.is_stale_retrieval(session_id, ticket):
+                return gr.update(), gr.update(), gr.update()
+
+            start_time = time.perf_counter()
+            query_embedding = self.encode_query(query)
+            if self.is_stale_retrieval(session_id, ticket):
+                return gr.update(), gr.update(), gr.update()
+
+            top_results = [int(idx) for idx in corpus.search(query, query_embedding, top_k)]
+            self.search_result_cache.put((corpus.version, query, top_k), top_results)
+            self.telemetry.record("retrieval", session_id=session_id, num_queries=1, retrieval_seconds=time.perf_counter() - start_time)
+
+        if self.is_stale_retrieval(session_id, ticket):
+            return gr.update(), gr.update(), gr.update()
+
+        # IVF 후보가 적거나 삭제 후 남은 문서가 적어도 Gradio 출력 개수는 항상 top_k 개
+        documents = [corpus.document(idx) for idx in top_results]
+        return tuple(documents + [""] * (top_k - len(documents)))
+
+    def retrieve_documents(self, queries, top_k=3):
+        self.rag_ready.result()
+
+        corpus = self.corpus
+        top_results = [self.search_result_cache.get((corpus.version, query, top_k)) for query in queries]
+        missing = [idx for idx, result in enumerate(top_results) if result is None]
+        if missing:
+            # 캐시에 없는 쿼리만 모아서 한 번에 인코딩
+            start_time = time.perf_counter()
+            query_embeddings = self.embedder.encode([queries[idx] for idx in missing], convert_to_tensor=True)
+            for idx, query_embedding in zip(missing, query_embeddings):
+                top_results[idx] = [int(doc_idx) for doc_idx in corpus.search(queries[idx], query_embedding, top_k)]
+                self.search_result_cache.put((corpus.version, queries[idx], top_k), top_results[idx])
+            self.telemetry.record("retrieval", num_queries=len(missing), retrieval_seconds=time.perf_counter() - start_time)
+
+        return [[corpus.document(doc_idx) for doc_idx in result] for result in top_results]
+
+    def encode_query(self, query):
+        query_embedding = self.query_embedding_cache.get(query)
+        if query_embedding is None:
             query_embedding = self.embedder.encode(query, convert_to_tensor=True)
-            cos_scores = util.pytorch_cos_sim(query_embedding, self.corpus_embeddings)[0]
-            cos_scores = cos_scores.cpu()
-            top_results = np.argpartition(-cos_scores, range(top_k))[0:top_k]
+            self.query_embedding_cache.put(query, query_embedding)
+        return query_embedding
 
-        result_1 = self.collector['train']['output'][top_results[0]].strip()
-        result_2 = self.collector['train']['output'][top_results[1]].strip()
-        result_3 = self.collector['train']['output'][top_results[2]].strip()
+    def next_retrieval_ticket(self, session_id):
+        with self.retrieval_lock:
+            ticket = self.retrieval_tickets.get(session_id, 0) + 1
+            self.retrieval_tickets[session_id] = ticket
+        return ticket
 
-        return result_1, result_2, result_3
+    def is_stale_retrieval(self, session_id, ticket):
+        # 같은 세션에서 더 새로운 검색 요청이 들어왔으면 지금 결과는 버림
+        return session_id is not None and self.retrieval_tickets.get(session_id) != ticket
 
     def rag_inference(self, use_system_prompt, applied_system_prompt, rag_input, repetition_penalty, temperature, top_p, rag_selected_doc, rag_doc_1, rag_doc_2, rag_doc_3):
-        system_prompt = [{"role": "system", "content": applied_system_prompt}] if use_system_prompt is True else []
+        with self.telemetry.request("rag") as metrics:
+            self.chat_ready.result()
 
-        documents = {
-            "Document 1": rag_doc_1,
-            "Document 2": rag_doc_2,
-            "Document 3": rag_doc_3
-        }
+            system_prompt = [{"role": "system", "content": applied_system_prompt}] if use_system_prompt is True else []
+
+            documents = {
+                "Document 1": rag_doc_1,
+                "Document 2": rag_doc_2,
+                "Document 3": rag_doc_3
+            }
         
-        rag_conversation = [
-            system_prompt + [
-                {"role": "user", "content": rag_input+self.rag_template.format(document=documents[rag_selected_doc])}
-                ],
-             system_prompt + [
-                {"role": "user", "content": rag_input}
+            rag_conversation = [
+                system_prompt + [
+                    {"role": "user", "content": rag_input+self.rag_template.format(document=documents[rag_selected_doc])}
+                    ],
+                 system_prompt + [
+                    {"role": "user", "content": rag_input}
+                    ]
                 ]
-            ]
-
-        result = []
-
-        for conversation in rag_conversation:
-            input_ids = self.tokenizer.apply_chat_template(
-                conversation,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_tensors="pt"
-                ).to(self.model.device)
-            
-            outputs = self.model.generate(
-                input_ids,
-                max_new_tokens=self.max_new_tokens,
-                eos_token_id=self.tokenizer.eos_token_id,
-                repetition_penalty=float(repetition_penalty),
-                do_sample=True,
-                temperature=float(temperature),
-                top_p=top_p
-                )
 
-            response = outputs[0][input_ids.shape[-1]:]
-            response = self.tokenizer.decode(response, skip_special_tokens=True)
-            result.append(response)
+            input_ids_list = [
+                self.tokenizer.apply_chat_template(
+                    conversation,
+                    add_generation_prompt=True,
+                    tokenize=True,
+                    return_tensors="pt"
+                    )[0].to(self.model.device)
+                for conversation in rag_conversation
+                ]
 
-        for item in rag_conversation[0]:
-            print(item)
-        print("")
-        print("--------------------------")
-        print("")
-        
-        return result[0], result[1]
+            log_fields = {"conversation": rag_conversation[0]} if self.log_conversations is True else {}
+            metrics.update(prompt_tokens=sum(input_ids.shape[-1] for input_ids in input_ids_list), **log_fields)
 
-    def chat_reset(self, system_prompt):
+            for result in self.generate_batch(input_ids_list, repetition_penalty, temperature, top_p, metrics=metrics):
+                yield result[0], result[1]
+
+    def chat_reset(self, system_prompt, request: gr.Request = None):
         history = []
+        if self.kv_cache is not None and request is not None:
+            self.kv_cache.discard(request.session_hash)
+
         if system_prompt == "":
             return history, gr.update(value=self.default_chat_system_prompt), gr.update(value=self.default_chat_system_prompt), gr.update(value="")
         
@@ -141,15 +580,109 @@ class ChatbotFunctions:
         else:
             return gr.update(value=system_prompt), gr.update(value=system_prompt), gr.update(value=""), gr.update(value="")
         
-    def retry(self, system_prompt, repetition_penalty, temperature, top_p, history):
+    def retry(self, use_system_prompt, applied_system_prompt, repetition_penalty, temperature, top_p, history, request: gr.Request = None):
         if not history:
-            return history, gr.update(value="")
+            yield history, gr.update(value="")
+            return
         last_message = history[-1][0]
         history.pop()
-        return self.chat_respond(system_prompt, last_message, repetition_penalty, temperature, top_p, history)
+        yield from self.chat_respond(use_system_prompt, applied_system_prompt, last_message, repetition_penalty, temperature, top_p, history, request)
 
     def undo(self, history):
         if not history:
             return history, gr.update(value="")
         history.pop()
-        return history, gr.update(value="")
\ No newline at end of file
+        return history, gr.update(value="")
+
+
+MODEL_LOAD_LOCK = Lock()
+
+
+def load_causal_lm(model_name_or_path):
+    # device_map 로딩은 nn.Module 을 전역으로 패치 (init_empty_weights) 하므로 본 모델과 draft 모델은 한 번에 하나씩 로드
+    with MODEL_LOAD_LOCK:
+        return AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype='auto', device_map='auto')
+
+
+def readiness_label(future):
+    if not future.done():
+        return "⏳ loading"
+    if future.exception() is not None:
+        return f"❌ failed ({future.exception()})"
+    return "✅ ready"
+
+
+class StopOnEvent(StoppingCriteria):
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+class BatchTextIteratorStreamer(BaseStreamer):
+    def __init__(self, tokenizer, batch_size, eos_token_id):
+        self.tokenizer = tokenizer
+        self.eos_token_id = eos_token_id
+        self.token_ids = [[] for _ in range(batch_size)]
+        self.finished = [False] * batch_size
+        self.next_tokens_are_prompt = True
+        self.open_rows = batch_size
+        self.lock = Lock()
+        self.queue = Queue()
+
+    def put(self, value):
+        # model.generate 는 첫 호출에 프롬프트 전체를, 이후에는 행마다 토큰 하나씩 전달
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+
+        with self.lock:
+            for idx, token in enumerate(value.reshape(-1).tolist()):
+                self.append(idx, token)
+            self.queue.put(self.texts())
+
+    def end(self):
+        self.queue.put(None)
+
+    def row(self, idx):
+        return RowStreamer(self, idx)
+
+    def append(self, idx, token):
+        if self.finished[idx]:
+            return
+        self.token_ids[idx].append(token)
+        self.finished[idx] = token == self.eos_token_id
+
+    def texts(self):
+        return [self.tokenizer.decode(token_ids, skip_special_tokens=True) for token_ids in self.token_ids]
+
+    def __iter__(self):
+        while True:
+            texts = self.queue.get()
+            if texts is None:
+                return
+            yield texts
+
+
+class RowStreamer(BaseStreamer):
+    def __init__(self, batch_streamer, idx):
+        self.batch_streamer = batch_streamer
+        self.idx = idx
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+
+        with self.batch_streamer.lock:
+            for token in value.reshape(-1).tolist():
+                self.batch_streamer.append(self.idx, token)
+            self.batch_streamer.queue.put(self.batch_streamer.texts())
+
+    def end(self):
+        with self.batch_streamer.lock:
+            self.batch_streamer.open_rows -= 1
+            if self.batch_streamer.open_rows == 0:
+                self.batch_streamer.end()
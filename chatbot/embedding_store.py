@@ -0,0 +1,232 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pyarrow as pa
+
+
+# segment 의 문서 id 는 ingest 때 쓴 id_field 와 상관없이 항상 이 이름으로 저장
+SEGMENT_ID_COLUMN = "doc_id"
+
+
+class EmbeddingStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json"), "r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+
+    @property
+    def count(self):
+        return self.manifest["count"]
+
+    @property
+    def dim(self):
+        return self.manifest["dim"]
+
+    @property
+    def dtype(self):
+        return np.dtype(self.manifest["dtype"])
+
+    @property
+    def version(self):
+        return self.manifest.get("version", 0)
+
+    @property
+    def base_count(self):
+        return self.manifest.get("base_count", self.count)
+
+    def embeddings(self):
+        # copy-on-write 로 매핑해서 torch.from_numpy 가 복사 없이 그대로 사용할 수 있게 함
+        return np.memmap(os.path.join(self.path, "embeddings.bin"), dtype=self.dtype, mode="c", shape=(self.count, self.dim))
+
+    def deleted(self):
+        if self.manifest.get("tombstones") is None:
+            return None
+        mask = np.zeros(self.count, dtype=bool)
+        mask[np.load(os.path.join(self.path, self.manifest["tombstones"]))] = True
+        return mask
+
+    def documents(self, base_column):
+        # 추가된 문서는 segment 파일을 memory map 으로 열어서 원본 컬럼 뒤에 복사 없이 이어 붙임
+        chunks = list(base_column.chunks)
+        for segment in self.manifest.get("segments", []):
+            chunks.extend(self.read_segment(segment).column(self.manifest["column"]).chunks)
+        return pa.chunked_array(chunks, type=base_column.type)
+
+    def read_segment(self, segment):
+        with pa.memory_map(os.path.join(self.path, segment["file"]), "r") as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def reload(self):
+        return type(self)(self.path)
+
+    @classmethod
+    def create(cls, path, embeddings, manifest):
+        return cls.create_from_parts(path, [(slice(None), embeddings)], embeddings.shape, embeddings.dtype, manifest)
+
+    @classmethod
+    def create_from_parts(cls, path, parts, shape, dtype, manifest):
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        # parts 는 (행 번호, 임베딩) 을 하나씩 만들어서 전체 임베딩을 메모리에 올리지 않고 파일에 바로 씀
+        dtype = np.dtype(dtype)
+        output = np.memmap(os.path.join(tmp_path, "embeddings.bin"), dtype=dtype, mode="w+", shape=shape)
+        for rows, part in parts:
+            output[rows] = part
+        output.flush()
+        del output
+
+        manifest = dict(
+            manifest,
+            count=shape[0],
+            dim=shape[1],
+            dtype=dtype.name,
+            version=0,
+            base_count=shape[0],
+            segments=[],
+            tombstones=None
+            )
+        with open(os.path.join(tmp_path, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+        # 완성된 디렉토리만 최종 경로로 옮겨서 중단된 빌드가 캐시로 읽히지 않도록 함
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    def ingest(self, embedder, upserts, deletions, base_column, base_ids=None):
+        with open(os.path.join(self.path, "ingest.lock"), "w") as lock:
+            # 동시에 여러 ingestion 이 같은 store 에 쓰지 않도록 잠금
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            store = self.reload()
+            return store.append(embedder, upserts, deletions, base_column, base_ids)
+
+    def append(self, embedder, upserts, deletions, base_column, base_ids):
+        column = self.manifest["column"]
+        documents = self.documents(base_column)
+        deleted = self.deleted()
+        live_rows = self.live_rows(base_ids, deleted)
+
+        tombstones = set()
+        new_ids = []
+        new_texts = []
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+
+        for doc_id in deletions:
+            if doc_id in live_rows:
+                tombstones.add(live_rows.pop(doc_id))
+                stats["deleted"] += 1
+
+        # 같은 id 가 여러 번 들어오면 마지막 내용만 반영
+        for doc_id, text in dict(upserts).items():
+            row = live_rows.get(doc_id)
+            if row is not None and documents[row].as_py() == text:
+                stats["unchanged"] += 1
+                continue
+            if row is not None:
+                tombstones.add(row)
+                stats["updated"] += 1
+            else:
+                stats["added"] += 1
+            new_ids.append(doc_id)
+            new_texts.append(text)
+
+        if not new_ids and not tombstones:
+            return self, stats
+
+        version = self.version + 1
+        manifest = dict(self.manifest, version=version)
+
+        if new_ids:
+            embeddings = embedder.encode(
+                new_texts,
+                normalize_embeddings=self.manifest["normalize_embeddings"],
+                convert_to_numpy=True,
+                show_progress_bar=True
+                ).astype(self.dtype)
+
+            # 이전 manifest 의 count 뒤에 남은 중단된 쓰기를 잘라낸 다음 새 행만 덧붙임
+            row_bytes = self.dim * self.dtype.itemsize
+            with open(os.path.join(self.path, "embeddings.bin"), "r+b") as f:
+                f.truncate(self.count * row_bytes)
+                f.seek(0, os.SEEK_END)
+                f.write(np.ascontiguousarray(embeddings).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            segment = {"file": f"segment-{version:06d}.arrow", "start": self.count, "count": len(new_ids)}
+            table = pa.table({SEGMENT_ID_COLUMN: pa.array(new_ids, pa.string()), column: pa.array(new_texts, base_column.type)})
+            tmp_file = os.path.join(self.path, f"{segment['file']}.tmp-{os.getpid()}")
+            with pa.OSFile(tmp_file, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(tmp_file, os.path.join(self.path, segment["file"]))
+
+            manifest["count"] = self.count + len(new_ids)
+            manifest["segments"] = self.manifest.get("segments", []) + [segment]
+
+        if tombstones:
+            rows = np.flatnonzero(deleted) if deleted is not None else np.zeros(0, dtype=np.int64)
+            rows = np.union1d(rows, np.fromiter(tombstones, dtype=np.int64))
+            manifest["tombstones"] = f"tombstones-{version:06d}.npy"
+            with open(os.path.join(self.path, manifest["tombstones"]), "wb") as f:
+                np.save(f, rows)
+
+        # 새 manifest 가 원자적으로 교체되기 전까지 읽는 쪽은 이전 버전을 그대로 사용
+        tmp_manifest = os.path.join(self.path, f"manifest.json.tmp-{os.getpid()}")
+        with open(tmp_manifest, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_manifest, os.path.join(self.path, "manifest.json"))
+
+        return self.reload(), stats
+
+    def live_rows(self, base_ids, deleted):
+        if base_ids is None:
+            base_ids = (str(row) for row in range(self.base_count))
+
+        rows = {}
+        for row, doc_id in enumerate(base_ids):
+            rows[doc_id] = row
+        for segment in self.manifest.get("segments", []):
+            for offset, doc_id in enumerate(self.read_segment(segment).column(SEGMENT_ID_COLUMN).to_pylist()):
+                rows[doc_id] = segment["start"] + offset
+
+        if deleted is not None:
+            rows = {doc_id: row for doc_id, row in rows.items() if not deleted[row]}
+        return rows
+
+
+def store_key(embedder_name_or_path, dataset_fingerprint, normalize_embeddings, dtype):
+    key = json.dumps([embedder_name_or_path, dataset_fingerprint, normalize_embeddings, np.dtype(dtype).name])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def store_location(embedder_name_or_path, dataset, column, store_dir, dtype="float32", normalize_embeddings=True):
+    manifest = {
+        "embedder": embedder_name_or_path,
+        "fingerprint": dataset._fingerprint,
+        "column": column,
+        "normalize_embeddings": normalize_embeddings
+        }
+    path = os.path.join(store_dir, store_key(embedder_name_or_path, dataset._fingerprint, normalize_embeddings, dtype))
+    return path, manifest
+
+
+def load_or_build_store(embedder, embedder_name_or_path, dataset, column, store_dir, dtype="float32", normalize_embeddings=True):
+    path, manifest = store_location(embedder_name_or_path, dataset, column, store_dir, dtype, normalize_embeddings)
+
+    if os.path.exists(os.path.join(path, "manifest.json")):
+        return EmbeddingStore(path)
+
+    os.makedirs(store_dir, exist_ok=True)
+    embeddings = embedder.encode(
+        dataset[column],
+        normalize_embeddings=normalize_embeddings,
+        convert_to_numpy=True,
+        show_progress_bar=True
+        )
+
+    return EmbeddingStore.create(path, embeddings.astype(dtype), manifest)
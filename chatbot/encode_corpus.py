@@ -0,0 +1,153 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pyarrow as pa
+import torch
+
+from rich.console import Console
+from rich.panel import Panel
+from rich.align import Align
+from rich.progress import track
+
+from sentence_transformers import SentenceTransformer
+from datasets import load_dataset
+
+from arguments import encode_corpus_parse_args
+from embedding_store import EmbeddingStore, store_location
+
+
+def token_lengths(tokenizer, documents, max_length, batch_size=1000):
+    # Arrow chunk 단위로 조금씩 읽어서 전체 컬럼을 파이썬 리스트로 만들지 않음
+    lengths = np.empty(len(documents), dtype=np.int32)
+    offset = 0
+    for chunk in documents.chunks:
+        for start in range(0, len(chunk), batch_size):
+            texts = chunk.slice(start, batch_size).to_pylist()
+            input_ids = tokenizer(texts, add_special_tokens=False, truncation=True, max_length=max_length)["input_ids"]
+            lengths[offset:offset + len(texts)] = [len(ids) for ids in input_ids]
+            offset += len(texts)
+    return lengths
+
+
+def resolve_devices(encode_devices):
+    if encode_devices is not None:
+        return [device.strip() for device in encode_devices.split(",") if device.strip()]
+    if torch.cuda.is_available():
+        return [f"cuda:{idx}" for idx in range(torch.cuda.device_count())]
+    return ["cpu"] * max(1, min(4, os.cpu_count() or 1))
+
+
+def start_pool(embedder, devices):
+    # CPU worker 마다 모든 코어를 쓰면 서로 경쟁하므로 코어를 나눠서 사용
+    num_cpu_workers = sum(device == "cpu" for device in devices)
+    omp_num_threads = os.environ.get("OMP_NUM_THREADS")
+    if num_cpu_workers > 0 and omp_num_threads is None:
+        os.environ["OMP_NUM_THREADS"] = str(max(1, (os.cpu_count() or 1) // num_cpu_workers))
+    try:
+        return embedder.start_multi_process_pool(devices)
+    finally:
+        if omp_num_threads is None:
+            os.environ.pop("OMP_NUM_THREADS", None)
+
+
+def load_or_create_plan(work_dir, plan, lengths_fn):
+    plan_path = os.path.join(work_dir, "plan.json")
+    order_path = os.path.join(work_dir, "order.npy")
+
+    if os.path.exists(plan_path):
+        with open(plan_path, "r", encoding="utf-8") as f:
+            saved_plan = json.load(f)
+        if saved_plan != plan:
+            raise ValueError(f"{work_dir} was created for a different corpus or shard size. Remove it to start over.")
+        return np.load(order_path)
+
+    os.makedirs(work_dir, exist_ok=True)
+    # 긴 문서부터 정렬해서 같은 batch 안의 padding 을 줄이고, 메모리 부족은 첫 shard 에서 바로 확인
+    order = np.argsort(-lengths_fn(), kind="stable")
+    np.save(order_path, order)
+    with open(plan_path, "w", encoding="utf-8") as f:
+        json.dump(plan, f, ensure_ascii=False, indent=2)
+    return order
+
+
+def main():
+    args = encode_corpus_parse_args()
+    store_args = args[0]
+    encode_args = args[1]
+
+    collector = load_dataset(store_args.rag_collector_name_or_path)['train']
+    path, manifest = store_location(
+        store_args.rag_embedder_name_or_path,
+        collector,
+        'output',
+        store_args.rag_store_dir,
+        dtype=store_args.rag_embedding_dtype,
+        normalize_embeddings=store_args.rag_normalize_embeddings
+        )
+    if os.path.exists(os.path.join(path, "manifest.json")):
+        return EmbeddingStore(path), 0, 0.0
+
+    start_time = time.perf_counter()
+    embedder = SentenceTransformer(store_args.rag_embedder_name_or_path)
+    documents = collector.data.column('output')
+
+    work_dir = encode_args.work_dir if encode_args.work_dir is not None else f"{path}.build"
+    plan = {"manifest": manifest, "count": len(documents), "shard_size": encode_args.shard_size}
+    order = load_or_create_plan(work_dir, plan, lambda: token_lengths(embedder.tokenizer, documents, embedder.max_seq_length))
+
+    shards = [
+        (os.path.join(work_dir, f"shard-{shard_idx:05d}.npy"), start, min(start + encode_args.shard_size, len(order)))
+        for shard_idx, start in enumerate(range(0, len(order), encode_args.shard_size))
+        ]
+    missing = [shard for shard in shards if not os.path.exists(shard[0])]
+
+    devices = resolve_devices(encode_args.encode_devices)
+    pool = start_pool(embedder, devices) if missing and len(devices) > 1 else None
+    if pool is None:
+        embedder.to(devices[0])
+
+    try:
+        for shard_path, start, end in track(missing, description=f"Encoding {len(missing)}/{len(shards)} shards"):
+            # shard 에 필요한 행만 Arrow 에서 꺼내서 인코딩
+            texts = documents.take(pa.array(order[start:end])).to_pylist()
+            if pool is not None:
+                embeddings = embedder.encode_multi_process(
+                    texts,
+                    pool,
+                    batch_size=encode_args.encode_batch_size,
+                    normalize_embeddings=store_args.rag_normalize_embeddings
+                    )
+            else:
+                embeddings = embedder.encode(
+                    texts,
+                    batch_size=encode_args.encode_batch_size,
+                    normalize_embeddings=store_args.rag_normalize_embeddings,
+                    convert_to_numpy=True
+                    )
+
+            tmp_path = f"{shard_path}.tmp-{os.getpid()}.npy"
+            np.save(tmp_path, embeddings.astype(store_args.rag_embedding_dtype))
+            os.replace(tmp_path, shard_path)
+    finally:
+        if pool is not None:
+            embedder.stop_multi_process_pool(pool)
+
+    # shard 는 길이 순서이므로 원래 행 번호 위치에 써서 챗봇이 읽는 store 와 같은 형식으로 만듦
+    dim = np.load(shards[0][0], mmap_mode="r").shape[1]
+    parts = ((order[start:end], np.load(shard_path)) for shard_path, start, end in shards)
+    os.makedirs(store_args.rag_store_dir, exist_ok=True)
+    embedding_store = EmbeddingStore.create_from_parts(path, parts, (len(order), dim), store_args.rag_embedding_dtype, manifest)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    return embedding_store, len(missing), time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    embedding_store, num_encoded_shards, elapsed = main()
+
+    console = Console()
+    message = Align.center(f"{embedding_store.count} documents ({num_encoded_shards} shards encoded in {elapsed:.1f}s)\n{embedding_store.path}")
+    console.print("\n", Panel(message, title="Success", border_style="bold", width=80, height=4), "\n")
@@ -5,13 +5,13 @@ def main_md():
     
     return markdown
 
-def multiturn_chatbot_md():
-    markdown = """## Multiturn Chatbot
+def multiturn_chatbot_md(max_new_tokens):
+    markdown = f"""## Multiturn Chatbot
 
 **고정 파라미터**
 
-- **Max Multi-turn :** 5 turn
-- **Max new tokens :** 512 token
+- **Max Multi-turn :** (컨텍스트 길이 - {max_new_tokens}) token 안에 들어가는 최근 턴
+- **Max new tokens :** {max_new_tokens} token
 
 **기능**
 
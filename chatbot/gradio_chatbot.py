@@ -3,34 +3,36 @@ from arguments import parse_args
 
 import explanation
 from chatbot_functions import ChatbotFunctions
+from http_api import start_http_api
 
 
 def main():
 
-    main_md = explanation.main_md()
-    multiturn_chatbot_md = explanation.multiturn_chatbot_md()
-    RAG_md = explanation.RAG_md()
-
     args = parse_args()
 
     ChatbotArguments = args[0]
 
-    chatbot_model_name_or_path = ChatbotArguments.chatbot_model_name_or_path
-    rag_embedder_name_or_path = ChatbotArguments.rag_embedder_name_or_path
-    rag_collector_name_or_path = ChatbotArguments.rag_collector_name_or_path
+    main_md = explanation.main_md()
+    multiturn_chatbot_md = explanation.multiturn_chatbot_md(ChatbotArguments.chatbot_max_new_tokens)
+    RAG_md = explanation.RAG_md()
+
     default_chat_system_prompt = ChatbotArguments.default_chat_system_prompt
     default_rag_system_prompt = ChatbotArguments.default_rag_system_prompt
     use_system_prompt = ChatbotArguments.use_system_prompt
+    # assisted decoding 은 batch 1 로만 동작하므로 draft 모델을 쓰면 스케줄러를 사용하지 않음
+    use_batch_scheduler = ChatbotArguments.use_batch_scheduler is True and ChatbotArguments.chatbot_draft_model_name_or_path is None
+    scheduler_max_batch_size = ChatbotArguments.scheduler_max_batch_size
 
-    chatbot = ChatbotFunctions(chatbot_model_name_or_path,
-                               rag_embedder_name_or_path,
-                               rag_collector_name_or_path,
-                               default_chat_system_prompt,
-                               default_rag_system_prompt
-                               )
+    chatbot = ChatbotFunctions(ChatbotArguments)
+
+    # 같은 모델과 임베더를 Gradio UI 와 HTTP API 가 함께 사용
+    if ChatbotArguments.http_api_port is not None:
+        start_http_api(chatbot, ChatbotArguments.http_api_host, ChatbotArguments.http_api_port, use_system_prompt)
 
     with gr.Blocks() as demo:
         gr.Markdown(main_md)
+        status_md = gr.Markdown()
+        readiness_timer = gr.Timer(1.0)
         with gr.Tab("Multiturn Chatbot"):
             gr.Markdown(multiturn_chatbot_md)
             with gr.Row():
@@ -51,23 +53,23 @@ def main():
 
             with gr.Row():
                 with gr.Row():
-                    chat_retry_button = gr.Button("Retry")
+                    chat_retry_button = gr.Button("Retry", interactive=False)
                 with gr.Row():
-                    chat_undo_button = gr.Button("Undo")
+                    chat_undo_button = gr.Button("Undo", interactive=False)
                 with gr.Row():
                     gr.Markdown("")
                     #gr.Checkbox(label="RAG")
 
             with gr.Row():
                 chat_message = gr.Textbox(show_label=False, placeholder="Type a message...", min_width=1000)
-                chat_send_button = gr.Button(value="Send")
+                chat_send_button = gr.Button(value="Send", interactive=False)
 
             chat_reset_button.click(chatbot.chat_reset,
                             inputs=[chat_system_prompt],
                             outputs=[chat_chatbot, chat_applied_system_prompt, chat_system_prompt, chat_message])
 
             chat_retry_button.click(chatbot.retry, 
-                            inputs=[chat_applied_system_prompt, chat_repetition_penalty, chat_temperature, chat_top_p, chat_chatbot], 
+                            inputs=[gr.State(use_system_prompt), chat_applied_system_prompt, chat_repetition_penalty, chat_temperature, chat_top_p, chat_chatbot], 
                             outputs=[chat_chatbot, chat_message])
 
             chat_undo_button.click(chatbot.undo, 
@@ -94,7 +96,7 @@ def main():
                     rag_doc_3 = gr.Textbox(label="Document 3", lines=7)
 
             with gr.Row():
-                rag_input = gr.Textbox(label="Search box", placeholder="Enter your questions...", min_width=750)
+                rag_input = gr.Textbox(label="Search box", placeholder="Enter your questions...", min_width=750, interactive=False)
                 with gr.Row():
                     rag_selected_doc = gr.Radio(label="Using document", choices=["Document 1", "Document 2", "Document 3"])
 
@@ -106,7 +108,7 @@ def main():
                 with gr.Row():
                     rag_top_p = gr.Slider(label="Top-p", value=1.0, minimum=0.0, maximum=1.0, step=0.1, interactive=True)
                 with gr.Row():
-                    rag_inference_button = gr.Button(value="Inference")
+                    rag_inference_button = gr.Button(value="Inference", interactive=False)
 
             with gr.Row():
                 with gr.Row():
@@ -118,11 +120,20 @@ def main():
                             inputs=[rag_system_prompt],
                             outputs=[rag_system_prompt, rag_applied_system_prompt, rag_inference_output, no_rag_inference_output])
 
-            rag_input.change(chatbot.retrieval, inputs=rag_input, outputs=[rag_doc_1, rag_doc_2, rag_doc_3])
+            # 입력마다 새 검색을 바로 시작하고, 더 새로운 입력이 들어온 검색은 retrieval 에서 결과를 버림
+            rag_input.change(chatbot.retrieval, inputs=rag_input, outputs=[rag_doc_1, rag_doc_2, rag_doc_3],
+                            trigger_mode="multiple", concurrency_limit=None, show_progress="hidden")
             rag_inference_button.click(chatbot.rag_inference, 
                             inputs=[gr.State(use_system_prompt), rag_applied_system_prompt, rag_input, rag_repetition_penalty, rag_temperature, rag_top_p, rag_selected_doc, rag_doc_1, rag_doc_2, rag_doc_3],
                             outputs=[rag_inference_output, no_rag_inference_output])
 
+        # 모델이 로드되는 동안 서버를 먼저 띄우고, 준비된 기능부터 활성화
+        readiness_timer.tick(chatbot.readiness,
+                            outputs=[status_md, chat_send_button, chat_retry_button, chat_undo_button, rag_input, rag_inference_button, readiness_timer],
+                            show_progress="hidden")
+
+    # 스케줄러가 여러 요청을 함께 처리할 수 있도록 이벤트 동시 실행 수를 배치 크기에 맞춤
+    demo.queue(default_concurrency_limit=scheduler_max_batch_size if use_batch_scheduler is True else 1)
     demo.launch(share=True)
 
 
@@ -0,0 +1,112 @@
+import json
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from arguments import parse_args
+from chatbot_functions import ChatbotFunctions, readiness_label
+
+
+def make_handler(chatbot, use_system_prompt):
+    # batch scheduler 가 없으면 같은 모델을 Gradio 와 함께 쓰므로 HTTP 요청의 생성은 한 번에 하나씩 실행
+    generation_lock = Lock()
+
+    class ChatbotRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, {
+                    "chat": readiness_label(chatbot.chat_ready),
+                    "rag": readiness_label(chatbot.rag_ready)
+                    })
+            elif self.path == "/metrics":
+                self.send_body(200, chatbot.telemetry.prometheus().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+            elif self.path == "/metrics.json":
+                self.send_json(200, chatbot.telemetry.snapshot())
+            else:
+                self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError as error:
+                self.send_json(400, {"error": f"Invalid JSON body: {error}"})
+                return
+
+            try:
+                if self.path == "/retrieve":
+                    self.send_json(200, {"documents": chatbot.retrieve_documents([body["query"]], top_k=body.get("top_k", 3))[0]})
+                elif self.path == "/generate":
+                    self.send_json(200, self.generate(body))
+                else:
+                    self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            except KeyError as error:
+                self.send_json(400, {"error": f"Missing field: {error}"})
+            except Exception as error:
+                self.send_json(500, {"error": str(error)})
+
+        def generate(self, body):
+            message = body["message"]
+            with chatbot.telemetry.request("http") as metrics:
+                document = None
+                system_prompt = body.get("system_prompt", chatbot.default_chat_system_prompt)
+                if body.get("use_rag", False) is True:
+                    document = chatbot.retrieve_documents([message], top_k=1)[0][0]
+                    system_prompt = body.get("system_prompt", chatbot.default_rag_system_prompt)
+
+                input_ids = chatbot.build_input_ids(message, use_system_prompt, system_prompt, history=body.get("history", []), document=document)
+                metrics.update(prompt_tokens=input_ids.shape[-1])
+                # batch scheduler 가 있으면 Gradio 요청과 같은 continuous batching loop 에서 동시에 생성
+                with generation_lock if chatbot.scheduler is None else nullcontext():
+                    response = chatbot.generate_texts(
+                        [input_ids],
+                        repetition_penalty=body.get("repetition_penalty", 1.0),
+                        temperature=body.get("temperature", 1.0),
+                        top_p=body.get("top_p", 1.0),
+                        max_new_tokens=body.get("max_new_tokens"),
+                        do_sample=body.get("do_sample", True),
+                        metrics=metrics
+                        )[0]
+
+            result = {"response": response}
+            if document is not None:
+                result["document"] = document
+            return result
+
+        def send_json(self, status, payload):
+            self.send_body(status, json.dumps(payload, ensure_ascii=False).encode("utf-8"), "application/json; charset=utf-8")
+
+        def send_body(self, status, data, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # 요청 로그는 telemetry 의 JSON 로그로 대신함
+            pass
+
+    return ChatbotRequestHandler
+
+
+def start_http_api(chatbot, host, port, use_system_prompt):
+    server = ThreadingHTTPServer((host, port), make_handler(chatbot, use_system_prompt))
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    args = parse_args()
+    ChatbotArguments = args[0]
+
+    port = ChatbotArguments.http_api_port if ChatbotArguments.http_api_port is not None else 8000
+
+    chatbot = ChatbotFunctions(ChatbotArguments)
+    server = ThreadingHTTPServer((ChatbotArguments.http_api_host, port), make_handler(chatbot, ChatbotArguments.use_system_prompt))
+    print(f"Serving chatbot HTTP API on http://{ChatbotArguments.http_api_host}:{port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
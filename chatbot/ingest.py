@@ -0,0 +1,73 @@
+import json
+
+from rich.console import Console
+from rich.panel import Panel
+from rich.align import Align
+
+from sentence_transformers import SentenceTransformer
+from datasets import load_dataset
+
+from arguments import ingest_parse_args
+from embedding_store import load_or_build_store
+
+
+def main():
+    args = ingest_parse_args()
+    store_args = args[0]
+    ingest_args = args[1]
+
+    upserts = []
+    deletions = []
+    with open(ingest_args.input_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            doc_id = str(record[ingest_args.id_field])
+            if record.get(ingest_args.delete_field, False) is True:
+                deletions.append(doc_id)
+            else:
+                upserts.append((doc_id, record[ingest_args.text_field]))
+
+    embedder = SentenceTransformer(store_args.rag_embedder_name_or_path)
+    collector = load_dataset(store_args.rag_collector_name_or_path)['train']
+
+    # 챗봇과 같은 인자로 store 를 찾아서, 실행 중인 챗봇이 다음 reload 때 새 버전을 읽도록 함
+    embedding_store = load_or_build_store(
+        embedder,
+        store_args.rag_embedder_name_or_path,
+        collector,
+        'output',
+        store_args.rag_store_dir,
+        dtype=store_args.rag_embedding_dtype,
+        normalize_embeddings=store_args.rag_normalize_embeddings
+        )
+
+    base_ids = None
+    if ingest_args.id_field in collector.column_names:
+        base_ids = [str(doc_id) for doc_id in collector[ingest_args.id_field]]
+
+    return embedding_store.ingest(
+        embedder,
+        upserts,
+        deletions,
+        collector.data.column('output'),
+        base_ids=base_ids
+        )
+
+
+if __name__ == "__main__":
+    embedding_store, stats = main()
+
+    console = Console()
+    message = Align.center(
+        "Corpus version {} · {} documents\nadded {} · updated {} · unchanged {} · deleted {}".format(
+            embedding_store.version,
+            embedding_store.count - (0 if embedding_store.deleted() is None else int(embedding_store.deleted().sum())),
+            stats["added"],
+            stats["updated"],
+            stats["unchanged"],
+            stats["deleted"]
+            )
+        )
+    console.print("\n", Panel(message, title="Success", border_style="bold", width=70, height=4), "\n")
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+from threading import Lock
+
+from transformers import DynamicCache
+
+
+class SessionKVCache:
+    def __init__(self, max_memory_mb):
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = Lock()
+
+    def pop(self, session_id, input_ids):
+        with self.lock:
+            entry = self.entries.pop(session_id, None)
+            if entry is not None:
+                self.total_bytes -= entry[2]
+
+        if entry is None:
+            return DynamicCache()
+
+        token_ids, past_key_values, _ = entry
+
+        # 새 프롬프트와 겹치는 토큰까지만 재사용하고, 마지막 토큰은 항상 새로 prefill
+        prefix_len = min(common_prefix_length(token_ids, input_ids), input_ids.shape[-1] - 1)
+        if prefix_len <= 0:
+            return DynamicCache()
+
+        past_key_values.crop(prefix_len)
+        return past_key_values
+
+    def put(self, session_id, token_ids, past_key_values):
+        if not isinstance(past_key_values, DynamicCache):
+            return
+
+        cache_len = past_key_values.get_seq_length()
+        nbytes = cache_nbytes(past_key_values)
+        if cache_len == 0 or nbytes > self.max_memory_bytes:
+            return
+
+        with self.lock:
+            entry = self.entries.pop(session_id, None)
+            if entry is not None:
+                self.total_bytes -= entry[2]
+
+            self.entries[session_id] = (token_ids[:cache_len], past_key_values, nbytes)
+            self.total_bytes += nbytes
+
+            while self.total_bytes > self.max_memory_bytes:
+                _, (_, _, evicted_bytes) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+
+    def discard(self, session_id):
+        with self.lock:
+            entry = self.entries.pop(session_id, None)
+            if entry is not None:
+                self.total_bytes -= entry[2]
+
+
+def common_prefix_length(cached_ids, input_ids):
+    length = min(cached_ids.shape[-1], input_ids.shape[-1])
+    mismatch = (cached_ids[:length].to(input_ids.device) != input_ids[:length]).nonzero()
+
+    return int(mismatch[0]) if len(mismatch) > 0 else length
+
+
+def cache_nbytes(past_key_values):
+    tensors = past_key_values.key_cache + past_key_values.value_cache
+
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
@@ -0,0 +1,112 @@
+import torch
+
+from query_cache import LRUCache
+
+
+class ChatPromptBuilder:
+    def __init__(self, tokenizer, max_prompt_tokens, cache_size=4096):
+        self.tokenizer = tokenizer
+        self.max_prompt_tokens = max_prompt_tokens
+        self.segment_cache = LRUCache(cache_size)
+
+        # 템플릿 안에서 대화 턴의 위치와 상관없이 같은 문자열이 나오도록 고정된 probe 턴을 앞에 둠
+        self.probe_turn = [
+            {"role": "user", "content": "probe"},
+            {"role": "assistant", "content": "probe"}
+            ]
+
+    def build(self, system_messages, history, message):
+        user_message = [{"role": "user", "content": message}]
+        segments = self.segments(system_messages, history, message)
+        if segments is None:
+            return self.build_without_cache(system_messages, history, message)
+
+        prefix_ids, turn_ids, generation_ids = segments
+
+        budget = self.max_prompt_tokens - len(prefix_ids) - len(generation_ids)
+        kept = 0
+        for ids in reversed(turn_ids):
+            if len(ids) > budget:
+                break
+            budget -= len(ids)
+            kept += 1
+
+        input_ids = list(prefix_ids)
+        for ids in turn_ids[len(turn_ids) - kept:]:
+            input_ids.extend(ids)
+        input_ids.extend(generation_ids)
+
+        conversation = system_messages + history_messages(history[len(history) - kept:]) + user_message
+        return torch.tensor([input_ids]), conversation
+
+    def segments(self, system_messages, history, message):
+        system_key = tuple(item["content"] for item in system_messages)
+
+        prefix = self.segment_cache.get(("prefix", system_key))
+        if prefix is None:
+            base = self.render(system_messages + self.probe_turn)
+            probe_text = self.segment_text(system_messages, self.probe_turn, base)
+            if probe_text is None or not base.endswith(probe_text):
+                return None
+
+            prefix = (base, self.tokenize(base[:len(base) - len(probe_text)]))
+            self.segment_cache.put(("prefix", system_key), prefix)
+
+        base, prefix_ids = prefix
+
+        turn_ids = []
+        for user, assistant in history:
+            ids = self.segment(system_key, system_messages, history_messages([(user, assistant)]), base)
+            if ids is None:
+                return None
+            turn_ids.append(ids)
+
+        generation_ids = self.segment(system_key, system_messages, [{"role": "user", "content": message}], base, add_generation_prompt=True)
+        if generation_ids is None:
+            return None
+
+        return prefix_ids, turn_ids, generation_ids
+
+    def segment(self, system_key, system_messages, messages, base, add_generation_prompt=False):
+        key = (system_key, tuple((item["role"], item["content"]) for item in messages), add_generation_prompt)
+        ids = self.segment_cache.get(key)
+        if ids is not None:
+            return ids
+
+        text = self.segment_text(system_messages, messages, base, add_generation_prompt)
+        if text is None:
+            return None
+
+        ids = self.tokenize(text)
+        self.segment_cache.put(key, ids)
+        return ids
+
+    def segment_text(self, system_messages, messages, base, add_generation_prompt=False):
+        text = self.render(system_messages + self.probe_turn + messages, add_generation_prompt=add_generation_prompt)
+        if not text.startswith(base):
+            return None
+        return text[len(base):]
+
+    def tokenize(self, text):
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def render(self, conversation, add_generation_prompt=False):
+        return self.tokenizer.apply_chat_template(conversation, tokenize=False, add_generation_prompt=add_generation_prompt)
+
+    def build_without_cache(self, system_messages, history, message):
+        # 턴 단위로 나눌 수 없는 템플릿은 오래된 턴부터 버리면서 전체 대화를 다시 토큰화
+        for start in range(len(history) + 1):
+            conversation = system_messages + history_messages(history[start:]) + [{"role": "user", "content": message}]
+            input_ids = self.tokenizer.apply_chat_template(conversation, add_generation_prompt=True, tokenize=True, return_tensors="pt")
+            if input_ids.shape[-1] <= self.max_prompt_tokens:
+                break
+
+        return input_ids, conversation
+
+
+def history_messages(history):
+    messages = []
+    for user, assistant in history:
+        messages.append({"role": "user", "content": user})
+        messages.append({"role": "assistant", "content": assistant})
+    return messages
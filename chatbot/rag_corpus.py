@@ -0,0 +1,52 @@
+from vector_index import build_index, rescore
+from sparse_index import load_or_build_bm25
+
+
+class RagCorpus:
+    def __init__(self, embedding_store, vector_index, documents, sparse_index=None, sparse_candidates=2000):
+        self.embedding_store = embedding_store
+        self.vector_index = vector_index
+        self.documents = documents
+        self.sparse_index = sparse_index
+        self.sparse_candidates = sparse_candidates
+
+        self.embeddings = embedding_store.embeddings() if sparse_index is not None else None
+        self.deleted = embedding_store.deleted()
+
+    @property
+    def version(self):
+        return self.embedding_store.version
+
+    def search(self, query, query_embedding, top_k):
+        if self.sparse_index is not None:
+            candidates = self.sparse_index.search(query, self.sparse_candidates)
+            # 키워드가 겹치는 문서가 부족하면 dense index 로 전체 검색
+            if len(candidates) >= top_k:
+                _, top_results = rescore(self.embeddings, candidates, query_embedding, top_k, self.deleted)
+                if len(top_results) >= top_k:
+                    return top_results
+
+        _, top_results = self.vector_index.search(query_embedding, top_k)
+        return top_results
+
+    def document(self, idx):
+        return self.documents[idx].as_py().strip()
+
+
+def build_corpus(embedding_store, chatbot_args, device, base_column):
+    vector_index = build_index(
+        embedding_store,
+        chatbot_args.rag_index_type,
+        device,
+        ivf_nlist=chatbot_args.rag_ivf_nlist,
+        ivf_nprobe=chatbot_args.rag_ivf_nprobe,
+        rescore_candidates=chatbot_args.rag_rescore_candidates
+        )
+    # 문서는 Arrow 컬럼에서 필요한 행만 바로 읽어서 전체 컬럼을 파이썬 리스트로 만들지 않음
+    documents = embedding_store.documents(base_column)
+
+    sparse_index = None
+    if chatbot_args.rag_use_sparse_first_stage:
+        sparse_index = load_or_build_bm25(embedding_store, documents)
+
+    return RagCorpus(embedding_store, vector_index, documents, sparse_index, chatbot_args.rag_sparse_candidates)
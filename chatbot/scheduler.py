@@ -0,0 +1,277 @@
+from queue import Empty, Queue
+from threading import Event, Thread
+
+import torch
+import torch.nn.functional as F
+
+from transformers import DynamicCache
+from transformers.generation.utils import GenerateDecoderOnlyOutput
+
+
+class GenerationRequest:
+    def __init__(self, input_ids, max_new_tokens, eos_token_id, repetition_penalty, temperature, top_p, past_key_values=None, streamer=None, stop_event=None, metrics=None):
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = eos_token_id
+        self.repetition_penalty = float(repetition_penalty)
+        self.temperature = float(temperature)
+        self.top_p = float(top_p)
+        self.past_key_values = past_key_values
+        self.streamer = streamer
+        self.stop_event = stop_event if stop_event is not None else Event()
+        self.metrics = metrics
+
+        self.generated = []
+        self.output = None
+        self.error = None
+        self.done = Event()
+
+    def is_finished(self):
+        if self.stop_event.is_set() or len(self.generated) >= self.max_new_tokens:
+            return True
+        return len(self.generated) > 0 and self.generated[-1] in self.eos_token_id
+
+
+class BatchScheduler:
+    def __init__(self, model, max_batch_size=8):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.pending = Queue()
+
+        self.requests = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.next_tokens = None
+
+        self.thread = Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def generate(self, input_ids, max_new_tokens, eos_token_id, repetition_penalty, temperature, top_p, past_key_values=None, streamer=None, stop_event=None, metrics=None):
+        eos_token_id = eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]
+        request = GenerationRequest(input_ids, max_new_tokens, eos_token_id, repetition_penalty, temperature, top_p, past_key_values, streamer, stop_event, metrics)
+
+        if streamer is not None:
+            streamer.put(input_ids.cpu())
+        self.pending.put(request)
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def loop(self):
+        while True:
+            try:
+                with torch.no_grad():
+                    # 처리 중인 요청이 없으면 새 요청이 들어올 때까지 대기
+                    self.admit(block=not self.requests)
+                    if self.requests:
+                        self.decode_step()
+            except Exception as error:
+                for request in self.requests:
+                    self.finish(request, error=error)
+                self.reset()
+
+    def admit(self, block=False):
+        while len(self.requests) < self.max_batch_size:
+            try:
+                request = self.pending.get(block=block)
+            except Empty:
+                return
+            block = False
+
+            # 배치에 들어가기 전까지 기다린 시간을 queue wait 으로 기록
+            if request.metrics is not None:
+                request.metrics.mark_started()
+
+            try:
+                past_key_values, logits = self.prefill(request)
+            except Exception as error:
+                self.finish(request, error=error)
+                continue
+
+            token = self.sample(logits, [request])[0]
+            self.join(request, past_key_values, token)
+
+            self.emit(request, token)
+            if request.is_finished():
+                self.leave([len(self.requests) - 1])
+
+    def prefill(self, request):
+        input_ids = request.input_ids.to(self.model.device)
+        past_key_values = request.past_key_values if request.past_key_values is not None else DynamicCache()
+        prefix_len = past_key_values.get_seq_length()
+
+        cache_position = torch.arange(prefix_len, input_ids.shape[-1], device=self.model.device)
+        outputs = self.model(
+            input_ids=input_ids[None, prefix_len:],
+            attention_mask=torch.ones(1, input_ids.shape[-1], dtype=torch.long, device=self.model.device),
+            position_ids=cache_position[None],
+            cache_position=cache_position,
+            past_key_values=past_key_values,
+            use_cache=True
+            )
+
+        return outputs.past_key_values, outputs.logits[:, -1, :]
+
+    def join(self, request, past_key_values, token):
+        seq_len = past_key_values.get_seq_length()
+        attention_mask = torch.ones(1, seq_len, dtype=torch.long, device=self.model.device)
+        next_token = torch.tensor([token], device=self.model.device)
+
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.next_tokens = next_token
+        else:
+            # 길이가 다른 요청을 합칠 때는 왼쪽을 padding 해서 KV cache 길이를 맞춤
+            batch_len = max(self.attention_mask.shape[-1], seq_len)
+            batch_cache = left_pad_cache(self.past_key_values, batch_len - self.attention_mask.shape[-1])
+            request_cache = left_pad_cache(past_key_values, batch_len - seq_len)
+
+            for layer_idx in range(len(batch_cache.key_cache)):
+                batch_cache.key_cache[layer_idx] = torch.cat([batch_cache.key_cache[layer_idx], request_cache.key_cache[layer_idx]], dim=0)
+                batch_cache.value_cache[layer_idx] = torch.cat([batch_cache.value_cache[layer_idx], request_cache.value_cache[layer_idx]], dim=0)
+
+            self.past_key_values = batch_cache
+            self.attention_mask = torch.cat([
+                F.pad(self.attention_mask, (batch_len - self.attention_mask.shape[-1], 0)),
+                F.pad(attention_mask, (batch_len - seq_len, 0))
+                ], dim=0)
+            self.next_tokens = torch.cat([self.next_tokens, next_token])
+
+        self.requests.append(request)
+
+    def decode_step(self):
+        seq_len = self.attention_mask.shape[-1]
+        position_ids = self.attention_mask.sum(dim=-1, keepdim=True)
+        self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+
+        outputs = self.model(
+            input_ids=self.next_tokens[:, None],
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            cache_position=torch.tensor([seq_len], device=self.model.device),
+            past_key_values=self.past_key_values,
+            use_cache=True
+            )
+        self.past_key_values = outputs.past_key_values
+
+        tokens = self.sample(outputs.logits[:, -1, :], self.requests)
+        self.next_tokens = torch.tensor(tokens, device=self.model.device)
+
+        finished = []
+        for idx, (request, token) in enumerate(zip(self.requests, tokens)):
+            self.emit(request, token)
+            if request.is_finished():
+                finished.append(idx)
+
+        if finished:
+            self.leave(finished)
+
+    def sample(self, logits, requests):
+        logits = logits.float()
+
+        for idx, request in enumerate(requests):
+            if request.repetition_penalty != 1.0:
+                seen = torch.cat([request.input_ids.to(logits.device), torch.tensor(request.generated, dtype=torch.long, device=logits.device)])
+                score = logits[idx].gather(0, seen)
+                score = torch.where(score < 0, score * request.repetition_penalty, score / request.repetition_penalty)
+                logits[idx].scatter_(0, seen, score)
+
+        temperature = torch.tensor([request.temperature for request in requests], device=logits.device)
+        top_p = torch.tensor([request.top_p for request in requests], device=logits.device)
+        greedy = temperature <= 0.0
+
+        logits = logits / torch.where(greedy, torch.ones_like(temperature), temperature)[:, None]
+
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        # 누적 확률이 top_p 를 넘기 전까지의 토큰만 남기되, 가장 확률이 높은 토큰은 항상 유지
+        remove = (sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p[:, None]
+        remove[:, 0] = False
+        sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+        logits = torch.full_like(logits, float("-inf")).scatter(1, sorted_indices, sorted_logits)
+
+        sampled = torch.multinomial(logits.softmax(dim=-1), num_samples=1)[:, 0]
+        tokens = torch.where(greedy, logits.argmax(dim=-1), sampled)
+
+        return tokens.tolist()
+
+    def emit(self, request, token):
+        request.generated.append(token)
+        if request.metrics is not None:
+            request.metrics.mark_tokens(1)
+        if request.streamer is not None:
+            request.streamer.put(torch.tensor([token]))
+
+    def leave(self, indices):
+        for idx in indices:
+            request = self.requests[idx]
+            self.finish(request, past_key_values=extract_row_cache(self.past_key_values, self.attention_mask, idx))
+
+        keep = [idx for idx in range(len(self.requests)) if idx not in indices]
+        if not keep:
+            self.reset()
+            return
+
+        keep_indices = torch.tensor(keep, device=self.model.device)
+        self.requests = [self.requests[idx] for idx in keep]
+        self.attention_mask = self.attention_mask[keep_indices]
+        self.next_tokens = self.next_tokens[keep_indices]
+        self.past_key_values.batch_select_indices(keep_indices)
+
+        # 남은 요청 모두에게 padding 인 왼쪽 열은 잘라냄
+        trim = int((self.attention_mask.cumsum(dim=-1) == 0).all(dim=0).sum())
+        if trim > 0:
+            self.attention_mask = self.attention_mask[:, trim:]
+            trim_cache_left(self.past_key_values, trim)
+
+    def finish(self, request, past_key_values=None, error=None):
+        if error is None:
+            sequences = torch.cat([request.input_ids.cpu(), torch.tensor(request.generated, dtype=torch.long)])[None]
+            request.output = GenerateDecoderOnlyOutput(sequences=sequences, past_key_values=past_key_values)
+        request.error = error
+
+        if request.streamer is not None:
+            request.streamer.end()
+        request.done.set()
+
+    def reset(self):
+        self.requests = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.next_tokens = None
+
+
+def left_pad_cache(past_key_values, pad_len):
+    if pad_len == 0:
+        return past_key_values
+
+    padded = DynamicCache()
+    for layer_idx in range(len(past_key_values.key_cache)):
+        padded.update(
+            F.pad(past_key_values.key_cache[layer_idx], (0, 0, pad_len, 0)),
+            F.pad(past_key_values.value_cache[layer_idx], (0, 0, pad_len, 0)),
+            layer_idx
+            )
+    return padded
+
+
+def trim_cache_left(past_key_values, trim):
+    for layer_idx in range(len(past_key_values.key_cache)):
+        past_key_values.key_cache[layer_idx] = past_key_values.key_cache[layer_idx][:, :, trim:, :]
+        past_key_values.value_cache[layer_idx] = past_key_values.value_cache[layer_idx][:, :, trim:, :]
+
+
+def extract_row_cache(past_key_values, attention_mask, idx):
+    pad_len = int((attention_mask[idx] == 0).sum())
+
+    row_cache = DynamicCache()
+    for layer_idx in range(len(past_key_values.key_cache)):
+        row_cache.update(
+            past_key_values.key_cache[layer_idx][idx:idx + 1, :, pad_len:, :].clone(),
+            past_key_values.value_cache[layer_idx][idx:idx + 1, :, pad_len:, :].clone(),
+            layer_idx
+            )
+    return row_cache
@@ -0,0 +1,199 @@
+import fcntl
+import json
+import os
+import re
+import shutil
+from array import array
+from collections import Counter
+
+import numpy as np
+
+
+TOKENIZER_VERSION = "word+char-bigram-v1"
+
+
+class BM25Segment:
+    def __init__(self, path):
+        with open(os.path.join(path, "vocab.json"), "r", encoding="utf-8") as f:
+            self.vocab = json.load(f)
+        self.indptr = np.load(os.path.join(path, "indptr.npy"), mmap_mode="r")
+        self.doc_ids = np.load(os.path.join(path, "doc_ids.npy"), mmap_mode="r")
+        self.term_freqs = np.load(os.path.join(path, "term_freqs.npy"), mmap_mode="r")
+
+    def postings(self, term):
+        term_id = self.vocab.get(term)
+        if term_id is None:
+            return None
+        start, end = self.indptr[term_id], self.indptr[term_id + 1]
+        return np.asarray(self.doc_ids[start:end]), np.asarray(self.term_freqs[start:end])
+
+
+class BM25Index:
+    def __init__(self, path, deleted=None, k1=1.2, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+
+        info = read_info(path)
+        self.segments = [BM25Segment(os.path.join(path, segment["dir"])) for segment in info["segments"]]
+        self.doc_lengths = np.load(os.path.join(path, "doc_lengths.npy"), mmap_mode="r")
+        self.deleted = deleted
+
+        # 삭제되거나 수정 전 내용인 행 (tombstone) 은 문서 수와 평균 길이에서 뺌
+        live_lengths = self.doc_lengths if deleted is None else self.doc_lengths[~deleted[:len(self.doc_lengths)]]
+        self.num_docs = len(live_lengths)
+        self.avg_doc_length = max(float(live_lengths.mean()) if self.num_docs > 0 else 0.0, 1.0)
+
+    def search(self, query, top_n):
+        doc_ids = []
+        scores = []
+        for term in set(tokenize(query)):
+            postings = [segment.postings(term) for segment in self.segments]
+            postings = [posting for posting in postings if posting is not None]
+            if not postings:
+                continue
+
+            docs = np.concatenate([posting[0] for posting in postings])
+            tf = np.concatenate([posting[1] for posting in postings]).astype(np.float32)
+            if self.deleted is not None:
+                live = ~self.deleted[docs]
+                docs, tf = docs[live], tf[live]
+
+            df = len(docs)
+            if df == 0:
+                continue
+            idf = np.log(1.0 + (self.num_docs - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1.0 - self.b + self.b * self.doc_lengths[docs] / self.avg_doc_length)
+
+            doc_ids.append(docs)
+            scores.append(idf * tf * (self.k1 + 1.0) / (tf + norm))
+
+        if not doc_ids:
+            return np.zeros(0, dtype=np.int64)
+
+        # 쿼리 용어가 등장한 문서만 점수를 합산해서 전체 코퍼스 크기에 비례하는 배열을 만들지 않음
+        candidates, inverse = np.unique(np.concatenate(doc_ids), return_inverse=True)
+        candidate_scores = np.bincount(inverse, weights=np.concatenate(scores))
+
+        if len(candidates) > top_n:
+            top = np.argpartition(-candidate_scores, top_n)[:top_n]
+            candidates = candidates[top]
+        return candidates.astype(np.int64)
+
+
+def tokenize(text):
+    # 한국어는 조사/어미가 붙어도 겹치도록 어절과 함께 글자 bigram 을 색인
+    tokens = []
+    for word in re.findall(r"\w+", text.lower()):
+        tokens.append(word)
+        tokens.extend(word[idx:idx + 2] for idx in range(len(word) - 1))
+    return tokens
+
+
+def build_segment(path, documents, start, deleted=None):
+    vocab = {}
+    term_ids = array("i")
+    doc_ids = array("i")
+    term_freqs = array("i")
+    doc_lengths = array("i")
+
+    for doc_id, text in enumerate(documents, start=start):
+        # 이미 tombstone 인 행은 색인하지 않음
+        if deleted is not None and doc_id < len(deleted) and deleted[doc_id]:
+            doc_lengths.append(0)
+            continue
+        counts = Counter(tokenize(text or ""))
+        doc_lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            doc_ids.append(doc_id)
+            term_freqs.append(tf)
+
+    term_ids = np.frombuffer(term_ids, dtype=np.int32)
+    order = np.argsort(term_ids, kind="stable")
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(term_ids, minlength=len(vocab)))]).astype(np.int64)
+
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    np.save(os.path.join(tmp_path, "indptr.npy"), indptr)
+    np.save(os.path.join(tmp_path, "doc_ids.npy"), np.frombuffer(doc_ids, dtype=np.int32)[order])
+    np.save(os.path.join(tmp_path, "term_freqs.npy"), np.frombuffer(term_freqs, dtype=np.int32)[order])
+    with open(os.path.join(tmp_path, "vocab.json"), "w", encoding="utf-8") as f:
+        json.dump(vocab, f, ensure_ascii=False)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    return np.frombuffer(doc_lengths, dtype=np.int32)
+
+
+def read_info(path):
+    info_path = os.path.join(path, "index.json")
+    if not os.path.exists(info_path):
+        return None
+    with open(info_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_info(path, info):
+    tmp_file = os.path.join(path, f"index.json.tmp-{os.getpid()}")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    os.replace(tmp_file, os.path.join(path, "index.json"))
+
+
+def text_rows(documents, start, end):
+    for chunk in documents.slice(start, end - start).chunks:
+        yield from chunk.to_pylist()
+
+
+def update_bm25(path, documents, count, deleted, max_segments):
+    info = read_info(path)
+    if info is None or info["tokenizer"] != TOKENIZER_VERSION:
+        info = {"tokenizer": TOKENIZER_VERSION, "count": 0, "segments": []}
+        doc_lengths = np.zeros(0, dtype=np.int32)
+    else:
+        doc_lengths = np.load(os.path.join(path, "doc_lengths.npy"))
+
+    if info["count"] == count:
+        return False
+
+    segments = info["segments"]
+    start = info["count"]
+    if len(segments) >= max_segments:
+        # 추가된 segment 가 많아지면 처음 만든 segment 뒤의 행만 하나로 다시 묶음
+        start = segments[1]["start"]
+        segments = segments[:1]
+
+    segment = {"dir": f"segment-{start:010d}-{count:010d}", "start": start, "count": count - start}
+    new_lengths = build_segment(os.path.join(path, segment["dir"]), text_rows(documents, start, count), start, deleted)
+    doc_lengths = np.concatenate([doc_lengths[:start], new_lengths])
+
+    tmp_file = os.path.join(path, f"doc_lengths.tmp-{os.getpid()}.npy")
+    np.save(tmp_file, doc_lengths)
+    os.replace(tmp_file, os.path.join(path, "doc_lengths.npy"))
+    write_info(path, dict(info, count=count, segments=segments + [segment]))
+    return True
+
+
+def remove_unused_segments(path):
+    # 다시 묶여서 더 이상 index.json 이 가리키지 않는 segment 와 중단된 쓰기를 지움
+    used = {segment["dir"] for segment in read_info(path)["segments"]}
+    for name in os.listdir(path):
+        if name.startswith("segment-") and name not in used:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def load_or_build_bm25(embedding_store, documents, max_segments=8):
+    # vector index 와 같이 store 안에 두고, ingest 로 추가된 행만 새 segment 로 색인
+    path = os.path.join(embedding_store.path, "bm25")
+    os.makedirs(path, exist_ok=True)
+    deleted = embedding_store.deleted()
+
+    with open(os.path.join(path, "build.lock"), "w") as lock:
+        # 여러 프로세스가 같은 store 를 reload 해도 segment 는 한 번만 만듦
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if update_bm25(path, documents, embedding_store.count, deleted, max_segments):
+            remove_unused_segments(path)
+        return BM25Index(path, deleted)
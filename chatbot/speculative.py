@@ -0,0 +1,60 @@
+import time
+from contextlib import contextmanager
+from threading import Lock, local
+
+
+class SpeculativeStats:
+    def __init__(self, model, draft_model, telemetry):
+        self.telemetry = telemetry
+        self.local = local()
+        self.lock = Lock()
+        self.totals = {"new_tokens": 0, "accepted_tokens": 0, "draft_tokens": 0, "seconds": 0.0}
+
+        # 생성 스레드별로 본 모델과 draft 모델의 forward 횟수를 셈
+        model.register_forward_hook(self.count_forward("target_forwards"))
+        draft_model.register_forward_hook(self.count_forward("draft_forwards"))
+
+    def count_forward(self, name):
+        def hook(module, args, output):
+            counters = getattr(self.local, "counters", None)
+            if counters is not None:
+                counters[name] += 1
+        return hook
+
+    @contextmanager
+    def track(self):
+        counters = {"target_forwards": 0, "draft_forwards": 0, "new_tokens": 0}
+        self.local.counters = counters
+        start = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            self.local.counters = None
+            self.record(counters, time.perf_counter() - start)
+
+    def record(self, counters, seconds):
+        new_tokens = counters["new_tokens"]
+        if new_tokens == 0:
+            return
+
+        # 검증 forward 한 번마다 draft 토큰 중 일치한 만큼과 본 모델의 토큰 하나가 추가됨
+        accepted_tokens = max(new_tokens - counters["target_forwards"], 0)
+        draft_tokens = counters["draft_forwards"]
+
+        with self.lock:
+            self.totals["new_tokens"] += new_tokens
+            self.totals["accepted_tokens"] += accepted_tokens
+            self.totals["draft_tokens"] += draft_tokens
+            self.totals["seconds"] += seconds
+            totals = dict(self.totals)
+
+        self.telemetry.record(
+            "speculative",
+            new_tokens=new_tokens,
+            accepted_tokens=accepted_tokens,
+            draft_tokens=draft_tokens,
+            acceptance_rate=accepted_tokens / max(draft_tokens, 1),
+            tokens_per_second=new_tokens / max(seconds, 1e-9),
+            total_acceptance_rate=totals["accepted_tokens"] / max(totals["draft_tokens"], 1),
+            total_tokens_per_second=totals["new_tokens"] / max(totals["seconds"], 1e-9)
+            )
@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict, deque
+from threading import Lock
+
+import numpy as np
+import torch
+
+from transformers.generation.streamers import BaseStreamer
+
+
+class Telemetry:
+    def __init__(self, window_size=1000, log_path=None):
+        self.windows = defaultdict(lambda: deque(maxlen=window_size))
+        self.counts = defaultdict(int)
+        self.lock = Lock()
+
+        # 한 줄에 JSON 하나씩 기록해서 로그 수집기가 그대로 파싱할 수 있게 함
+        # logger 는 프로세스 전역이므로 기록할 위치마다 따로 만들어서 각 인스턴스가 자신의 log_path 에 씀
+        log_name = "stderr" if log_path is None else os.path.abspath(log_path)
+        self.logger = logging.getLogger(f"chatbot.telemetry.{log_name}")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if not self.logger.handlers:
+            handler = logging.FileHandler(log_path, encoding="utf-8") if log_path is not None else logging.StreamHandler()
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+
+    def request(self, event, **fields):
+        return RequestMetrics(self, event, **fields)
+
+    def record(self, event, **fields):
+        with self.lock:
+            self.counts[event] += 1
+            for name, value in fields.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.windows[(event, name)].append(float(value))
+
+        self.logger.info(json.dumps({"event": event, "timestamp": time.time(), **fields}, ensure_ascii=False, default=str))
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+            windows = {key: list(values) for key, values in self.windows.items()}
+
+        summary = {event: {"count": count} for event, count in counts.items()}
+        for (event, name), values in sorted(windows.items()):
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary[event][name] = {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+        return summary
+
+    def prometheus(self):
+        metrics = defaultdict(list)
+        for event, summary in self.snapshot().items():
+            metrics["chatbot_requests_total"].append(f'chatbot_requests_total{{event="{event}"}} {summary["count"]}')
+            for name, quantiles in summary.items():
+                if name == "count":
+                    continue
+                for quantile, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+                    metrics[f"chatbot_{name}"].append(f'chatbot_{name}{{event="{event}",quantile="{quantile}"}} {quantiles[key]}')
+
+        lines = []
+        for name, samples in metrics.items():
+            lines.append(f"# TYPE {name} {'counter' if name == 'chatbot_requests_total' else 'summary'}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    def __init__(self, telemetry, event, **fields):
+        self.telemetry = telemetry
+        self.event = event
+        self.fields = fields
+
+        self.start_time = time.perf_counter()
+        self.generation_start_time = None
+        self.first_token_time = None
+        self.last_token_time = None
+        self.first_step_tokens = 0
+        self.new_tokens = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # 정상 종료뿐 아니라 사용자가 취소 (generator 의 GeneratorExit) 하거나 오류로 끝난 요청도 기록
+        if exc_type is None:
+            self.finish(status="completed")
+        elif issubclass(exc_type, GeneratorExit):
+            self.finish(status="cancelled")
+        else:
+            self.finish(status="error", error=repr(exc_value))
+        return False
+
+    def update(self, **fields):
+        self.fields.update(fields)
+
+    def mark_started(self):
+        if self.generation_start_time is None:
+            self.generation_start_time = time.perf_counter()
+
+    def mark_tokens(self, count):
+        if count <= 0:
+            return
+        now = time.perf_counter()
+        if self.first_token_time is None:
+            self.first_token_time = now
+            self.first_step_tokens = count
+        self.last_token_time = now
+        self.new_tokens += count
+
+    def finish(self, **fields):
+        metrics = dict(self.fields, **fields)
+        metrics["total_seconds"] = time.perf_counter() - self.start_time
+        metrics.setdefault("new_tokens", self.new_tokens)
+
+        if self.generation_start_time is not None:
+            metrics["queue_wait_seconds"] = self.generation_start_time - self.start_time
+        if self.first_token_time is not None:
+            metrics["ttft_seconds"] = self.first_token_time - self.start_time
+            # 첫 토큰(prefill) 이후 decode 구간의 처리량
+            decode_seconds = self.last_token_time - self.first_token_time
+            if decode_seconds > 0:
+                metrics["decode_tokens_per_second"] = (self.new_tokens - self.first_step_tokens) / decode_seconds
+
+        self.telemetry.record(self.event, **metrics)
+
+
+class TokenTimer(BaseStreamer):
+    def __init__(self, metrics, streamer=None, eos_token_id=None):
+        self.metrics = metrics
+        self.streamer = streamer
+        self.eos_token_ids = None if eos_token_id is None else torch.tensor(eos_token_id).reshape(-1)
+        self.finished = None
+        self.next_tokens_are_prompt = True
+
+    def put(self, value):
+        # generate 가 streamer 로 넘기는 토큰은 본 모델이 확정한 토큰이므로 assisted decoding 의 draft 후보는 세지 않음
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            self.finished = torch.zeros(value.shape[0] if value.dim() > 1 else 1, dtype=torch.bool)
+        else:
+            self.metrics.mark_tokens(self.count_new_tokens(value))
+
+        if self.streamer is not None:
+            self.streamer.put(value)
+
+    def count_new_tokens(self, value):
+        if self.eos_token_ids is None:
+            return value.numel()
+
+        # batch 생성은 EOS 가 나온 행을 끝날 때까지 pad 토큰으로 채우므로 아직 끝나지 않은 행의 토큰만 셈
+        tokens = value.reshape(len(self.finished), -1)
+        is_eos = torch.isin(tokens, self.eos_token_ids)
+        after_eos = (is_eos.cumsum(dim=-1) - is_eos.long()) > 0
+        count = int((~self.finished[:, None] & ~after_eos).sum())
+        self.finished |= is_eos.any(dim=-1)
+        return count
+
+    def end(self):
+        if self.streamer is not None:
+            self.streamer.end()
+
+
+def timed_streamer(streamer, metrics, eos_token_id=None):
+    return streamer if metrics is None else TokenTimer(metrics, streamer, eos_token_id)
@@ -0,0 +1,221 @@
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class ExactIndex:
+    def __init__(self, embeddings, device, normalized, deleted=None):
+        self.embeddings = torch.from_numpy(embeddings).to(device)
+        self.norms = None if normalized else torch.linalg.vector_norm(self.embeddings, dim=-1, dtype=torch.float32).clamp(min=1e-12)
+        self.deleted = None if deleted is None else torch.from_numpy(deleted).to(device)
+        self.num_live = len(embeddings) if deleted is None else int((~deleted).sum())
+
+    def search(self, query_embedding, top_k):
+        query_embedding = F.normalize(query_embedding.to(self.embeddings.device, torch.float32), dim=-1)
+        scores = (self.embeddings @ query_embedding.to(self.embeddings.dtype)).float()
+        if self.norms is not None:
+            scores = scores / self.norms
+        if self.deleted is not None:
+            scores = scores.masked_fill(self.deleted, float("-inf"))
+
+        top_scores, top_indices = torch.topk(scores, min(top_k, self.num_live))
+        return top_scores.cpu().numpy(), top_indices.cpu().numpy()
+
+
+class IVFIndex:
+    def __init__(self, embeddings, centroids, assignments, nprobe, deleted=None):
+        self.embeddings = embeddings
+        self.deleted = deleted
+        self.centroids = torch.from_numpy(centroids)
+        self.nprobe = min(nprobe, self.centroids.shape[0])
+
+        # 같은 cluster 의 문서 번호가 연속으로 놓이도록 정렬한 inverted list
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=self.centroids.shape[0]))])
+
+    def search(self, query_embedding, top_k):
+        query_embedding = F.normalize(query_embedding.detach().float().cpu(), dim=-1)
+        probe = torch.topk(self.centroids @ query_embedding, self.nprobe).indices.numpy()
+
+        candidates = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+        return rescore(self.embeddings, candidates, query_embedding, top_k, self.deleted)
+
+
+class QuantizedIndex:
+    def __init__(self, embeddings, codes, scales, device, rescore_candidates, chunk_size=65536, deleted=None):
+        self.embeddings = embeddings
+        self.deleted = deleted
+        self.deleted_on_device = None if deleted is None else torch.from_numpy(deleted).to(device)
+        self.codes = torch.from_numpy(codes).to(device)
+        self.scales = None if scales is None else torch.from_numpy(scales).to(device)
+        self.rescore_candidates = rescore_candidates
+        self.chunk_size = chunk_size
+
+        if self.scales is None:
+            self.popcount = torch.tensor([bin(value).count("1") for value in range(256)], dtype=torch.int16, device=device)
+
+    def search(self, query_embedding, top_k):
+        query_embedding = F.normalize(query_embedding.detach().float(), dim=-1).to(self.codes.device)
+        if self.scales is None:
+            # sign bit 끼리의 hamming 거리가 작을수록 가까운 문서
+            query_code = torch.from_numpy(np.packbits(query_embedding.cpu().numpy() > 0)).to(self.codes.device)
+            score = lambda chunk: -self.popcount[(chunk ^ query_code).long()].sum(dim=-1, dtype=torch.float32)
+        else:
+            scaled_query = query_embedding * self.scales
+            score = lambda chunk: chunk.float() @ scaled_query
+
+        # int8 -> float 변환이 코퍼스 전체 크기로 커지지 않도록 chunk 단위로 점수 계산
+        scores = torch.cat([score(self.codes[start:start + self.chunk_size]) for start in range(0, self.codes.shape[0], self.chunk_size)])
+        if self.deleted_on_device is not None:
+            scores = scores.masked_fill(self.deleted_on_device, float("-inf"))
+        candidates = torch.topk(scores, min(max(top_k, self.rescore_candidates), scores.shape[0])).indices.cpu().numpy()
+        return rescore(self.embeddings, candidates, query_embedding, top_k, self.deleted)
+
+
+def rescore(embeddings, candidates, query_embedding, top_k, deleted=None):
+    if deleted is not None:
+        candidates = candidates[~deleted[candidates]]
+    if len(candidates) == 0:
+        return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+
+    # 디스크 순서대로 읽도록 정렬한 뒤 후보 문서만 원래 정밀도로 코사인 유사도 계산
+    candidates = np.sort(candidates)
+    query_embedding = F.normalize(query_embedding.detach().float().cpu(), dim=-1)
+    vectors = F.normalize(torch.from_numpy(np.asarray(embeddings[candidates], dtype=np.float32)), dim=-1)
+    scores = vectors @ query_embedding
+
+    top_scores, top_positions = torch.topk(scores, min(top_k, len(candidates)))
+    return top_scores.numpy(), candidates[top_positions.numpy()]
+
+
+def build_index(embedding_store, index_type, device, ivf_nlist=1024, ivf_nprobe=16, rescore_candidates=200):
+    embeddings = embedding_store.embeddings()
+    deleted = embedding_store.deleted()
+
+    if index_type == "exact":
+        return ExactIndex(embeddings, device, embedding_store.manifest["normalize_embeddings"], deleted)
+
+    if index_type == "ivf":
+        # 학습된 centroid 는 처음 만든 store 기준으로 유지하고, 추가된 문서만 가까운 cluster 에 배정
+        nlist = max(1, min(ivf_nlist, embedding_store.base_count))
+        path = os.path.join(embedding_store.path, f"ivf_{nlist}")
+        if not os.path.exists(os.path.join(path, "index.json")):
+            centroids, assignments = train_ivf(embeddings, nlist)
+            save_ivf(path, centroids, assignments)
+
+        centroids = np.load(os.path.join(path, "centroids.npy"))
+        assignments = np.load(os.path.join(path, "assignments.npy"), mmap_mode="r")
+        if len(assignments) < embedding_store.count:
+            new_assignments = assign_ivf(embeddings, torch.from_numpy(centroids), start=len(assignments))
+            assignments = extend_index_array(path, "assignments.npy", assignments, new_assignments)
+        return IVFIndex(embeddings, centroids, assignments, ivf_nprobe, deleted)
+
+    if index_type in ("int8", "binary"):
+        path = os.path.join(embedding_store.path, index_type)
+        if not os.path.exists(os.path.join(path, "index.json")):
+            codes, scales = quantize(embeddings, index_type)
+            save_quantized(path, index_type, codes, scales)
+
+        codes = np.load(os.path.join(path, "codes.npy"))
+        scales = np.load(os.path.join(path, "scales.npy")) if index_type == "int8" else None
+        if len(codes) < embedding_store.count:
+            new_codes, _ = quantize(embeddings, index_type, scales=scales, start=len(codes))
+            codes = extend_index_array(path, "codes.npy", codes, new_codes)
+        return QuantizedIndex(embeddings, codes, scales, device, rescore_candidates, deleted=deleted)
+
+    raise ValueError(f"Unknown rag_index_type: {index_type}")
+
+
+def extend_index_array(path, name, array, new_rows):
+    array = np.concatenate([array, new_rows])
+
+    tmp_file = os.path.join(path, f"{name}.tmp-{os.getpid()}.npy")
+    np.save(tmp_file, array)
+    os.replace(tmp_file, os.path.join(path, name))
+
+    with open(os.path.join(path, "index.json"), "r", encoding="utf-8") as f:
+        info = json.load(f)
+    tmp_file = os.path.join(path, f"index.json.tmp-{os.getpid()}")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(dict(info, count=len(array)), f, indent=2)
+    os.replace(tmp_file, os.path.join(path, "index.json"))
+
+    return array
+
+
+def train_ivf(embeddings, nlist, niter=20, max_train_points_per_list=256, chunk_size=65536, seed=0):
+    generator = np.random.default_rng(seed)
+
+    num_train = min(len(embeddings), nlist * max_train_points_per_list)
+    train_ids = np.sort(generator.choice(len(embeddings), num_train, replace=False))
+    train = F.normalize(torch.from_numpy(np.asarray(embeddings[train_ids], dtype=np.float32)), dim=-1)
+
+    # 코사인 유사도 기준의 spherical k-means
+    centroids = train[torch.from_numpy(generator.choice(num_train, nlist, replace=False))]
+    for _ in range(niter):
+        assignments = (train @ centroids.T).argmax(dim=-1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, train)
+        counts = torch.bincount(assignments, minlength=nlist)
+
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = train[torch.from_numpy(generator.choice(num_train, int(empty.sum())))]
+        centroids = F.normalize(sums, dim=-1)
+
+    return centroids.numpy(), assign_ivf(embeddings, centroids, chunk_size=chunk_size)
+
+
+def assign_ivf(embeddings, centroids, start=0, chunk_size=65536):
+    assignments = np.empty(len(embeddings) - start, dtype=np.int32)
+    for offset in range(start, len(embeddings), chunk_size):
+        chunk = F.normalize(torch.from_numpy(np.asarray(embeddings[offset:offset + chunk_size], dtype=np.float32)), dim=-1)
+        assignments[offset - start:offset - start + chunk_size] = (chunk @ centroids.T).argmax(dim=-1).numpy()
+    return assignments
+
+
+def save_ivf(path, centroids, assignments):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+
+    np.save(os.path.join(tmp_path, "centroids.npy"), centroids)
+    np.save(os.path.join(tmp_path, "assignments.npy"), assignments)
+    with open(os.path.join(tmp_path, "index.json"), "w", encoding="utf-8") as f:
+        json.dump({"type": "ivf", "nlist": len(centroids), "count": len(assignments)}, f, indent=2)
+
+    os.replace(tmp_path, path)
+
+
+def quantize(embeddings, index_type, scales=None, start=0, chunk_size=65536):
+    chunks = lambda: (
+        F.normalize(torch.from_numpy(np.asarray(embeddings[offset:offset + chunk_size], dtype=np.float32)), dim=-1).numpy()
+        for offset in range(start, len(embeddings), chunk_size)
+        )
+
+    if index_type == "binary":
+        return np.concatenate([np.packbits(chunk > 0, axis=-1) for chunk in chunks()]), None
+
+    # 차원마다 최대 절대값을 127 에 맞추는 대칭 int8 양자화 (추가된 문서는 기존 scale 을 그대로 사용)
+    if scales is None:
+        max_abs = np.zeros(embeddings.shape[1], dtype=np.float32)
+        for chunk in chunks():
+            np.maximum(max_abs, np.abs(chunk).max(axis=0), out=max_abs)
+        scales = np.maximum(max_abs, 1e-12) / 127
+
+    codes = np.concatenate([np.clip(np.rint(chunk / scales), -127, 127).astype(np.int8) for chunk in chunks()])
+    return codes, scales
+
+
+def save_quantized(path, index_type, codes, scales):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+
+    np.save(os.path.join(tmp_path, "codes.npy"), codes)
+    if scales is not None:
+        np.save(os.path.join(tmp_path, "scales.npy"), scales)
+    with open(os.path.join(tmp_path, "index.json"), "w", encoding="utf-8") as f:
+        json.dump({"type": index_type, "count": len(codes)}, f, indent=2)
+
+    os.replace(tmp_path, path)
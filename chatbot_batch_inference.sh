@@ -0,0 +1,13 @@
+#Chatbot batch inference 실행
+
+python chatbot/batch_inference.py \
+   --chatbot_model_name_or_path google/gemma-2-2b-it \
+   --rag_embedder_name_or_path BAAI/bge-m3 \
+   --rag_collector_name_or_path CHOJW1004/maywell_ko_wikidata_QA_12800 \
+   --use_system_prompt False \
+   --input_path ./storage/eval/prompts.jsonl \
+   --output_path ./storage/eval/generations.jsonl \
+   --prompt_field instruction \
+   --use_rag False \
+   --batch_size 16 \
+   --max_new_tokens 512
\ No newline at end of file
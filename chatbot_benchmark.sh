@@ -0,0 +1,26 @@
+#Chatbot benchmark 실행
+
+# 작은 랜덤 모델과 합성 코퍼스로 CPU 에서 실행
+python chatbot/benchmark.py \
+   --output_dir ./storage/benchmark \
+   --use_synthetic_models True \
+   --num_users 8 \
+   --num_turns 4 \
+   --num_rag_queries 2 \
+   --message_words 16 \
+   --max_new_tokens 64 \
+   --seed 0
+
+"""
+# 실제 모델로 실행
+python chatbot/benchmark.py \
+   --output_dir ./storage/benchmark \
+   --use_synthetic_models False \
+   --chatbot_model_name_or_path google/gemma-2-2b-it \
+   --rag_embedder_name_or_path BAAI/bge-m3 \
+   --rag_collector_name_or_path CHOJW1004/maywell_ko_wikidata_QA_12800 \
+   --use_system_prompt False \
+   --num_users 8 \
+   --num_turns 4 \
+   --max_new_tokens 256
+"""
\ No newline at end of file
@@ -0,0 +1,18 @@
+#Chatbot RAG 코퍼스 임베딩 (길이 순 정렬 + 멀티 프로세스, 중단 시 남은 shard 부터 이어서 실행)
+
+# 모든 GPU 로 나눠서 인코딩
+python chatbot/encode_corpus.py \
+   --rag_embedder_name_or_path BAAI/bge-m3 \
+   --rag_collector_name_or_path CHOJW1004/maywell_ko_wikidata_QA_12800 \
+   --shard_size 50000 \
+   --encode_batch_size 64
+
+"""
+# CPU 노드에서 worker 4 개로 인코딩
+python chatbot/encode_corpus.py \
+   --rag_embedder_name_or_path BAAI/bge-m3 \
+   --rag_collector_name_or_path CHOJW1004/maywell_ko_wikidata_QA_12800 \
+   --shard_size 50000 \
+   --encode_batch_size 32 \
+   --encode_devices cpu,cpu,cpu,cpu
+"""
\ No newline at end of file
@@ -0,0 +1,10 @@
+#Chatbot HTTP API 실행
+
+python chatbot/http_api.py \
+   --chatbot_model_name_or_path google/gemma-2-2b-it \
+   --rag_embedder_name_or_path BAAI/bge-m3 \
+   --rag_collector_name_or_path CHOJW1004/maywell_ko_wikidata_QA_12800 \
+   --use_system_prompt False \
+   --use_batch_scheduler True \
+   --http_api_host 127.0.0.1 \
+   --http_api_port 8000
\ No newline at end of file
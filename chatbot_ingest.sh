@@ -0,0 +1,9 @@
+#Chatbot RAG 코퍼스 증분 업데이트 (실행 중인 챗봇은 rag_reload_interval_seconds 마다 새 버전을 읽음)
+
+python chatbot/ingest.py \
+   --rag_embedder_name_or_path BAAI/bge-m3 \
+   --rag_collector_name_or_path CHOJW1004/maywell_ko_wikidata_QA_12800 \
+   --input_path ./storage/rag/updates.jsonl \
+   --id_field id \
+   --text_field output \
+   --delete_field deleted
\ No newline at end of file
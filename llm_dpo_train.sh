@@ -4,6 +4,7 @@
 python llm_dpo_trainer/train.py \
    --use_qlora False \
    --gradient_checkpointing False \
+   --use_chunked_loss False \
    --data_name_or_path xinlai/Math-Step-DPO-10K \
    --model_name_or_path google/gemma-2-2b-it \
    --attention_implementation eager \
@@ -17,6 +18,7 @@ python llm_dpo_trainer/train.py \
    --warmup_steps 0 \
    --learning_rate 0.00001 \
    --weight_decay 0.0 \
+   --log_training_metrics False \
    --mixed_precision bf16 \
 
 """
@@ -24,6 +26,7 @@ python llm_dpo_trainer/train.py \
 python step2_dpo_trainer/train.py \
    --use_qlora False \
    --gradient_checkpointing False \
+   --use_chunked_loss False \
    --data_name_or_path xinlai/Math-Step-DPO-10K \
    --model_name_or_path meta-llama/Meta-Llama-3.1-8B-Instruct \
    --output_dir ./storage/trained_dpo_models \
@@ -35,5 +38,6 @@ python step2_dpo_trainer/train.py \
    --warmup_steps 0 \
    --learning_rate 0.00001 \
    --weight_decay 0.0 \
+   --log_training_metrics False \
    --mixed_precision bf16 \
 """
\ No newline at end of file
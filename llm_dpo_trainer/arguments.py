@@ -12,6 +12,14 @@ class TrainingModeArguments:
         default=False,
         metadata={"help": "Whether to use gradient checkpointing to save memory."}
     )
+    use_chunked_loss: bool = field(
+        default=False,
+        metadata={"help": "Whether to compute the LM head and the loss in chunks of tokens so the full [batch, seq, vocab] logits are never materialized."}
+    )
+    loss_chunk_size: int = field(
+        default=1024,
+        metadata={"help": "Number of tokens per chunk when use_chunked_loss is True."}
+    )
 
 @dataclass
 class ModelArguments:
@@ -84,6 +92,14 @@ class TrainingArguments:
         default="bf16",
         metadata={"help": "Whether to use mixed precision training ('fp16', 'bf16'). Default is None."}
     )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={"help": "If set, batches are formed from pairs of similar length up to this many (padded) chosen + rejected tokens instead of per_device_train_batch_size rows."}
+    )
+    log_training_metrics: bool = field(
+        default=False,
+        metadata={"help": "Record tokens/sec, dataloader wait, compute and optimizer step time and peak memory (and the reference forward time) per logging step to training_metrics.jsonl in output_dir."}
+    )
     loss_type : Optional[str] = field(
         default="sigmoid",
         metadata={"help": "Type of loss function to use. Options are 'sigmoid', 'hinge', etc."}
@@ -1,6 +1,8 @@
 from functools import partial
 
 import json
+import os
+import sys
 from arguments import parse_args
 from dataclasses import asdict
 
@@ -9,7 +11,9 @@ from rich.panel import Panel
 from rich.align import Align
 from rich.pretty import Pretty
 
+import numpy as np
 import torch
+import pyarrow.compute as pc
 
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers import BitsAndBytesConfig
@@ -20,6 +24,10 @@ from datasets import Dataset, load_dataset
 
 from prompter import Prompter
 
+# SFT 와 DPO 가 같이 쓰는 모듈은 저장소 루트의 utils 에 하나만 둠
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import token_batching, chunked_loss, training_metrics
+
 def main():
 
     args = parse_args()
@@ -41,6 +49,8 @@ def main():
 
     use_qlora = training_mode_args.use_qlora
     gradient_checkpointing = training_mode_args.gradient_checkpointing
+    max_tokens_per_batch = training_args.max_tokens_per_batch
+    log_training_metrics = training_args.log_training_metrics
     training_args = DPOConfig(
         output_dir=training_args.output_dir,
         save_strategy=training_args.save_strategy,
@@ -109,14 +119,17 @@ def main():
 
     train_ds = formatting_prompts_func(train_ds, user_template, assistant_template)
 
-    trainer = DPOTrainer(
+    trainer = EfficientDPOTrainer(
         model=model,
         ref_model=None,
         peft_config=peft_config,
         beta=0.1,
         args=training_args,
         train_dataset=train_ds,
-        tokenizer=tokenizer
+        tokenizer=tokenizer,
+        max_tokens_per_batch=max_tokens_per_batch,
+        loss_chunk_size=training_mode_args.loss_chunk_size if training_mode_args.use_chunked_loss is True else None,
+        log_training_metrics=log_training_metrics
         )
 
     print_args(user_template, assistant_template, training_mode_args, model_args, lora_args, training_args)
@@ -126,6 +139,72 @@ def main():
     print_result()
 
 
+class EfficientDPOTrainer(DPOTrainer):
+    def __init__(self, *args, max_tokens_per_batch=None, loss_chunk_size=None, log_training_metrics=False, **kwargs):
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.loss_chunk_size = loss_chunk_size
+        super().__init__(*args, **kwargs)
+        if max_tokens_per_batch is not None:
+            self.add_callback(token_batching.PaddingEfficiencyCallback(self))
+        if log_training_metrics is True:
+            self.add_callback(training_metrics.TrainingMetricsCallback(self))
+
+    def get_train_dataloader(self):
+        dataloader = super().get_train_dataloader()
+        if self.max_tokens_per_batch is None:
+            return dataloader
+
+        # chosen 과 rejected 는 한 batch 로 이어 붙여서 둘 중 긴 쪽 길이로 padding 되므로 예제 하나를 2 행으로 계산
+        columns = self.train_dataset.with_format("arrow")[:]
+        chosen_lengths = pc.list_value_length(columns["chosen_input_ids"]).to_numpy()
+        rejected_lengths = pc.list_value_length(columns["rejected_input_ids"]).to_numpy()
+        return token_batching.token_budget_dataloader(
+            self,
+            np.maximum(chosen_lengths, rejected_lengths),
+            self.max_tokens_per_batch,
+            rows_per_example=2,
+            real_lengths=chosen_lengths + rejected_lengths
+            )
+
+    def concatenated_forward(self, model, batch):
+        if self.loss_chunk_size is None or self.is_encoder_decoder or self.is_vision_model or self.aux_loss_enabled:
+            return super().concatenated_forward(model, batch)
+
+        concatenated_batch = self.concatenated_inputs(
+            batch,
+            is_encoder_decoder=False,
+            is_vision_model=False,
+            label_pad_token_id=self.label_pad_token_id,
+            padding_value=self.padding_value,
+            device=self.accelerator.device
+            )
+        len_chosen = batch["chosen_labels"].shape[0]
+
+        per_token_logps, mask, mean_logits, _ = chunked_loss.chunked_causal_lm_logps(
+            model,
+            self.accelerator.unwrap_model(model),
+            {"input_ids": concatenated_batch["concatenated_input_ids"], "attention_mask": concatenated_batch["concatenated_attention_mask"]},
+            concatenated_batch["concatenated_labels"],
+            chunk_size=self.loss_chunk_size,
+            ignore_index=self.label_pad_token_id
+            )
+
+        all_logps = per_token_logps.sum(-1)
+        size_completion = mask.sum(-1)
+        # DPOTrainer 와 같이 chosen 응답의 토큰 평균 cross entropy 를 nll loss 로 사용
+        nll_loss = -per_token_logps[:len_chosen].sum() / size_completion[:len_chosen].sum().clamp(min=1)
+
+        if self.loss_type == "ipo":
+            all_logps = all_logps / size_completion
+
+        # 전체 logits 는 만들지 않으므로 logits 지표는 응답 토큰의 vocab 평균 logit 으로 대신함
+        row_ids = mask.nonzero()[:, 0]
+        chosen_logits = mean_logits[row_ids < len_chosen]
+        rejected_logits = mean_logits[row_ids >= len_chosen]
+
+        return (all_logps[:len_chosen], all_logps[len_chosen:], chosen_logits, rejected_logits, nll_loss)
+
+
 def formatting_prompts_func(example, user_template, assistant_template):
 
     format_item = lambda inst, chosen, rejected: {
@@ -5,6 +5,7 @@ python llm_sft_trainer/train.py \
    --use_lora True \
    --use_qlora False \
    --gradient_checkpointing False \
+   --use_chunked_loss False \
    --data_name_or_path maywell/ko_wikidata_QA \
    --model_name_or_path google/gemma-2-2b-it \
    --attention_implementation eager \
@@ -18,7 +19,14 @@ python llm_sft_trainer/train.py \
    --warmup_steps 0 \
    --learning_rate 0.00001 \
    --weight_decay 0.0 \
-   --mixed_precision bf16
+   --mixed_precision bf16 \
+   --max_seq_length 2048 \
+   --use_packing False \
+   --dataset_cache_dir ./storage/sft_dataset_cache \
+   --preprocessing_num_workers 8 \
+   --use_streaming False \
+   --shuffle_buffer_size 10000 \
+   --log_training_metrics False
 
 """
 # Llama-3.1 train set
@@ -26,6 +34,7 @@ python step1_sft_trainer/train.py \
    --use_lora True \
    --use_qlora False \
    --gradient_checkpointing False \
+   --use_chunked_loss False \
    --data_name_or_path maywell/ko_wikidata_QA \
    --model_name_or_path meta-llama/Meta-Llama-3.1-8B-Instruct \
    --output_dir ./storage/trained_sft_models \
@@ -37,5 +46,12 @@ python step1_sft_trainer/train.py \
    --warmup_steps 0 \
    --learning_rate 0.00001 \
    --weight_decay 0.0 \
-   --mixed_precision bf16
+   --mixed_precision bf16 \
+   --max_seq_length 2048 \
+   --use_packing False \
+   --dataset_cache_dir ./storage/sft_dataset_cache \
+   --preprocessing_num_workers 8 \
+   --use_streaming False \
+   --shuffle_buffer_size 10000 \
+   --log_training_metrics False
 """
\ No newline at end of file
@@ -16,6 +16,14 @@ class TrainingModeArguments:
         default=False,
         metadata={"help": "Whether to use gradient checkpointing to save memory."}
     )
+    use_chunked_loss: bool = field(
+        default=False,
+        metadata={"help": "Whether to compute the LM head and the loss in chunks of tokens so the full [batch, seq, vocab] logits are never materialized."}
+    )
+    loss_chunk_size: int = field(
+        default=1024,
+        metadata={"help": "Number of tokens per chunk when use_chunked_loss is True."}
+    )
 
 @dataclass
 class ModelArguments:
@@ -56,6 +64,10 @@ class TrainingArguments:
         default=1,
         metadata={"help": "Total number of training epochs to perform."}
     )
+    max_steps: int = field(
+        default=-1,
+        metadata={"help": "If > 0, total number of training steps to perform. Overrides num_train_epochs and is required when use_streaming is True."}
+    )
     logging_steps: int = field(
         default=1,
         metadata={"help": "Log every X updates steps."}
@@ -84,6 +96,42 @@ class TrainingArguments:
         default="bf16",
         metadata={"help": "Whether to use mixed precision training ('fp16', 'bf16'). Default is None."}
     )
+    max_seq_length: int = field(
+        default=2048,
+        metadata={"help": "Maximum number of tokens per training sequence (per packed window when use_packing is True)."}
+    )
+    use_packing: bool = field(
+        default=False,
+        metadata={"help": "Whether to pack several examples into each max_seq_length window. Position ids and attention are reset at example boundaries and only the responses are trained on."}
+    )
+    max_tokens_per_batch: Optional[int] = field(
+        default=None,
+        metadata={"help": "If set, batches are formed from examples of similar length up to this many (padded) tokens instead of per_device_train_batch_size rows."}
+    )
+    dataset_cache_dir: str = field(
+        default="./storage/sft_dataset_cache",
+        metadata={"help": "Directory where the tokenized (and packed) dataset is saved, keyed by the dataset, tokenizer, chat template, prompt and max_seq_length."}
+    )
+    preprocessing_num_workers: Optional[int] = field(
+        default=None,
+        metadata={"help": "Number of processes used to tokenize the dataset. Defaults to a single process."}
+    )
+    use_streaming: bool = field(
+        default=False,
+        metadata={"help": "Whether to stream the dataset and tokenize (and pack) it on the fly instead of downloading and preprocessing it in full."}
+    )
+    shuffle_buffer_size: int = field(
+        default=10000,
+        metadata={"help": "Number of examples kept in memory for shuffling when use_streaming is True."}
+    )
+    resume_from_checkpoint: Optional[str] = field(
+        default=None,
+        metadata={"help": "Checkpoint directory to resume training from. Streaming runs also resume from the saved stream position."}
+    )
+    log_training_metrics: bool = field(
+        default=False,
+        metadata={"help": "Record tokens/sec, dataloader wait, compute and optimizer step time and peak memory per logging step to training_metrics.jsonl in output_dir."}
+    )
 
 @dataclass
 class LoRAArguments:
@@ -0,0 +1,77 @@
+import torch
+
+
+def pack_examples(examples, max_seq_length):
+    # 긴 예제부터 남은 공간이 가장 적은 window 에 넣어서 (best-fit decreasing) window 당 padding 을 줄임
+    order = sorted(range(len(examples["input_ids"])), key=lambda idx: len(examples["input_ids"][idx]), reverse=True)
+    windows = []
+    for idx in order:
+        length = len(examples["input_ids"][idx])
+        best = None
+        for window in windows:
+            if window["length"] + length <= max_seq_length and (best is None or window["length"] > best["length"]):
+                best = window
+        if best is None:
+            best = {"length": 0, "indices": []}
+            windows.append(best)
+        best["length"] += length
+        best["indices"].append(idx)
+
+    packed = {"input_ids": [], "labels": [], "position_ids": []}
+    for window in windows:
+        input_ids, labels, position_ids = [], [], []
+        for idx in window["indices"]:
+            input_ids += examples["input_ids"][idx]
+            labels += examples["labels"][idx]
+            # 예제 경계마다 position id 를 0 부터 다시 시작
+            position_ids += list(range(len(examples["input_ids"][idx])))
+        packed["input_ids"].append(input_ids)
+        packed["labels"].append(labels)
+        packed["position_ids"].append(position_ids)
+    return packed
+
+
+def pack_dataset(tokenized, max_seq_length, num_proc=None):
+    return tokenized.map(
+        pack_examples,
+        batched=True,
+        batch_size=1000,
+        num_proc=num_proc,
+        remove_columns=tokenized.column_names,
+        desc="Packing",
+        fn_kwargs={"max_seq_length": max_seq_length}
+        )
+
+
+class PackedDataCollator:
+    def __init__(self, pad_token_id, attn_implementation, mask_dtype=torch.float32):
+        self.pad_token_id = pad_token_id
+        self.use_position_ids_only = attn_implementation == "flash_attention_2"
+        self.mask_dtype = mask_dtype
+
+    def __call__(self, features):
+        max_length = max(len(feature["input_ids"]) for feature in features)
+
+        input_ids = torch.full((len(features), max_length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(features), max_length), -100, dtype=torch.long)
+        # padding 도 position 0 부터 시작하는 별도 구간으로 취급
+        position_ids = torch.arange(max_length).repeat(len(features), 1)
+        for row, feature in enumerate(features):
+            length = len(feature["input_ids"])
+            input_ids[row, :length] = torch.tensor(feature["input_ids"])
+            labels[row, :length] = torch.tensor(feature["labels"])
+            position_ids[row, :length] = torch.tensor(feature["position_ids"])
+            position_ids[row, length:] = torch.arange(max_length - length)
+
+        batch = {"input_ids": input_ids, "labels": labels, "position_ids": position_ids}
+        if self.use_position_ids_only:
+            # flash attention 2 는 position_ids 가 0 으로 돌아가는 지점을 경계로 varlen attention 을 실행
+            return batch
+
+        # eager / sdpa 는 예제끼리 보지 못하도록 block diagonal causal mask 를 직접 넘김
+        segment_ids = (position_ids == 0).cumsum(dim=-1)
+        causal = torch.ones(max_length, max_length, dtype=torch.bool).tril()
+        allowed = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal
+        attention_mask = torch.zeros(allowed.shape, dtype=self.mask_dtype).masked_fill(~allowed, torch.finfo(self.mask_dtype).min)
+        batch["attention_mask"] = attention_mask[:, None, :, :]
+        return batch
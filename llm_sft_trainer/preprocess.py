@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import shutil
+
+import torch
+
+from datasets import load_from_disk
+
+from packing import pack_dataset
+
+
+PREPROCESS_VERSION = "response-offsets-v1"
+
+
+def tokenize_examples(examples, tokenizer, generated_prompt, max_seq_length):
+    texts = list(map(lambda inst, out: generated_prompt.format(instruction=inst, output=out),
+                     examples['instruction'],
+                     examples['output']))
+    # 응답은 포맷된 문자열에서 {output} 이 들어간 위치부터 시작하므로 토큰을 다시 검색하지 않고 문자 위치로 구분
+    prompt_head = generated_prompt.split("{output}", 1)[0]
+    response_starts = [len(prompt_head.format(instruction=inst)) for inst in examples['instruction']]
+
+    encodings = tokenizer(texts, truncation=True, max_length=max_seq_length, return_offsets_mapping=True)
+
+    # 응답 시작 이후의 글자를 포함하는 토큰 (응답과 turn 종료 토큰) 만 loss 에 포함
+    labels = []
+    for ids, offsets, response_start in zip(encodings["input_ids"], encodings["offset_mapping"], response_starts):
+        labels.append([token_id if end > response_start else -100 for token_id, (_, end) in zip(ids, offsets)])
+
+    return {"input_ids": encodings["input_ids"], "labels": labels}
+
+
+def tokenizer_fingerprint(tokenizer):
+    # fast tokenizer 는 vocab / merge / normalizer 전체를 직렬화해서 비교
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    content = backend.to_str() if backend is not None else json.dumps([tokenizer.name_or_path, len(tokenizer)])
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def preprocess_key(dataset, tokenizer, generated_prompt, max_seq_length, use_packing):
+    key = json.dumps([
+        PREPROCESS_VERSION,
+        dataset._fingerprint,
+        tokenizer_fingerprint(tokenizer),
+        tokenizer.chat_template,
+        generated_prompt,
+        max_seq_length,
+        use_packing
+        ], ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def load_or_preprocess_dataset(dataset, tokenizer, generated_prompt, max_seq_length, use_packing, cache_dir, num_proc=None):
+    # 시스템 프롬프트는 generated_prompt 에 포함되어 있으므로 key 에 같이 반영됨
+    path = os.path.join(cache_dir, "sft-" + preprocess_key(dataset, tokenizer, generated_prompt, max_seq_length, use_packing))
+    if os.path.exists(os.path.join(path, "dataset_info.json")):
+        return load_from_disk(path)
+
+    tokenized = dataset.map(
+        tokenize_examples,
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=dataset.column_names,
+        desc="Tokenizing",
+        fn_kwargs={
+            "tokenizer": tokenizer,
+            "generated_prompt": generated_prompt,
+            "max_seq_length": max_seq_length
+            }
+        )
+    if use_packing is True:
+        tokenized = pack_dataset(tokenized, max_seq_length, num_proc=num_proc)
+
+    # 완성된 디렉토리만 최종 경로로 옮겨서 중단된 전처리가 캐시로 읽히지 않도록 함
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tokenized.save_to_disk(tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # 다른 프로세스가 먼저 같은 캐시를 만든 경우
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return load_from_disk(path)
+
+
+class PaddingDataCollator:
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, features):
+        max_length = max(len(feature["input_ids"]) for feature in features)
+
+        input_ids = torch.full((len(features), max_length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(features), max_length), -100, dtype=torch.long)
+        attention_mask = torch.zeros((len(features), max_length), dtype=torch.long)
+        for row, feature in enumerate(features):
+            length = len(feature["input_ids"])
+            input_ids[row, :length] = torch.tensor(feature["input_ids"])
+            labels[row, :length] = torch.tensor(feature["labels"])
+            attention_mask[row, :length] = 1
+
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
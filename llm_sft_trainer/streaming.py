@@ -0,0 +1,112 @@
+import json
+import os
+from collections import deque
+
+from torch.utils.data import IterableDataset
+from transformers import TrainerCallback
+
+from packing import pack_examples
+from preprocess import tokenize_examples
+
+
+STREAM_STATE_NAME = "stream_state.json"
+
+
+class StreamingSFTDataset(IterableDataset):
+    def __init__(self, dataset, tokenizer, generated_prompt, max_seq_length, use_packing, shuffle_buffer_size, seed=42, group_size=1000):
+        self.dataset = dataset
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.tokenizer = tokenizer
+        self.generated_prompt = generated_prompt
+        self.max_seq_length = max_seq_length
+        self.use_packing = use_packing
+        self.group_size = group_size
+        self.base_epoch = 0
+        self.epoch = 0
+        self.start_state = None
+        self.rows_yielded = 0
+        # dataloader 가 학습보다 몇 batch 앞서 읽으므로 최근 행마다 원본 stream 의 위치를 기록해 둠
+        self.snapshots = deque(maxlen=max(10000, group_size * 4))
+
+    def set_epoch(self, epoch):
+        # Trainer 는 재개해도 epoch 를 0 부터 다시 세므로 checkpoint 의 epoch 에 더해서 씀
+        self.epoch = self.base_epoch + epoch
+
+    def stream(self):
+        # 전체를 내려받지 않고 shuffle_buffer_size 개씩만 메모리에 두고 섞음 (epoch 마다 다른 순서)
+        dataset = self.dataset.shuffle(seed=self.seed, buffer_size=self.shuffle_buffer_size)
+        dataset.set_epoch(self.epoch)
+        # 저장된 stream 위치는 재개한 epoch 에만 적용하고 다음 epoch 는 처음부터 읽음
+        if self.start_state is not None and self.epoch == self.base_epoch:
+            dataset.load_state_dict(self.start_state)
+        return dataset
+
+    def groups(self):
+        dataset = self.stream()
+        examples, states = {}, []
+        for example in dataset:
+            for key, value in example.items():
+                examples.setdefault(key, []).append(value)
+            states.append(dataset.state_dict())
+            if len(states) == self.group_size:
+                yield examples, states
+                examples, states = {}, []
+        if states:
+            yield examples, states
+
+    def __iter__(self):
+        for examples, states in self.groups():
+            tokenized = tokenize_examples(examples, self.tokenizer, self.generated_prompt, self.max_seq_length)
+            if self.use_packing is True:
+                # group 단위로 packing 하므로 group 안의 모든 window 는 group 을 다 읽은 위치에서 재개
+                tokenized = pack_examples(tokenized, self.max_seq_length)
+                states = [states[-1]] * len(tokenized["input_ids"])
+
+            for idx, state in enumerate(states):
+                self.rows_yielded += 1
+                self.snapshots.append((self.rows_yielded, self.epoch, state))
+                yield {key: values[idx] for key, values in tokenized.items()}
+
+        # stream 을 끝까지 읽은 뒤에 저장하면 다음 epoch 처음부터 재개
+        self.snapshots.append((self.rows_yielded, self.epoch + 1, None))
+
+    def state_at(self, rows_consumed):
+        for rows, epoch, state in reversed(self.snapshots):
+            if rows <= rows_consumed:
+                return {"rows": rows, "epoch": epoch, "dataset": state}
+        return None
+
+    def load_state_dict(self, state):
+        self.base_epoch = state["epoch"]
+        self.epoch = state["epoch"]
+        self.start_state = state["dataset"]
+        self.rows_yielded = state["rows"]
+
+
+class StreamStateCallback(TrainerCallback):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def on_save(self, args, state, control, **kwargs):
+        if not state.is_world_process_zero:
+            return
+
+        # 학습에 실제로 들어간 행 수 기준으로 stream 위치를 저장해서 재개할 때 같은 데이터를 다시 보지 않음
+        rows_consumed = state.global_step * args.gradient_accumulation_steps * args.per_device_train_batch_size * args.world_size
+        stream_state = self.dataset.state_at(rows_consumed)
+        if stream_state is None:
+            return
+
+        checkpoint_dir = os.path.join(args.output_dir, f"checkpoint-{state.global_step}")
+        with open(os.path.join(checkpoint_dir, STREAM_STATE_NAME), "w", encoding="utf-8") as f:
+            json.dump(stream_state, f)
+
+
+def load_stream_state(dataset, checkpoint_dir):
+    path = os.path.join(checkpoint_dir, STREAM_STATE_NAME)
+    if not os.path.exists(path):
+        raise ValueError(f"{checkpoint_dir} has no {STREAM_STATE_NAME}. It was not saved by a streaming run.")
+
+    with open(path, "r", encoding="utf-8") as f:
+        dataset.load_state_dict(json.load(f))
@@ -1,4 +1,6 @@
 import json
+import os
+import sys
 from arguments import parse_args
 from dataclasses import asdict
 
@@ -8,15 +10,23 @@ from rich.align import Align
 from rich.pretty import Pretty
 
 import torch
+import pyarrow.compute as pc
 
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers import BitsAndBytesConfig
 from peft import LoraConfig, get_peft_model
-from trl import SFTTrainer, SFTConfig, DataCollatorForCompletionOnlyLM
+from trl import SFTTrainer, SFTConfig
 
 from datasets import load_dataset
 
 from prompter import Prompter
+from packing import PackedDataCollator
+from preprocess import PaddingDataCollator, load_or_preprocess_dataset
+from streaming import StreamingSFTDataset, StreamStateCallback, load_stream_state
+
+# SFT 와 DPO 가 같이 쓰는 모듈은 저장소 루트의 utils 에 하나만 둠
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import token_batching, chunked_loss, training_metrics
 
 def main():
 
@@ -35,16 +45,34 @@ def main():
     model_name_or_path = model_args.model_name_or_path
     data_name_or_path = model_args.data_name_or_path
     attn_implementation = model_args.attention_implementation
-    train_ds = load_dataset(data_name_or_path)['train']
 
     use_lora = training_mode_args.use_lora
     use_qlora = training_mode_args.use_qlora
     gradient_checkpointing = training_mode_args.gradient_checkpointing
+    use_packing = training_args.use_packing
+    max_seq_length = training_args.max_seq_length
+    dataset_cache_dir = training_args.dataset_cache_dir
+    preprocessing_num_workers = training_args.preprocessing_num_workers
+    max_tokens_per_batch = training_args.max_tokens_per_batch
+    use_streaming = training_args.use_streaming
+    shuffle_buffer_size = training_args.shuffle_buffer_size
+    resume_from_checkpoint = training_args.resume_from_checkpoint
+    log_training_metrics = training_args.log_training_metrics
+
+    # streaming 은 전체 길이를 모르므로 epoch 대신 step 수로 학습량을 정함
+    if use_streaming is True and training_args.max_steps <= 0:
+        raise ValueError("--use_streaming True requires --max_steps > 0.")
+    if use_streaming is True and max_tokens_per_batch is not None:
+        raise ValueError("--max_tokens_per_batch needs the length of every example and can't be used with --use_streaming True.")
+
+    train_ds = load_dataset(data_name_or_path, streaming=use_streaming)['train']
+
     training_args = SFTConfig(
         output_dir=training_args.output_dir,
         save_strategy=training_args.save_strategy,
         save_steps=training_args.save_steps,
         num_train_epochs=training_args.num_train_epochs,
+        max_steps=training_args.max_steps,
         logging_steps=training_args.logging_steps,
         per_device_train_batch_size=training_args.per_device_train_batch_size,
         gradient_accumulation_steps=training_args.gradient_accumulation_steps,
@@ -55,8 +83,11 @@ def main():
         lr_scheduler_type="cosine",
         bf16=True if training_args.mixed_precision == 'bf16' else None,
         fp16=True if training_args.mixed_precision == 'fp16' else None,
-        max_seq_length=2048,
-        save_only_model=True
+        max_seq_length=max_seq_length,
+        # streaming 은 optimizer 상태까지 저장해야 중간부터 이어서 학습할 수 있음
+        save_only_model=True if use_streaming is False else False,
+        # 재개할 때 지난 batch 들을 다시 읽어서 건너뛰지 않고 저장된 stream 위치에서 바로 시작
+        ignore_data_skip=use_streaming
         )
     
     if use_lora == True or use_qlora == True:
@@ -95,7 +126,7 @@ def main():
     tokenizer.deprecation_warnings["Asking-to-pad-a-fast-tokenizer"]=True
 
     prompter = Prompter()
-    generated_prompt, response_template= prompter.prompt_generator(tokenizer=tokenizer, use_system_prompt=use_system_prompt)
+    generated_prompt, _ = prompter.prompt_generator(tokenizer=tokenizer, use_system_prompt=use_system_prompt)
 
     if use_system_prompt is True:
         generated_prompt = generated_prompt.format(system=system_prompt, instruction="{instruction}", output="{output}")
@@ -103,31 +134,86 @@ def main():
     if use_lora == True or use_qlora == True:
         model = get_peft_model(model, lora_config)
 
-    data_collator = DataCollatorForCompletionOnlyLM(
-        response_template=response_template,
-        tokenizer=tokenizer, mlm=False
-        )
+    # transformers 4.44 의 Gemma2 flash attention 2 는 position_ids 를 넘기지 않아서 예제 경계를 알 수 없음
+    if use_packing is True and attn_implementation == "flash_attention_2" and model.config.model_type == "gemma2":
+        raise ValueError("Packing with gemma2 requires --attention_implementation eager or sdpa.")
+
+    if use_streaming is True:
+        # 읽어오는 대로 토큰화 (와 packing) 해서 바로 학습에 넘김
+        train_ds = StreamingSFTDataset(
+            train_ds,
+            tokenizer,
+            generated_prompt,
+            max_seq_length,
+            use_packing,
+            shuffle_buffer_size,
+            seed=training_args.seed
+            )
+        if resume_from_checkpoint is not None:
+            load_stream_state(train_ds, resume_from_checkpoint)
+    else:
+        # 토큰화와 label mask 는 한 번만 계산해서 저장하고, 같은 설정으로 다시 실행하면 바로 불러옴
+        train_ds = load_or_preprocess_dataset(
+            train_ds,
+            tokenizer,
+            generated_prompt,
+            max_seq_length,
+            use_packing,
+            dataset_cache_dir,
+            num_proc=preprocessing_num_workers
+            )
 
-    trainer = SFTTrainer(
+    if use_packing is True:
+        data_collator = PackedDataCollator(
+            pad_token_id=tokenizer.pad_token_id,
+            attn_implementation=attn_implementation,
+            mask_dtype=model.get_input_embeddings().weight.dtype
+            )
+    else:
+        data_collator = PaddingDataCollator(pad_token_id=tokenizer.pad_token_id)
+
+    trainer = EfficientSFTTrainer(
         model=model,
         args=training_args,
         train_dataset=train_ds,
-        formatting_func=lambda example: formatting_prompts_func(example, generated_prompt=generated_prompt),
-        data_collator=data_collator
+        data_collator=data_collator,
+        max_tokens_per_batch=max_tokens_per_batch,
+        loss_chunk_size=training_mode_args.loss_chunk_size if training_mode_args.use_chunked_loss is True else None,
+        log_training_metrics=log_training_metrics
         )
     
     print_args(generated_prompt, training_mode_args, model_args, lora_args, training_args)
 
-    trainer.train()
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
 
     print_result()
 
 
-def formatting_prompts_func(example, generated_prompt):
-    output_texts = list(map(lambda inst, out: generated_prompt.format(instruction=inst, output=out), 
-                            example['instruction'], 
-                            example['output']))
-    return output_texts
+class EfficientSFTTrainer(SFTTrainer):
+    def __init__(self, *args, max_tokens_per_batch=None, loss_chunk_size=None, log_training_metrics=False, **kwargs):
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.loss_chunk_size = loss_chunk_size
+        super().__init__(*args, **kwargs)
+        if max_tokens_per_batch is not None:
+            self.add_callback(token_batching.PaddingEfficiencyCallback(self))
+        if isinstance(self.train_dataset, StreamingSFTDataset):
+            self.add_callback(StreamStateCallback(self.train_dataset))
+        if log_training_metrics is True:
+            self.add_callback(training_metrics.TrainingMetricsCallback(self))
+
+    def get_train_dataloader(self):
+        if self.max_tokens_per_batch is None:
+            return super().get_train_dataloader()
+
+        lengths = pc.list_value_length(self.train_dataset.with_format("arrow")["input_ids"]).to_numpy()
+        return token_batching.token_budget_dataloader(self, lengths, self.max_tokens_per_batch)
+
+    def compute_loss(self, model, inputs, return_outputs=False):
+        if self.loss_chunk_size is None:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs)
+
+        loss, outputs = chunked_loss.chunked_causal_lm_loss(model, self.accelerator.unwrap_model(model), inputs, self.loss_chunk_size)
+        return (loss, outputs) if return_outputs else loss
 
 
 def print_args(generated_prompt, training_mode_args, model_args, lora_args, training_args):
@@ -1,3 +1,6 @@
+import importlib.util
+import os
+
 from dataclasses import dataclass, field
 from transformers import HfArgumentParser
 
@@ -14,7 +17,64 @@ class MergeLoraArguments:
         metadata={"help": "The directory where the merged model will be saved."}
     )
 
+@dataclass
+class MemoryPlannerArguments:
+    trainer: str = field(
+        default="sft",
+        metadata={"help": "Which trainer's arguments to plan for ('sft' or 'dpo'). The remaining arguments are the same as the trainer's train.py."}
+    )
+    gpu_memory_gb: float = field(
+        default=80.0,
+        metadata={"help": "Memory of one GPU in GB."}
+    )
+    memory_headroom: float = field(
+        default=0.15,
+        metadata={"help": "Fraction of gpu_memory_gb kept free for the CUDA context and allocator fragmentation."}
+    )
+    seq_lengths: str = field(
+        default="512,1024,2048,4096,8192",
+        metadata={"help": "Comma separated sequence lengths to recommend batch sizes for."}
+    )
+    max_batch_size: int = field(
+        default=64,
+        metadata={"help": "Largest per-device batch size considered in the recommendations."}
+    )
+    validate: bool = field(
+        default=False,
+        metadata={"help": "Whether to check the estimates against tiny CPU models of the same architecture before planning."}
+    )
+    validate_tolerance: float = field(
+        default=0.05,
+        metadata={"help": "Largest allowed |estimated - measured| / measured activation error. Validation exits with status 1 above it."}
+    )
+
 def merge_lora_parse_args():
     parser = HfArgumentParser(MergeLoraArguments)
 
-    return parser.parse_args_into_dataclasses()
\ No newline at end of file
+    return parser.parse_args_into_dataclasses()
+
+def load_trainer_arguments(trainer):
+    # 두 trainer 모두 arguments.py 라는 이름이라서 경로로 직접 불러옴
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", f"llm_{trainer}_trainer", "arguments.py")
+    spec = importlib.util.spec_from_file_location(f"llm_{trainer}_trainer_arguments", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def memory_planner_parse_args():
+    parser = HfArgumentParser(MemoryPlannerArguments)
+    planner_args, remaining_args = parser.parse_args_into_dataclasses(return_remaining_strings=True)
+
+    if planner_args.trainer not in ("sft", "dpo"):
+        raise ValueError("--trainer must be 'sft' or 'dpo'.")
+
+    # 나머지 인자는 학습 스크립트와 같은 dataclass 로 해석해서 학습 명령어를 그대로 넘길 수 있게 함
+    trainer_arguments = load_trainer_arguments(planner_args.trainer)
+    trainer_parser = HfArgumentParser((
+        trainer_arguments.TrainingModeArguments,
+        trainer_arguments.ModelArguments,
+        trainer_arguments.LoRAArguments,
+        trainer_arguments.TrainingArguments
+        ))
+
+    return (planner_args, *trainer_parser.parse_args_into_dataclasses(args=remaining_args))
@@ -0,0 +1,74 @@
+from contextlib import contextmanager
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+@contextmanager
+def capture_lm_head_input(model):
+    # lm_head 를 잠시 건너뛰어서 [batch, seq, vocab] logits 를 만들지 않고 마지막 hidden state 만 받아옴
+    lm_head = model.get_output_embeddings()
+    lm_head_forward = lm_head.forward
+    captured = {}
+
+    def skip_lm_head(hidden_states):
+        captured["hidden_states"] = hidden_states
+        return hidden_states[..., :0]
+
+    lm_head.forward = skip_lm_head
+    try:
+        yield captured, lm_head_forward
+    finally:
+        lm_head.forward = lm_head_forward
+
+
+def chunk_token_logps(hidden_states, labels, lm_head_forward, softcap):
+    logits = lm_head_forward(hidden_states)
+    if softcap is not None:
+        # Gemma-2 와 같이 모델 dtype 에서 final logit softcapping 을 적용한 뒤 float 로 변환
+        logits = torch.tanh(logits / softcap) * softcap
+    logits = logits.float()
+    token_logps = logits.gather(-1, labels[:, None]).squeeze(-1) - torch.logsumexp(logits, dim=-1)
+    return token_logps, logits.detach().mean(dim=-1)
+
+
+def chunked_token_logps(hidden_states, labels, lm_head_forward, softcap=None, chunk_size=1024, ignore_index=-100):
+    # hidden_states[:, t] 가 labels[:, t] 를 예측하도록 호출하는 쪽에서 미리 shift 함
+    mask = labels != ignore_index
+    selected_hidden_states = hidden_states[mask]
+    selected_labels = labels[mask]
+
+    token_logps, mean_logits = [], []
+    for start in range(0, selected_labels.shape[0], chunk_size):
+        args = (selected_hidden_states[start:start + chunk_size], selected_labels[start:start + chunk_size], lm_head_forward, softcap)
+        # backward 때 chunk 의 logits 를 다시 계산해서 한 번에 한 chunk 의 logits 만 메모리에 둠
+        outputs = checkpoint(chunk_token_logps, *args, use_reentrant=False) if torch.is_grad_enabled() else chunk_token_logps(*args)
+        token_logps.append(outputs[0])
+        mean_logits.append(outputs[1])
+
+    token_logps = torch.cat(token_logps) if token_logps else selected_hidden_states.new_zeros(0, dtype=torch.float32)
+    mean_logits = torch.cat(mean_logits) if mean_logits else selected_hidden_states.new_zeros(0, dtype=torch.float32)
+
+    per_token_logps = torch.zeros(labels.shape, dtype=torch.float32, device=hidden_states.device).masked_scatter(mask, token_logps)
+    return per_token_logps, mask, mean_logits
+
+
+def chunked_causal_lm_logps(model, unwrapped_model, inputs, labels, chunk_size=1024, ignore_index=-100):
+    softcap = getattr(unwrapped_model.config, "final_logit_softcapping", None)
+
+    with capture_lm_head_input(unwrapped_model) as (captured, lm_head_forward):
+        outputs = model(**inputs, use_cache=False)
+
+    hidden_states = captured["hidden_states"][:, :-1]
+    labels = labels[:, 1:].to(hidden_states.device)
+    per_token_logps, mask, mean_logits = chunked_token_logps(hidden_states, labels, lm_head_forward, softcap, chunk_size, ignore_index)
+    return per_token_logps, mask, mean_logits, outputs
+
+
+def chunked_causal_lm_loss(model, unwrapped_model, inputs, chunk_size=1024):
+    labels = inputs.pop("labels")
+    per_token_logps, mask, _, outputs = chunked_causal_lm_logps(model, unwrapped_model, inputs, labels, chunk_size)
+
+    # 모델의 기본 loss 와 같이 label 이 있는 토큰 평균 cross entropy
+    loss = -per_token_logps.sum() / mask.sum().clamp(min=1)
+    return loss, outputs
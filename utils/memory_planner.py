@@ -0,0 +1,463 @@
+import copy
+import itertools
+import re
+from dataclasses import asdict
+from types import SimpleNamespace
+
+import torch
+import torch.nn.functional as F
+
+from rich.console import Console
+from rich.panel import Panel
+from rich.pretty import Pretty
+from rich.table import Table
+
+from transformers import AutoConfig, AutoModelForCausalLM
+from peft import LoraConfig, get_peft_model
+
+from arguments import memory_planner_parse_args
+from chunked_loss import chunked_causal_lm_logps
+
+
+GB = 1024 ** 3
+DTYPE_BYTES = {torch.float32: 4, torch.bfloat16: 2, torch.float16: 2}
+# bitsandbytes nf4 + double quant: 4bit 가중치, 64 개마다 8bit absmax, absmax 256 개마다 fp32 scale
+NF4_BYTES_PER_PARAM = 0.5 + 1 / 64 + 4 / (64 * 256)
+# llm_dpo_trainer/train.py 의 DPOConfig(max_length=2048)
+DPO_MAX_LENGTH = 2048
+SUPPORTED_MODEL_TYPES = ("llama", "mistral", "qwen2", "gemma", "gemma2")
+LINEAR_NAMES = ("q_proj", "k_proj", "v_proj", "o_proj", "gate_proj", "up_proj", "down_proj")
+
+
+def training_plan(trainer, training_mode_args, model_args, lora_args, training_args):
+    # DPO trainer 는 항상 LoRA (또는 QLoRA) 로 학습
+    use_lora = getattr(training_mode_args, "use_lora", True)
+    mode = "qlora" if training_mode_args.use_qlora is True else "lora" if use_lora is True else "full"
+
+    return SimpleNamespace(
+        trainer=trainer,
+        mode=mode,
+        mixed_precision=training_args.mixed_precision in ("bf16", "fp16"),
+        attention=model_args.attention_implementation,
+        gradient_checkpointing=training_mode_args.gradient_checkpointing,
+        loss_chunk_size=training_mode_args.loss_chunk_size if training_mode_args.use_chunked_loss is True else None,
+        lora_r=lora_args.lora_r,
+        lora_alpha=lora_args.lora_alpha,
+        lora_dropout=lora_args.lora_dropout,
+        lora_target_modules=lora_args.lora_target_modules,
+        batch_size=training_args.per_device_train_batch_size,
+        seq_length=getattr(training_args, "max_seq_length", DPO_MAX_LENGTH)
+        )
+
+
+def model_dims(config):
+    if config.model_type not in SUPPORTED_MODEL_TYPES:
+        raise ValueError(f"model_type '{config.model_type}' is not supported. Supported: {', '.join(SUPPORTED_MODEL_TYPES)}")
+
+    heads = config.num_attention_heads
+    return SimpleNamespace(
+        model_type=config.model_type,
+        hidden=config.hidden_size,
+        intermediate=config.intermediate_size,
+        layers=config.num_hidden_layers,
+        heads=heads,
+        kv_heads=getattr(config, "num_key_value_heads", None) or heads,
+        head_dim=getattr(config, "head_dim", None) or config.hidden_size // heads,
+        vocab=config.vocab_size,
+        norms_per_layer=4 if config.model_type == "gemma2" else 2,
+        gemma_norm=config.model_type in ("gemma", "gemma2"),
+        attn_softcap=getattr(config, "attn_logit_softcapping", None) is not None,
+        final_softcap=getattr(config, "final_logit_softcapping", None) is not None,
+        torch_dtype=config.torch_dtype if isinstance(config.torch_dtype, torch.dtype) else getattr(torch, str(config.torch_dtype or "float32"))
+        )
+
+
+def is_lora_target(name, target_modules):
+    # peft 와 같이 "all-linear" 가 아니면 문자열 target_modules 를 module 이름 전체에 대한 정규식으로 취급
+    if target_modules == "all-linear":
+        return True
+    return re.fullmatch(target_modules, name) is not None
+
+
+def parameter_counts(config, plan):
+    # meta device 에 모델을 만들어서 메모리 없이 정확한 파라미터 수를 셈
+    with torch.device("meta"):
+        model = AutoModelForCausalLM.from_config(config)
+
+    output_embeddings = model.get_output_embeddings()
+    total = sum(p.numel() for p in model.parameters())
+    linear, lora, targeted = 0, 0, set()
+    for name, module in model.named_modules():
+        if not isinstance(module, torch.nn.Linear) or module is output_embeddings:
+            continue
+        linear += module.weight.numel()
+        if plan.mode != "full" and is_lora_target(name, plan.lora_target_modules):
+            lora += plan.lora_r * (module.in_features + module.out_features)
+            targeted.add(name.split(".")[-1])
+
+    return SimpleNamespace(
+        total=total,
+        linear=linear,
+        lora=lora,
+        trainable=total if plan.mode == "full" else lora,
+        targeted=set(LINEAR_NAMES) if plan.mode == "full" else targeted
+        )
+
+
+def estimate_memory(dims, counts, plan, batch_size, seq_length):
+    H, I, V = dims.hidden, dims.intermediate, dims.vocab
+    Q, K = dims.heads * dims.head_dim, dims.kv_heads * dims.head_dim
+    # DPO 는 chosen / rejected 를 이어 붙여서 한 번에 forward
+    rows = batch_size * (2 if plan.trainer == "dpo" else 1)
+    tokens = rows * seq_length
+
+    full = plan.mode == "full"
+    lora = plan.mode != "full"
+    # 학습 스크립트는 QLoRA 가 아니면 float32 로 불러오고, mixed precision 은 autocast 로 matmul 만 낮은 정밀도로 계산
+    rb = 4 if plan.mode != "qlora" else DTYPE_BYTES.get(dims.torch_dtype, 4)
+    ab = 2 if plan.mixed_precision is True else rb
+    # peft 는 gradient checkpointing 일 때 입력에 requires_grad 를 걸어서 첫 layer 도 입력 gradient 를 계산
+    input_requires_grad = full or plan.gradient_checkpointing is True
+
+    def norm_bytes(trainable):
+        # float32 입력 (또는 복사본), rsqrt, 그리고 weight 를 학습하면 정규화된 값까지 저장
+        normed = (4 if dims.gemma_norm else rb) * H if trainable else 0
+        return 4 * H + 4 + normed
+
+    def linear_input_bytes(names, dim, input_bytes, shared):
+        targets = len(counts.targeted & set(names))
+        if targets == 0:
+            return 0
+        if lora and plan.lora_dropout > 0:
+            # lora_A 마다 dropout 결과와 mask 를 따로 저장
+            dropout = targets * (dim * (input_bytes + 1) + (dim * ab if input_bytes != ab else 0))
+            # cast 하지 않으면 base linear 는 group 이 공유하는 입력을 한 번 저장
+            return dropout + (dim * input_bytes if input_bytes == ab == rb and not shared else 0)
+        if input_bytes != ab:
+            # autocast 는 linear 마다 입력을 따로 cast 해서 그 복사본을 저장
+            return targets * dim * ab
+        return 0 if shared else dim * ab
+
+    def lora_bytes(names):
+        # lora_A 출력 (rank 차원) 은 lora_B 의 backward 에 필요
+        return len(counts.targeted & set(names)) * plan.lora_r * ab if lora else 0
+
+    per_token = dims.norms_per_layer * norm_bytes(full)
+    per_token += linear_input_bytes(("q_proj", "k_proj", "v_proj"), H, rb, shared=False) + lora_bytes(("q_proj", "k_proj", "v_proj"))
+    mask_per_layer, mask_once, sliding_masks = 0, 0, 0
+    if plan.attention == "eager":
+        # q, k, v 와 softmax 확률 (float32) 을 저장하므로 토큰당 seq_length 에 비례
+        per_token += 3 * Q * ab + 4 * dims.heads * seq_length
+        per_token += ab * dims.heads * seq_length if ab != 4 else 0
+        per_token += ab * dims.heads * seq_length if dims.attn_softcap else 0
+        per_token += linear_input_bytes(("o_proj",), Q, ab, shared=False)
+    elif plan.attention == "flash_attention_2":
+        per_token += (2 * Q + 2 * K) * ab + 4 * dims.heads
+        per_token += linear_input_bytes(("o_proj",), Q, ab, shared=True)
+    else:
+        # sdpa 는 q, repeat 된 k / v, 출력, logsumexp 만 저장
+        per_token += 4 * Q * ab + 4 * dims.heads
+        per_token += linear_input_bytes(("o_proj",), Q, ab, shared=True)
+        # gemma2 는 항상, 나머지는 padding 이 있는 batch 에서 4D mask 를 넘김
+        if dims.model_type == "gemma2" or rows > 1:
+            if ab != rb:
+                mask_per_layer = rows * seq_length * seq_length * ab
+            else:
+                mask_once = rows * seq_length * seq_length * rb
+                # gemma2 의 sliding window layer (짝수 번째) 는 layer 안에서 mask 를 새로 만들어서 따로 저장
+                if dims.model_type == "gemma2":
+                    sliding_masks = (dims.layers + 1) // 2 * rows * seq_length * seq_length * rb
+    per_token += lora_bytes(("o_proj",))
+    per_token += linear_input_bytes(("gate_proj", "up_proj"), H, rb, shared=False) + lora_bytes(("gate_proj", "up_proj"))
+    per_token += 3 * I * ab
+    per_token += linear_input_bytes(("down_proj",), I, ab, shared=False) + lora_bytes(("down_proj",))
+
+    # autocast 는 float32 weight 의 half 복사본을 backward 까지 들고 있음 (QLoRA 는 4bit 를 그때그때 풀어서 씀)
+    attention_weights = 2 * H * Q + 2 * H * K
+    layer_weights = attention_weights + 3 * H * I
+    layer_lora = counts.lora // dims.layers if lora else 0
+    per_layer = mask_per_layer
+    if plan.mixed_precision is True and plan.mode != "qlora":
+        per_layer += layer_weights * ab
+    if plan.mixed_precision is True and lora:
+        per_layer += layer_lora * ab
+    if dims.gemma_norm:
+        per_layer += dims.norms_per_layer * H * 4
+
+    layer = tokens * per_token + per_layer
+    if not input_requires_grad:
+        # 첫 layer 는 입력 gradient 가 필요 없어서 input norm 과 q, k, v 의 weight 복사본을 저장하지 않음
+        first_layer = layer - tokens * norm_bytes(False) - (H * 4 if dims.gemma_norm else 0)
+        first_layer -= (H * Q + 2 * H * K) * ab if plan.mixed_precision is True and plan.mode != "qlora" else 0
+    else:
+        first_layer = layer
+
+    # eager 는 항상, sdpa 는 mask 를 넘길 때 모든 layer 가 같은 4D mask 를 공유
+    uses_mask = plan.attention == "eager" or (plan.attention == "sdpa" and (dims.model_type == "gemma2" or rows > 1))
+
+    base = tokens * norm_bytes(full) + mask_once
+    if full:
+        base += tokens * 8 + tokens * H * ab
+    if plan.mixed_precision is True and rb != ab and plan.loss_chunk_size is None:
+        base += V * H * ab
+
+    if plan.gradient_checkpointing is True:
+        # layer 입력만 저장하고 backward 때 한 layer 씩 다시 계산
+        # checkpoint 는 layer 입력과 함께 공유 mask 도 저장
+        activations = dims.layers * tokens * rb * H + base
+        activations += rows * seq_length * seq_length * rb if uses_mask and mask_once == 0 else 0
+        recompute = layer
+    else:
+        activations = first_layer + (dims.layers - 1) * layer + base + sliding_masks
+        recompute = 0
+
+    softcap = tokens * V * ab if dims.final_softcap else 0
+    if plan.loss_chunk_size is not None:
+        # chunk 의 logits 만 잠깐 만들고 backward 에서 다시 계산 (마지막 hidden state 와 label, mask 만 저장)
+        logits = tokens * (H * rb + 9)
+        transient = min(tokens, plan.loss_chunk_size) * V * 16 + (V * H * ab if plan.mixed_precision is True and rb != ab else 0)
+    elif plan.trainer == "dpo":
+        # log_softmax (전체) + chosen 의 NLL, 그리고 reference forward 동안 policy logits 를 들고 있음
+        logits = tokens * V * 4 + tokens // 2 * V * 4 + softcap
+        transient = tokens * V * (4 + 8 + ab)
+    else:
+        # cross entropy 의 log_softmax 와 float32 logits, shift 복사본
+        logits = tokens * V * 4 + softcap
+        transient = tokens * V * 8
+
+    if plan.mode == "qlora":
+        weights = counts.linear * NF4_BYTES_PER_PARAM + (counts.total - counts.linear) * rb + counts.lora * 4
+    else:
+        weights = counts.total * 4 + counts.lora * 4
+
+    estimate = {
+        "weights": weights,
+        "gradients": counts.trainable * 4,
+        # adamw_torch 는 float32 상태 2 개, paged_adamw_8bit 는 8bit 상태 2 개
+        "optimizer": counts.trainable * (8 if plan.mode != "qlora" else 2),
+        "activations": activations,
+        "logits": logits,
+        "recompute": recompute,
+        "transient": transient
+        }
+    estimate["total"] = sum(estimate.values())
+    return estimate
+
+
+def recommend(dims, counts, plan, seq_lengths, max_batch_size, budget):
+    recommendations = []
+    for seq_length in seq_lengths:
+        best = None
+        for batch_size in range(1, max_batch_size + 1):
+            estimate = estimate_memory(dims, counts, plan, batch_size, seq_length)
+            if estimate["total"] > budget:
+                break
+            best = (batch_size, estimate["total"])
+        recommendations.append((seq_length, best))
+    return recommendations
+
+
+def tiny_config(config):
+    # 같은 구조 (GQA 비율, softcapping, tie embedding) 를 유지한 채 크기만 줄임
+    tiny = copy.deepcopy(config)
+    ratio = max(1, config.num_attention_heads // (getattr(config, "num_key_value_heads", None) or config.num_attention_heads))
+    tiny.hidden_size = 64
+    tiny.intermediate_size = 176
+    tiny.num_hidden_layers = 2
+    tiny.num_attention_heads = 8
+    # key / value head 가 1 개면 repeat_kv 가 복사 없이 view 를 돌려줘서 실제 모델과 달라짐
+    tiny.num_key_value_heads = max(2, 8 // ratio)
+    tiny.vocab_size = 320
+    tiny.max_position_embeddings = 4096
+    if hasattr(tiny, "head_dim"):
+        tiny.head_dim = 16
+    if getattr(tiny, "sliding_window", None) is not None:
+        tiny.sliding_window = 4096
+    if getattr(tiny, "rope_scaling", None) is not None:
+        tiny.rope_scaling = None
+    tiny.torch_dtype = torch.float32
+    return tiny
+
+
+def measure_tiny(config, plan, batch_size, seq_length):
+    torch.manual_seed(0)
+    model = AutoModelForCausalLM.from_config(config, attn_implementation=plan.attention, torch_dtype=torch.float32)
+    if plan.gradient_checkpointing is True:
+        model.config.use_cache = False
+        model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        model.enable_input_require_grads() if plan.mode != "full" else None
+    if plan.mode != "full":
+        model = get_peft_model(model, LoraConfig(
+            r=plan.lora_r,
+            lora_alpha=plan.lora_alpha,
+            target_modules=plan.lora_target_modules,
+            lora_dropout=plan.lora_dropout,
+            bias="none",
+            task_type="CAUSAL_LM"
+            ))
+    model.train()
+
+    rows = batch_size * (2 if plan.trainer == "dpo" else 1)
+    input_ids = torch.randint(0, config.vocab_size, (rows, seq_length))
+    attention_mask = torch.ones_like(input_ids)
+    if rows > 1:
+        # 학습 때처럼 padding 이 있는 batch
+        attention_mask[-1, -seq_length // 4:] = 0
+    labels = input_ids.masked_fill(attention_mask == 0, -100)
+    inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    # parameter 가 아닌 텐서 중 backward 를 위해 저장된 것을 storage 단위로 합산
+    parameter_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameter_storages:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=plan.mixed_precision):
+            if plan.loss_chunk_size is not None:
+                per_token_logps, mask, _, _ = chunked_causal_lm_logps(model, model, inputs, labels, plan.loss_chunk_size)
+                loss = -per_token_logps.sum() / mask.sum()
+            elif plan.trainer == "dpo":
+                # trl 0.9.6 의 concatenated_forward 와 같은 순서: 전체 log_softmax 후 chosen 의 NLL
+                logits = model(**inputs, use_cache=False).logits.float()
+                shifted_labels = labels[:, 1:]
+                logps = torch.gather(logits[:, :-1].log_softmax(-1), 2, shifted_labels.clamp(min=0).unsqueeze(2)).squeeze(2)
+                nll = F.cross_entropy(logits[:rows // 2, :-1].contiguous().view(-1, logits.shape[-1]), shifted_labels[:rows // 2].reshape(-1))
+                loss = -(logps * (shifted_labels != -100)).sum() / rows + nll
+            else:
+                loss = model(**inputs, labels=labels, use_cache=False).loss
+    activations = sum(saved.values())
+
+    loss.backward()
+    trainable = [p for p in model.parameters() if p.requires_grad]
+    gradients = sum(p.grad.nbytes for p in trainable)
+    optimizer = torch.optim.AdamW(trainable)
+    optimizer.step()
+    optimizer_state = sum(value.nbytes for state in optimizer.state.values() for key, value in state.items() if key != "step")
+
+    return {
+        "parameters": sum(p.numel() for p in model.parameters()),
+        "trainable": sum(p.numel() for p in trainable),
+        "activations": activations,
+        "gradients": gradients,
+        "optimizer": optimizer_state
+        }
+
+
+def validate(config, plan):
+    tiny = tiny_config(config)
+    dims = model_dims(tiny)
+    rows = []
+    # QLoRA 는 CPU 에서 bitsandbytes 를 쓸 수 없으므로 같은 adapter 구성의 LoRA 로 확인
+    modes = ["full", "lora"] if plan.mode == "full" else ["lora"]
+    for mode, mixed_precision, gradient_checkpointing, batch_size, seq_length in itertools.product(modes, [False, True], [False, True], [1, 2], [64, 128]):
+        case = SimpleNamespace(**{**vars(plan), "mode": mode, "mixed_precision": mixed_precision, "gradient_checkpointing": gradient_checkpointing})
+        counts = parameter_counts(tiny, case)
+        estimate = estimate_memory(dims, counts, case, batch_size, seq_length)
+        measured = measure_tiny(tiny, case, batch_size, seq_length)
+
+        estimated_activations = estimate["activations"] + estimate["logits"]
+        rows.append({
+            "case": f"{mode} {'bf16' if mixed_precision else 'fp32'}{' gc' if gradient_checkpointing else ''} b{batch_size} s{seq_length}",
+            "parameters": counts.total + counts.lora == measured["parameters"] and counts.trainable == measured["trainable"],
+            "states": estimate["gradients"] == measured["gradients"] and (mode == "qlora" or estimate["optimizer"] == measured["optimizer"]),
+            "estimated": estimated_activations,
+            "measured": measured["activations"],
+            "error": (estimated_activations - measured["activations"]) / measured["activations"]
+            })
+    return rows
+
+
+def validation_failed(validation, tolerance):
+    return any(not row["parameters"] or not row["states"] or abs(row["error"]) > tolerance for row in validation)
+
+
+def format_gb(value):
+    return f"{value / GB:.2f}"
+
+
+def main():
+    args = memory_planner_parse_args()
+    planner_args = args[0]
+    training_mode_args = args[1]
+    model_args = args[2]
+    lora_args = args[3]
+    training_args = args[4]
+
+    plan = training_plan(planner_args.trainer, training_mode_args, model_args, lora_args, training_args)
+    config = AutoConfig.from_pretrained(model_args.model_name_or_path)
+    dims = model_dims(config)
+    counts = parameter_counts(config, plan)
+
+    validation = validate(config, plan) if planner_args.validate is True else None
+
+    budget = planner_args.gpu_memory_gb * GB * (1 - planner_args.memory_headroom)
+    estimate = estimate_memory(dims, counts, plan, plan.batch_size, plan.seq_length)
+    seq_lengths = [int(seq_length) for seq_length in planner_args.seq_lengths.split(",") if seq_length.strip()]
+    recommendations = recommend(dims, counts, plan, seq_lengths, planner_args.max_batch_size, budget)
+
+    return planner_args, training_mode_args, model_args, lora_args, training_args, plan, counts, estimate, budget, recommendations, validation
+
+
+def print_plan(planner_args, training_mode_args, model_args, lora_args, training_args, plan, counts, estimate, budget, recommendations, validation):
+    console = Console()
+
+    combined_settings = {
+        "Planner Args": asdict(planner_args),
+        "Training Mode Args": asdict(training_mode_args),
+        "Model Args": asdict(model_args),
+        "Lora Args": asdict(lora_args),
+        "Training Args": asdict(training_args)
+    }
+    if plan.mode == "full":
+        del combined_settings["Lora Args"]
+    console.print("\n", Panel(Pretty(combined_settings), title="Planner Settings", border_style="bold", width=80), "\n")
+
+    if validation is not None:
+        table = Table(title="Activation estimate vs tiny CPU model")
+        for column in ["Case", "Params", "Grad / Optim", "Estimated (KB)", "Measured (KB)", "Error"]:
+            table.add_column(column)
+        for row in validation:
+            table.add_row(
+                row["case"],
+                "ok" if row["parameters"] else "mismatch",
+                "ok" if row["states"] else "mismatch",
+                f"{row['estimated'] / 1024:.1f}",
+                f"{row['measured'] / 1024:.1f}",
+                f"{row['error']:+.1%}"
+                )
+        console.print(table)
+        console.print(f"max |error|: {max(abs(row['error']) for row in validation):.1%} (tolerance {planner_args.validate_tolerance:.1%})\n")
+        if validation_failed(validation, planner_args.validate_tolerance):
+            console.print("[bold red]Validation failed: estimates are outside the tolerance, so the batch sizes below may not fit.\n")
+
+    table = Table(title=f"{plan.trainer.upper()} {plan.mode} · batch {plan.batch_size} · {plan.seq_length} tokens · {counts.trainable:,} trainable / {counts.total:,} params")
+    table.add_column("Component")
+    table.add_column("GB", justify="right")
+    for component in ["weights", "gradients", "optimizer", "activations", "logits", "recompute", "transient", "total"]:
+        table.add_row(component, format_gb(estimate[component]))
+    console.print(table)
+
+    fits = "fits" if estimate["total"] <= budget else "does not fit"
+    console.print(f"Budget: {format_gb(budget)} GB ({planner_args.gpu_memory_gb:g} GB - {planner_args.memory_headroom:.0%} headroom) · current settings {fits}\n")
+
+    table = Table(title="Largest per-device batch size that fits")
+    for column in ["Sequence length", "Batch size", "Estimated GB"]:
+        table.add_column(column)
+    for seq_length, best in recommendations:
+        table.add_row(str(seq_length), str(best[0]) if best else "-", format_gb(best[1]) if best else "-")
+    console.print(table, "\n")
+
+
+if __name__ == "__main__":
+    plan_args = main()
+    print_plan(*plan_args)
+
+    # 추정치가 허용 오차를 넘으면 스크립트에서 알 수 있도록 실패로 종료
+    validation = plan_args[-1]
+    if validation is not None and validation_failed(validation, plan_args[0].validate_tolerance):
+        raise ValueError(f"Memory estimates do not match the tiny model measurements (activation error above --validate_tolerance {plan_args[0].validate_tolerance:g} or a parameter / gradient / optimizer size mismatch).")
@@ -0,0 +1,100 @@
+import numpy as np
+
+from rich.console import Console
+
+from torch.utils.data import DataLoader
+from transformers import TrainerCallback
+
+
+class TokenBudgetBatchSampler:
+    def __init__(self, lengths, max_tokens, rows_per_example=1, real_lengths=None, bucket_size=100, seed=42):
+        self.lengths = np.asarray(lengths)
+        # padding 없이 실제로 들어있는 토큰 수 (기본값은 행마다 lengths 만큼)
+        self.real_lengths = np.asarray(real_lengths) if real_lengths is not None else self.lengths * rows_per_example
+        self.max_tokens = max_tokens
+        self.rows_per_example = rows_per_example
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+        self.epoch_stats = {}
+
+    @property
+    def sampler(self):
+        # accelerate 의 DataLoaderShard.set_epoch 은 batch_sampler.sampler.set_epoch 만 호출하므로 자신을 넘겨서 epoch 을 받음
+        return self
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, epoch):
+        rng = np.random.default_rng(self.seed + epoch)
+        order = rng.permutation(len(self.lengths))
+
+        # 섞은 순서를 bucket 단위로 나눠서 bucket 안에서만 길이순으로 정렬해 epoch 마다 다른 조합이 나오게 함
+        window = self.bucket_size * max(1, self.max_tokens // max(1, int(self.lengths.mean()) * self.rows_per_example))
+        batches = []
+        for start in range(0, len(order), window):
+            bucket = order[start:start + window]
+            bucket = bucket[np.argsort(-self.lengths[bucket], kind="stable")]
+
+            batch, max_length = [], 0
+            for idx in bucket:
+                length = int(self.lengths[idx])
+                # batch 는 가장 긴 예제 길이로 padding 되므로 (예제 수 x 최대 길이) 가 max_tokens 를 넘지 않게 묶음
+                if batch and (len(batch) + 1) * self.rows_per_example * max(max_length, length) > self.max_tokens:
+                    batches.append(batch)
+                    batch, max_length = [], 0
+                batch.append(int(idx))
+                max_length = max(max_length, length)
+            if batch:
+                batches.append(batch)
+
+        return [batches[idx] for idx in rng.permutation(len(batches))]
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+
+        real_tokens = sum(int(self.real_lengths[batch].sum()) for batch in batches)
+        padded_tokens = sum(len(batch) * int(self.lengths[batch].max()) * self.rows_per_example for batch in batches)
+        self.epoch_stats[self.epoch] = {
+            "batches": len(batches),
+            "mean_batch_size": float(np.mean([len(batch) for batch in batches])),
+            "real_tokens": real_tokens,
+            "padded_tokens": padded_tokens,
+            "padding_efficiency": real_tokens / max(1, padded_tokens)
+            }
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches(self.epoch))
+
+
+def token_budget_dataloader(trainer, lengths, max_tokens, rows_per_example=1, real_lengths=None):
+    train_dataset = trainer._remove_unused_columns(trainer.train_dataset, description="training")
+    trainer.token_budget_sampler = TokenBudgetBatchSampler(lengths, max_tokens, rows_per_example=rows_per_example, real_lengths=real_lengths, seed=trainer.args.seed)
+
+    dataloader = DataLoader(
+        train_dataset,
+        batch_sampler=trainer.token_budget_sampler,
+        collate_fn=trainer.data_collator,
+        num_workers=trainer.args.dataloader_num_workers,
+        pin_memory=trainer.args.dataloader_pin_memory
+        )
+    return trainer.accelerator.prepare(dataloader)
+
+
+class PaddingEfficiencyCallback(TrainerCallback):
+    def __init__(self, trainer):
+        self.trainer = trainer
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        sampler = getattr(self.trainer, "token_budget_sampler", None)
+        if sampler is None or sampler.epoch not in sampler.epoch_stats or not state.is_world_process_zero:
+            return
+
+        stats = sampler.epoch_stats[sampler.epoch]
+        Console().print(
+            f"\nEpoch {sampler.epoch} padding efficiency: {stats['padding_efficiency']:.1%} "
+            f"({stats['real_tokens']} real / {stats['padded_tokens']} padded tokens, "
+            f"{stats['batches']} batches, {stats['mean_batch_size']:.1f} examples per batch)\n"
+            )
@@ -0,0 +1,208 @@
+import json
+import os
+import time
+
+import torch
+
+from rich.console import Console
+from rich.table import Table
+
+from transformers import TrainerCallback
+
+
+TRAINING_METRICS_NAME = "training_metrics.jsonl"
+GB = 1024 ** 3
+
+
+def synchronize():
+    # CUDA 는 비동기로 실행되므로 구간을 나누기 전에 이전 kernel 이 끝날 때까지 기다림
+    if torch.cuda.is_available():
+        for device in range(torch.cuda.device_count()):
+            torch.cuda.synchronize(device)
+
+
+def count_tokens(inputs, pad_token_id):
+    # DPO 는 chosen 과 rejected 를 이어 붙여서 둘 중 긴 쪽 길이로 padding 함
+    if "chosen_attention_mask" in inputs and "rejected_attention_mask" in inputs:
+        chosen_mask, rejected_mask = inputs["chosen_attention_mask"], inputs["rejected_attention_mask"]
+        real_tokens = int(chosen_mask.sum()) + int(rejected_mask.sum())
+        padded_tokens = 2 * chosen_mask.shape[0] * max(chosen_mask.shape[1], rejected_mask.shape[1])
+        return real_tokens, padded_tokens
+
+    input_ids = inputs["input_ids"]
+    attention_mask = inputs.get("attention_mask")
+    if attention_mask is not None and attention_mask.dim() == 2:
+        return int(attention_mask.sum()), input_ids.numel()
+
+    # packing 은 2D mask 가 없으므로 행 끝에 이어지는 label 없는 pad 토큰을 padding 으로 셈
+    padding = input_ids == pad_token_id
+    if "labels" in inputs:
+        padding &= inputs["labels"] == -100
+    trailing_padding = int(padding.flip(-1).long().cumprod(dim=-1).sum())
+    return input_ids.numel() - trailing_padding, input_ids.numel()
+
+
+class TrainingMetricsCallback(TrainerCallback):
+    def __init__(self, trainer):
+        self.trainer = trainer
+        self.pad_token_id = getattr(trainer.data_collator, "pad_token_id", None)
+        self.in_training_step = False
+        self.window = self.new_window()
+        self.totals = self.new_window()
+        self.records = []
+
+        # 학습 loop 안쪽은 callback 으로 나눌 수 없어서 training_step 과 forward 를 감싸서 시간을 잼
+        training_step = trainer.training_step
+
+        def timed_training_step(model, inputs):
+            start = time.perf_counter()
+            self.window["data_wait"] += start - self.ready
+            real_tokens, padded_tokens = count_tokens(inputs, self.pad_token_id)
+            self.window["real_tokens"] += real_tokens
+            self.window["padded_tokens"] += padded_tokens
+
+            self.in_training_step = True
+            try:
+                loss = training_step(model, inputs)
+                synchronize()
+            finally:
+                self.in_training_step = False
+            self.ready = time.perf_counter()
+            self.window["compute"] += self.ready - start
+            return loss
+
+        trainer.training_step = timed_training_step
+
+        if hasattr(trainer, "concatenated_forward"):
+            concatenated_forward = trainer.concatenated_forward
+
+            def timed_concatenated_forward(model, batch):
+                # DPOTrainer 는 reference log prob 를 no_grad 로 계산하므로 그 구간만 따로 기록
+                if not self.in_training_step or torch.is_grad_enabled():
+                    return concatenated_forward(model, batch)
+                synchronize()
+                start = time.perf_counter()
+                outputs = concatenated_forward(model, batch)
+                synchronize()
+                self.window["reference_forward"] += time.perf_counter() - start
+                return outputs
+
+            trainer.concatenated_forward = timed_concatenated_forward
+
+    def new_window(self):
+        return {
+            "start": time.perf_counter(),
+            "steps": 0,
+            "real_tokens": 0,
+            "padded_tokens": 0,
+            "data_wait": 0.0,
+            "compute": 0.0,
+            "reference_forward": 0.0,
+            "optimizer": 0.0
+            }
+
+    def reset_peak_memory(self):
+        if torch.cuda.is_available():
+            for device in range(torch.cuda.device_count()):
+                torch.cuda.reset_peak_memory_stats(device)
+
+    def peak_memory(self):
+        if not torch.cuda.is_available():
+            return None
+        return max(torch.cuda.max_memory_allocated(device) for device in range(torch.cuda.device_count())) / GB
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self.path = os.path.join(args.output_dir, TRAINING_METRICS_NAME)
+        if state.is_world_process_zero:
+            os.makedirs(args.output_dir, exist_ok=True)
+            # checkpoint 에서 재개하면 이전 기록 뒤에 이어서 씀
+            open(self.path, "a" if state.global_step > 0 else "w", encoding="utf-8").close()
+        self.reset_peak_memory()
+        self.window = self.new_window()
+        self.totals = self.new_window()
+        self.ready = time.perf_counter()
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.ready = time.perf_counter()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        # gradient clipping 과 optimizer.step 을 합친 시간
+        synchronize()
+        self.window["optimizer"] += time.perf_counter() - self.ready
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.window["steps"] += 1
+        self.ready = time.perf_counter()
+
+    def on_save(self, args, state, control, **kwargs):
+        # checkpoint 저장 시간은 다음 batch 를 기다린 시간에 넣지 않음
+        self.ready = time.perf_counter()
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        window = self.window
+        if window["steps"] == 0:
+            return
+
+        elapsed = time.perf_counter() - window["start"]
+        record = {
+            "step": state.global_step,
+            "epoch": state.epoch,
+            "steps": window["steps"],
+            "elapsed_s": elapsed,
+            "real_tokens": window["real_tokens"],
+            "padded_tokens": window["padded_tokens"],
+            "real_tokens_per_s": window["real_tokens"] / elapsed,
+            "padded_tokens_per_s": window["padded_tokens"] / elapsed,
+            "padding_efficiency": window["real_tokens"] / max(1, window["padded_tokens"]),
+            "data_wait_s": window["data_wait"],
+            "compute_s": window["compute"],
+            "optimizer_s": window["optimizer"],
+            "other_s": max(0.0, elapsed - window["data_wait"] - window["compute"] - window["optimizer"]),
+            "data_wait_fraction": window["data_wait"] / elapsed,
+            "peak_memory_gb": self.peak_memory()
+            }
+        if hasattr(self.trainer, "concatenated_forward"):
+            record["reference_forward_s"] = window["reference_forward"]
+
+        for key in ("steps", "real_tokens", "padded_tokens", "data_wait", "compute", "reference_forward", "optimizer"):
+            self.totals[key] += window[key]
+        self.records.append(record)
+
+        if state.is_world_process_zero:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+        self.reset_peak_memory()
+        self.window = self.new_window()
+        # 로그 출력 시간도 다음 batch 를 기다린 시간에서 뺌
+        self.ready = time.perf_counter()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if not self.records or not state.is_world_process_zero:
+            return
+
+        totals = self.totals
+        elapsed = sum(record["elapsed_s"] for record in self.records)
+        other = max(0.0, elapsed - totals["data_wait"] - totals["compute"] - totals["optimizer"])
+        peak_memory = [record["peak_memory_gb"] for record in self.records if record["peak_memory_gb"] is not None]
+
+        table = Table(title=f"Training metrics ({totals['steps']} steps, {elapsed:.1f}s)")
+        table.add_column("Metric")
+        table.add_column("Value", justify="right")
+        table.add_column("Share", justify="right")
+        table.add_row("Dataloader wait", f"{totals['data_wait']:.2f}s", f"{totals['data_wait'] / elapsed:.1%}")
+        table.add_row("Forward / backward", f"{totals['compute']:.2f}s", f"{totals['compute'] / elapsed:.1%}")
+        if hasattr(self.trainer, "concatenated_forward"):
+            table.add_row("  Reference forward", f"{totals['reference_forward']:.2f}s", f"{totals['reference_forward'] / elapsed:.1%}")
+        table.add_row("Optimizer step", f"{totals['optimizer']:.2f}s", f"{totals['optimizer'] / elapsed:.1%}")
+        table.add_row("Logging / saving", f"{other:.2f}s", f"{other / elapsed:.1%}")
+        table.add_row("Real tokens / s", f"{totals['real_tokens'] / elapsed:,.0f}", "")
+        table.add_row("Padded tokens / s", f"{totals['padded_tokens'] / elapsed:,.0f}", "")
+        table.add_row("Padding efficiency", f"{totals['real_tokens'] / max(1, totals['padded_tokens']):.1%}", "")
+        table.add_row("Peak memory", f"{max(peak_memory):.2f} GB" if peak_memory else "-", "")
+
+        # 다음 batch 를 기다린 시간이 10% 를 넘으면 dataloader 가 GPU 를 따라가지 못하는 것으로 봄
+        bound = "input-bound" if totals["data_wait"] / elapsed > 0.1 else "compute-bound"
+        console = Console()
+        console.print("\n", table)
+        console.print(f"Run is {bound} · per-logging-step records saved to {self.path}\n")
@@ -0,0 +1,41 @@
+# Memory planner
+
+# gemma-2 SFT 설정
+python utils/memory_planner.py \
+   --trainer sft \
+   --gpu_memory_gb 80 \
+   --memory_headroom 0.15 \
+   --seq_lengths 512,1024,2048,4096,8192 \
+   --validate False \
+   --validate_tolerance 0.05 \
+   --use_lora True \
+   --use_qlora False \
+   --gradient_checkpointing False \
+   --use_chunked_loss False \
+   --data_name_or_path maywell/ko_wikidata_QA \
+   --model_name_or_path google/gemma-2-2b-it \
+   --attention_implementation eager \
+   --output_dir ./storage/trained_sft_models \
+   --per_device_train_batch_size 1 \
+   --mixed_precision bf16 \
+   --max_seq_length 2048
+
+"""
+# gemma-2 DPO 설정
+python utils/memory_planner.py \
+   --trainer dpo \
+   --gpu_memory_gb 80 \
+   --memory_headroom 0.15 \
+   --seq_lengths 512,1024,2048,4096 \
+   --validate False \
+   --validate_tolerance 0.05 \
+   --use_qlora False \
+   --gradient_checkpointing False \
+   --use_chunked_loss False \
+   --data_name_or_path xinlai/Math-Step-DPO-10K \
+   --model_name_or_path google/gemma-2-2b-it \
+   --attention_implementation eager \
+   --output_dir ./storage/trained_dpo_models \
+   --per_device_train_batch_size 1 \
+   --mixed_precision bf16
+"""